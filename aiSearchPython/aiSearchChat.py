@@ -1,13 +1,33 @@
 import os
+import re
 import json
+import math
+import time
+import numpy as np
 from openai import AzureOpenAI
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.models import Vector
+from azure.search.documents.models import VectorizedQuery
 from dotenv import load_dotenv
 
+try:
+    import tiktoken
+
+    encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(text):
+        return len(encoding.encode(text))
+
+except Exception:
+    # without tiktoken, or offline when the encoding can't be downloaded
+
+    def count_tokens(text):
+        # roughly 4 characters per token
+        return len(text) // 4
+
+
 load_dotenv(override=True)  # take environment variables from .env.
 # The following variables from your .env file are used in this notebook
 service_endpoint = os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"]
@@ -25,6 +45,21 @@ azure_openai_embedding_deployment = os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMEN
 embedding_model_name = os.environ["AZURE_OPENAI_EMBEDDING_MODEL_NAME"]
 gpt_model_name = os.environ["AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"]
 azure_openai_api_version = os.environ["AZURE_OPENAI_API_VERSION"]
+# query vectors are truncated like the indexed ones, see aiSearchIndexing2.py
+azure_openai_embedding_dimensions = int(os.getenv("AZURE_OPENAI_EMBEDDING_DIMENSIONS", 1536))
+
+# Local reranking of the search results before they are sent to the model, see rerank
+# "cosine" (query embedding against the recipe vectors), "term_overlap" (share of the query terms in the recipe) or "none" (the search order)
+rerank_scorer = os.getenv("RERANK_SCORER", "cosine")
+# number of search results that are reranked
+rerank_candidates = int(os.getenv("RERANK_CANDIDATES", 20))
+# maximal marginal relevance: 1 orders by relevance only, lower values prefer recipes unlike the ones already picked
+rerank_mmr_lambda = float(os.getenv("RERANK_MMR_LAMBDA", 0.7))
+# at most this many recipes, and this many tokens of recipes, are sent to the model
+rerank_top = int(os.getenv("RERANK_TOP", 3))
+rerank_context_tokens = int(os.getenv("RERANK_CONTEXT_TOKENS", 1000))
+# the recipe vectors cached by aiSearchIndexing2.py (next to it), the search returns them when there is no cache for this index
+recipe_vector_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("RECIPE_VECTOR_CACHE", "recipe_vectors.npz"))
 
 # Configure OpenAI environment variables
 client = AzureOpenAI(
@@ -46,9 +81,90 @@ def generate_embeddings(text):
         input=text, model=azure_openai_embedding_deployment
     )
     embeddings = response.data[0].embedding
+    if len(embeddings) > azure_openai_embedding_dimensions:
+        norm = math.sqrt(sum(x * x for x in embeddings[:azure_openai_embedding_dimensions])) or 1.0
+        embeddings = [x / norm for x in embeddings[:azure_openai_embedding_dimensions]]
     return embeddings
 
 
+def load_recipe_vectors(path):
+    if not os.path.exists(path):
+        return {}
+    cache = np.load(path)
+    # the cache is only used for the index and dimensions it was written for
+    if "index_name" not in cache.files or (str(cache["index_name"]), int(cache["dimensions"])) != (index_name, azure_openai_embedding_dimensions):
+        print(f"Ignoring {path}, it wasn't cached for index {index_name} with {azure_openai_embedding_dimensions} dimensions")
+        return {}
+    return dict(zip(cache["recipe_ids"].tolist(), cache["vectors"]))
+
+
+recipe_vectors = load_recipe_vectors(recipe_vector_cache)
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def tokenize(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+
+# Scorers of the relevance of a batch of candidates to the query, all at once
+def term_overlap_scores(query, query_vector, texts, vectors):
+    query_terms = tokenize(query)
+    if not query_terms:
+        return np.zeros(len(texts))
+    matches = np.array([[term in terms for term in query_terms] for terms in map(tokenize, texts)])
+    return matches.mean(axis=1)
+
+
+def cosine_scores(query, query_vector, texts, vectors):
+    return normalize(vectors) @ normalize(np.asarray(query_vector, dtype=np.float32))
+
+
+rerank_scorers = {"term_overlap": term_overlap_scores, "cosine": cosine_scores}
+if rerank_scorer not in rerank_scorers and rerank_scorer != "none":
+    raise ValueError(f"RERANK_SCORER must be one of {list(rerank_scorers)} or none, got {rerank_scorer}")
+
+
+def mmr_order(relevance, vectors, mmr_lambda, k):
+    """Picks k candidates one at a time, each the best by relevance minus its similarity to the ones picked before."""
+    vectors = normalize(vectors)
+    similarity = vectors @ vectors.T
+    max_similarity = np.zeros(len(relevance))
+    picked = np.zeros(len(relevance), dtype=bool)
+    order = []
+    for _ in range(min(k, len(relevance))):
+        mmr = np.where(picked, -np.inf, mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity)
+        best = int(np.argmax(mmr))
+        order.append(best)
+        picked[best] = True
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return order
+
+
+def rerank(query, query_vector, results, k):
+    """Orders the search results with the rerank_scorer (and by maximal marginal relevance when the results have
+    vectors), and returns the first k."""
+    if rerank_scorer == "none" or len(results) <= 1:
+        return results[:k]
+    texts = [f"{result['recipe_name']} {result['recipe_category']} {result['recipe']}" for result in results]
+    vectors = None
+    if all(result.get("recipe_vector") is not None for result in results):
+        vectors = np.array([result["recipe_vector"] for result in results], dtype=np.float32)
+    if rerank_scorer == "cosine" and vectors is None:
+        print("No vectors for all the results, reranking them by term overlap")
+        scores = term_overlap_scores(query, query_vector, texts, vectors)
+    else:
+        scores = rerank_scorers[rerank_scorer](query, query_vector, texts, vectors)
+    if vectors is not None and rerank_mmr_lambda < 1:
+        order = mmr_order(scores, vectors, rerank_mmr_lambda, k)
+    else:
+        order = np.argsort(-scores, kind="stable")[:k]
+    return [results[i] for i in order]
+
+
 model_name = gpt_model_name
 
 messages = [{"role": "user", "content": "Help me find a good lasagna recipe."}]
@@ -107,23 +223,42 @@ def query_recipes(query, ingredients_filter=None, time_filter=None):
         filter = time_filter
     print("I am looking for results")
     print("-----------------")
+    query_vector = generate_embeddings(query)
+    num_candidates = max(rerank_candidates, rerank_top) if rerank_scorer != "none" else rerank_top
+    select = ["recipe_id", "recipe", "recipe_category", "recipe_name", "description"]
+    if not recipe_vectors:
+        select.append("recipe_vector")
     results = search_client.search(
         query_type="semantic",
         query_language="en-us",
         semantic_configuration_name="my-semantic-config",
         search_text=query,
-        vectors=[Vector(value=generate_embeddings(query), k=3, fields="recipe_vector")],
+        vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=num_candidates, fields="recipe_vector")],
         filter=filter,
-        select=["recipe_id", "recipe", "recipe_category", "recipe_name", "description"],
-        top=3,
+        select=select,
+        top=num_candidates,
     )
+    results = list(results)
+    for result in results:
+        if result.get("recipe_vector") is not None:
+            continue
+        if result["recipe_id"] not in recipe_vectors:
+            # indexed after the cache was written, its vector is looked up once and cached for the next queries
+            document = search_client.get_document(key=result["recipe_id"], selected_fields=["recipe_vector"])
+            recipe_vectors[result["recipe_id"]] = np.asarray(document["recipe_vector"], dtype=np.float32)
+        result["recipe_vector"] = recipe_vectors[result["recipe_id"]]
     print("-----------------")
     print("I am DONE looking for results")
-    n = 1
+    results = rerank(query, query_vector, results, rerank_top)
     recipes_for_prompt = ""
+    num_tokens = 0
     for result in results:
-        recipes_for_prompt += f"Recipe {result['recipe_id']}: {result['recipe_name']}: {result['description']}\n"
-        n += 1
+        recipe_for_prompt = f"Recipe {result['recipe_id']}: {result['recipe_name']}: {result['description']}\n"
+        num_tokens += count_tokens(recipe_for_prompt)
+        # the first recipe is always kept, the others as long as they fit in the token budget
+        if recipes_for_prompt and num_tokens > rerank_context_tokens:
+            break
+        recipes_for_prompt += recipe_for_prompt
     print("I ended the Function")
     return recipes_for_prompt
 
@@ -190,10 +325,12 @@ def run_conversation(messages, tools, available_functions):
             print(message)
         print()
         print("HERE")
+        start = time.perf_counter()
         second_response = client.chat.completions.create(
             model=model_name,
             messages=messages,
         )  # get a new response from GPT where it can see the function response
+        print(f"Second request: {second_response.usage.prompt_tokens} prompt tokens, {time.perf_counter() - start:.2f}s")
 
         return second_response
     else:
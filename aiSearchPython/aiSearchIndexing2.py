@@ -1,5 +1,7 @@
 import os
 import json
+import math
+import numpy as np
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 from azure.core.credentials import AzureKeyCredential
@@ -20,6 +22,9 @@ from azure.search.documents.indexes.models import (
     SearchIndex,
     AzureOpenAIVectorizer,
     AzureOpenAIParameters,
+    ScalarQuantizationCompressionConfiguration,
+    ScalarQuantizationParameters,
+    BinaryQuantizationCompressionConfiguration,
 )
 
 # Load environment variables
@@ -41,6 +46,12 @@ embedding_model_name = os.getenv(
     "AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-ada-002"
 )
 azure_openai_api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-06-01")
+# "scalar" (int8) or "binary" (1 bit per dimension) quantization of the vector index, unset to keep full precision vectors
+vector_compression = os.getenv("AZURE_SEARCH_VECTOR_COMPRESSION")
+# compressed vector queries rerank this many times k candidates with the full precision vectors
+vector_oversampling = float(os.getenv("AZURE_SEARCH_VECTOR_OVERSAMPLING", 10))
+# local copy of the recipe vectors (next to this script), aiSearchChat.py reranks the search results with them
+recipe_vector_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("RECIPE_VECTOR_CACHE", "recipe_vectors.npz"))
 
 # Initialize the AzureOpenAI client
 client = AzureOpenAI(
@@ -105,14 +116,38 @@ fields = [
     ),
 ]
 
+# Configure the vector compression, if any
+compressions = []
+if vector_compression == "scalar":
+    compressions.append(
+        ScalarQuantizationCompressionConfiguration(
+            name="myCompression",
+            rerank_with_original_vectors=True,
+            default_oversampling=vector_oversampling,
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+        )
+    )
+elif vector_compression == "binary":
+    compressions.append(
+        BinaryQuantizationCompressionConfiguration(
+            name="myCompression",
+            rerank_with_original_vectors=True,
+            default_oversampling=vector_oversampling,
+        )
+    )
+elif vector_compression:
+    raise ValueError(f"AZURE_SEARCH_VECTOR_COMPRESSION must be scalar or binary, got {vector_compression}")
+
 # Configure the vector search algorithm and profile
 vector_search = VectorSearch(
     algorithms=[HnswAlgorithmConfiguration(name="myHnsw")],
+    compressions=compressions or None,
     profiles=[
         VectorSearchProfile(
             name="myHnswProfile",
             algorithm_configuration_name="myHnsw",
             vectorizer="myVectorizer",
+            compression_configuration_name="myCompression" if compressions else None,
         )
     ],
     vectorizers=[
@@ -160,11 +195,19 @@ print(f"{result.name} created")
 from azure.search.documents import SearchClient
 
 
+# Shorten an embedding of a Matryoshka model (text-embedding-3-*) to the index dimensions, rescaled to unit length
+def truncate_embedding(embedding, dimensions):
+    if len(embedding) <= dimensions:
+        return embedding
+    norm = math.sqrt(sum(x * x for x in embedding[:dimensions])) or 1.0
+    return [x / norm for x in embedding[:dimensions]]
+
+
 # Define a function to generate document embeddings
 def generate_embeddings(text):
     response = client.embeddings.create(input=text, model=embedding_model_name)
     embeddings = response.data[0].embedding
-    return embeddings
+    return truncate_embedding(embeddings, azure_openai_embedding_dimensions)
 
 
 # Load your data, generate embeddings, and prepare documents for upload from JSONL file
@@ -178,6 +221,16 @@ with open(input_file, "r", encoding="utf-8") as file:
         json_recipe["@search.action"] = "upload"
         documents.append(json_recipe)
 
+# Cache the vectors locally, so the chat doesn't have to retrieve them with the search results
+# the index and dimensions are saved with them, the chat ignores a cache written for others
+np.savez(
+    recipe_vector_cache,
+    index_name=np.array(index_name),
+    dimensions=np.array(azure_openai_embedding_dimensions),
+    recipe_ids=np.array([document["recipe_id"] for document in documents]),
+    vectors=np.array([document["recipe_vector"] for document in documents], dtype=np.float32),
+)
+
 # Upload the documents to the search index
 search_client = SearchClient(
     endpoint=endpoint, index_name=index_name, credential=credential
@@ -206,7 +206,7 @@ async def init_cosmosdb_client():
 def prepare_model_args(request_body, request_headers):
     request_messages = request_body.get("messages", [])
     messages = []
-    if not app_settings.datasource:
+    if not app_settings.datasource or app_settings.datasource.retrieves_locally:
         messages = [
             {
                 "role": "system",
@@ -250,7 +250,7 @@ def prepare_model_args(request_body, request_headers):
         "user": user_json
     }
 
-    if app_settings.datasource:
+    if app_settings.datasource and not app_settings.datasource.retrieves_locally:
         model_args["extra_body"] = {
             "data_sources": [
                 app_settings.datasource.construct_payload_configuration(
@@ -331,6 +331,44 @@ async def promptflow_request(request):
         logging.error(f"An error occurred while making promptflow_request: {e}")
 
 
+async def add_local_datasource_context(azure_openai_client, model_args):
+    """Grounds the model on the chunks of the local datasource best matching the last user message: they
+    are added to the system message, numbered for the model to cite them as [doc1], [doc2]...
+    Returns the context of the answer (its citations), as Azure OpenAI returns it for the other datasources."""
+    datasource = app_settings.datasource
+    parameters = datasource.construct_payload_configuration(request=request)["parameters"]
+    query = next(
+        (message["content"] for message in reversed(model_args["messages"]) if message["role"] == "user"),
+        ""
+    )
+    if not isinstance(query, str):
+        query = " ".join(part["text"] for part in query if part.get("type") == "text")
+
+    query_vector = None
+    if datasource.query_type != "simple":
+        if not app_settings.azure_openai.embedding_name:
+            raise ValueError("AZURE_OPENAI_EMBEDDING_NAME is required to search a local vector index")
+        embedding = await azure_openai_client.embeddings.create(
+            model=app_settings.azure_openai.embedding_name,
+            input=query
+        )
+        query_vector = embedding.data[0].embedding
+    # the search is synchronous numpy work, kept off the event loop
+    citations = await asyncio.to_thread(
+        datasource.retrieve, query, query_vector, parameters["filter"]
+    )
+    logging.debug(f"Retrieved {len(citations)} chunks from the local vector index")
+
+    grounding = "\n\nAnswer using the documents below, and cite the ones you use as [doc1], [doc2]..."
+    if datasource.enable_in_domain:
+        grounding += " If they do not contain the answer, reply that the requested information is not available in the retrieved data."
+    for i, citation in enumerate(citations):
+        grounding += f"\n\n[doc{i + 1}] {citation['title'] or ''}\n{citation['content']}"
+    model_args["messages"][0]["content"] += grounding
+
+    return {"citations": citations, "intent": json.dumps([query])}
+
+
 async def send_chat_request(request_body, request_headers):
     filtered_messages = []
     messages = request_body.get("messages", [])
@@ -343,6 +381,9 @@ async def send_chat_request(request_body, request_headers):
 
     try:
         azure_openai_client = await init_openai_client()
+        context = None
+        if app_settings.datasource and app_settings.datasource.retrieves_locally:
+            context = await add_local_datasource_context(azure_openai_client, model_args)
         raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
         response = raw_response.parse()
         apim_request_id = raw_response.headers.get("apim-request-id") 
@@ -350,7 +391,7 @@ async def send_chat_request(request_body, request_headers):
         logging.exception("Exception in send_chat_request")
         raise e
 
-    return response, apim_request_id
+    return response, apim_request_id, context
 
 
 async def complete_chat_request(request_body, request_headers):
@@ -364,18 +405,26 @@ async def complete_chat_request(request_body, request_headers):
             app_settings.promptflow.citations_field_name
         )
     else:
-        response, apim_request_id = await send_chat_request(request_body, request_headers)
+        response, apim_request_id, context = await send_chat_request(request_body, request_headers)
         history_metadata = request_body.get("history_metadata", {})
-        return format_non_streaming_response(response, history_metadata, apim_request_id)
+        return format_non_streaming_response(response, history_metadata, apim_request_id, context)
 
 
 async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
+    response, apim_request_id, context = await send_chat_request(request_body, request_headers)
     history_metadata = request_body.get("history_metadata", {})
     
     async def generate():
+        pending_context = context
         async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+            response_obj = format_stream_response(completionChunk, history_metadata, apim_request_id)
+            if pending_context is not None and response_obj:
+                # the citations of a locally grounded answer come with its first message
+                response_obj["choices"][0]["messages"].insert(
+                    0, {"role": "tool", "content": json.dumps(pending_context)}
+                )
+                pending_context = None
+            yield response_obj
 
     return generate()
 
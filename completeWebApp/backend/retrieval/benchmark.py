@@ -0,0 +1,144 @@
+"""Benchmark of the searches of local indexes of synthetic chunks: BM25 (keyword_index), exact and HNSW vector
+searches (vector_index) and their reciprocal rank fusion (hybrid).
+
+The chunks are made of words of a Zipf distributed vocabulary, partly drawn from the vocabulary of a topic,
+and their vectors are close to the center of the topic, so the keyword and vector searches find related
+chunks. Each query is a few words of a chunk and its vector with noise added. For each number of chunks,
+reports the time to build the index, its size, and for each search the throughput of batched queries
+(--batch-size per call) and the latency percentiles of single queries. Run it from the app directory, e.g.
+
+    python -m backend.retrieval.benchmark --chunks 100000,1000000 --output retrieval.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from backend.retrieval.hybrid import hybrid_search
+from backend.retrieval.vector_index import build_index_from_chunks, hnswlib
+
+VOCABULARY_SIZE = 50000
+NUM_TOPICS = 1000
+TOPIC_WORDS = 200
+GENERATION_BLOCK = 10000
+
+
+def synthetic_chunks(num_chunks: int, dimensions: int, words_per_chunk: int, seed: int = 0) -> Iterable[Dict]:
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"w{i}" for i in range(VOCABULARY_SIZE)])
+    word_probabilities = 1 / np.arange(1, VOCABULARY_SIZE + 1)
+    word_probabilities /= word_probabilities.sum()
+    topic_words = rng.integers(VOCABULARY_SIZE, size=(NUM_TOPICS, TOPIC_WORDS))
+    topic_centers = rng.normal(size=(NUM_TOPICS, dimensions)).astype(np.float32)
+    for start in range(0, num_chunks, GENERATION_BLOCK):
+        size = min(GENERATION_BLOCK, num_chunks - start)
+        topics = rng.integers(NUM_TOPICS, size=size)
+        words = rng.choice(VOCABULARY_SIZE, size=(size, words_per_chunk), p=word_probabilities)
+        # a third of the words are words of the chunk's topic
+        from_topic = rng.random((size, words_per_chunk)) < 1 / 3
+        words[from_topic] = topic_words[np.repeat(topics, words_per_chunk).reshape(size, words_per_chunk)[from_topic], rng.integers(TOPIC_WORDS, size=from_topic.sum())]
+        vectors = topic_centers[topics] + rng.normal(scale=0.8, size=(size, dimensions)).astype(np.float32)
+        for i in range(size):
+            yield {
+                "content": " ".join(vocabulary[words[i]]),
+                "id": str(start + i),
+                "filepath": f"{topics[i]}.md",
+                "contentVector": vectors[i],
+            }
+
+
+def synthetic_queries(index, num_queries: int, words_per_query: int, seed: int = 0):
+    rng = np.random.default_rng(seed + 1)
+    rows = rng.choice(len(index), size=num_queries, replace=False)
+    texts = []
+    for row in rows:
+        words = index.document(row)["content"].split()
+        texts.append(" ".join(rng.choice(words, size=min(words_per_query, len(words)), replace=False)))
+    vectors = np.asarray(index.vectors[rows]) + rng.normal(scale=0.5 / np.sqrt(index.dimensions), size=(num_queries, index.dimensions)).astype(np.float32)
+    return texts, vectors
+
+
+def directory_mb(directory: str) -> float:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / 1e6
+
+
+def measure(search, texts: List[str], vectors: np.ndarray, batch_size: int, num_latency_queries: int) -> Dict[str, float]:
+    """Queries per second of batched searches of all the queries, and latency percentiles (ms) of single query searches."""
+    start = time.perf_counter()
+    for batch_start in range(0, len(texts), batch_size):
+        search(texts[batch_start:batch_start + batch_size], vectors[batch_start:batch_start + batch_size])
+    queries_per_second = len(texts) / (time.perf_counter() - start)
+
+    latencies = []
+    for i in range(min(num_latency_queries, len(texts))):
+        start = time.perf_counter()
+        search(texts[i:i + 1], vectors[i:i + 1])
+        latencies.append((time.perf_counter() - start) * 1000)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {"queries/s": queries_per_second, "p50 ms": p50, "p95 ms": p95, "p99 ms": p99}
+
+
+def run(num_chunks: int, args, work_dir: str) -> Dict:
+    index_dir = os.path.join(work_dir, f"index_{num_chunks}")
+    start = time.perf_counter()
+    chunks = synthetic_chunks(num_chunks, args.dimensions, args.words_per_chunk, args.seed)
+    index = build_index_from_chunks(chunks, index_dir, filter_fields=["filepath"], keyword_fields=["content"], hnsw=args.hnsw)
+    build_seconds = time.perf_counter() - start
+    texts, vectors = synthetic_queries(index, args.num_queries, args.words_per_query, args.seed)
+
+    k = args.k
+    searches = {
+        "bm25": lambda texts, vectors: index.keywords.search(texts, k),
+        "vector exact": lambda texts, vectors: index.search(vectors, k),
+        "hybrid exact": lambda texts, vectors: hybrid_search(index, texts, vectors, k, candidates=args.candidates),
+    }
+    if index.graph is not None:
+        searches["vector hnsw"] = lambda texts, vectors: index.search(vectors, k, use_hnsw=True, ef_search=args.ef_search)
+        searches["hybrid hnsw"] = lambda texts, vectors: hybrid_search(index, texts, vectors, k, candidates=args.candidates, use_hnsw=True, ef_search=args.ef_search)
+    results = {name: measure(search, texts, vectors, args.batch_size, args.latency_queries) for name, search in searches.items()}
+    return {"chunks": num_chunks, "build seconds": build_seconds, "index mb": directory_mb(index_dir), "searches": results}
+
+
+def print_results(results: Dict):
+    print(f"{results['chunks']} chunks: built in {results['build seconds']:.1f}s, {results['index mb']:.0f}MB")
+    print(f"  {'search':<14} {'queries/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, metrics in results["searches"].items():
+        print(f"  {name:<14} {metrics['queries/s']:10.0f} {metrics['p50 ms']:8.2f} {metrics['p95 ms']:8.2f} {metrics['p99 ms']:8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=str, default="100000", help="Comma separated numbers of chunks to benchmark, e.g. 100000,1000000")
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--words-per-chunk", type=int, default=150)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--words-per-query", type=int, default=4)
+    parser.add_argument("--latency-queries", type=int, default=200, help="Number of queries searched one at a time for the latencies")
+    parser.add_argument("--batch-size", type=int, default=64, help="Queries per search call for the throughput")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--candidates", type=int, default=50, help="Results of each search fused by the hybrid searches")
+    parser.add_argument("--hnsw", action="store_true", help="Also build and search an HNSW graph (requires hnswlib)")
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", type=str, help="Directory to write the indexes to (kept), instead of a temporary one")
+    parser.add_argument("--output", type=str, help="Write the results to this json file")
+    args = parser.parse_args()
+    if args.hnsw and hnswlib is None:
+        parser.error("--hnsw requires hnswlib")
+
+    all_results = []
+    for num_chunks in (int(n) for n in args.chunks.split(",")):
+        if args.work_dir:
+            results = run(num_chunks, args, args.work_dir)
+        else:
+            with tempfile.TemporaryDirectory() as work_dir:
+                results = run(num_chunks, args, work_dir)
+        print_results(results)
+        all_results.append(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"arguments": vars(args), "results": all_results}, f, indent=2)
@@ -0,0 +1,82 @@
+"""Hybrid search of a local vector index built with keyword_fields: the vector and BM25 top candidates of
+each query, fused by reciprocal rank (as the hybrid queries of Azure AI Search are).
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from backend.retrieval.vector_index import HNSW_DEFAULT_EF_SEARCH, LocalVectorIndex
+
+# the constant of reciprocal rank fusion, the score of a result at rank r is 1 / (RRF_K + r)
+RRF_K = 60
+HYBRID_DEFAULT_CANDIDATES = 50
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], k: int, rrf_k: int = RRF_K) -> Tuple[np.ndarray, np.ndarray]:
+    """Fuses rankings of the same queries: each row scores the sum over the rankings of 1 / (rrf_k + its rank), from 1.
+
+    Args:
+        rankings (List[np.ndarray]): (number of queries, any number of results) rows, best first, -1 for no result.
+        k (int): Number of results to return per query.
+        rrf_k (int): The constant of the fusion, larger values lower the weight of the first ranks.
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The (number of queries, k) fused scores and rows, best first. Rows are -1 (and
+            scores 0) past the number of distinct rows of the rankings.
+    """
+    num_queries = rankings[0].shape[0]
+    rows = np.concatenate(rankings, axis=1)
+    ranks = np.concatenate([np.broadcast_to(np.arange(ranking.shape[1]), ranking.shape) for ranking in rankings], axis=1)
+    queries = np.broadcast_to(np.arange(num_queries)[:, np.newaxis], rows.shape)
+    valid = rows >= 0
+
+    fused_scores = np.zeros((num_queries, k), dtype=np.float32)
+    fused_rows = np.full((num_queries, k), -1, dtype=np.int64)
+    if not valid.any():
+        return fused_scores, fused_rows
+    # one key per (query, row): sums the contributions of a row over the rankings of a query
+    stride = int(rows.max()) + 1
+    keys, inverse = np.unique(queries[valid].astype(np.int64) * stride + rows[valid], return_inverse=True)
+    scores = np.bincount(inverse, weights=1 / (rrf_k + ranks[valid] + 1))
+    key_queries, key_rows = keys // stride, keys % stride
+    # by query, then best score first (ties by row)
+    order = np.lexsort((-scores, key_queries))
+    key_queries, key_rows, scores = key_queries[order], key_rows[order], scores[order]
+    positions = np.arange(len(keys)) - np.searchsorted(key_queries, key_queries)
+    kept = positions < k
+    fused_scores[key_queries[kept], positions[kept]] = scores[kept]
+    fused_rows[key_queries[kept], positions[kept]] = key_rows[kept]
+    return fused_scores, fused_rows
+
+
+def hybrid_search(
+        index: LocalVectorIndex,
+        texts: List[str],
+        vectors: np.ndarray,
+        k: int = 5,
+        filter: Optional[Dict[str, Any]] = None,
+        candidates: int = HYBRID_DEFAULT_CANDIDATES,
+        use_hnsw: bool = False,
+        ef_search: int = HNSW_DEFAULT_EF_SEARCH,
+        rrf_k: int = RRF_K,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """The k best chunks of each query by reciprocal rank fusion of its vector and BM25 candidates.
+
+    Args:
+        index (LocalVectorIndex): An index built with keyword_fields.
+        texts (List[str]): The query texts, searched with BM25.
+        vectors (np.ndarray): The (number of queries, dimensions) query vectors.
+        k (int): Number of chunks to return per query.
+        filter (Optional[Dict[str, Any]]): Only returns the chunks matching this filter, see LocalVectorIndex.filter_mask.
+        candidates (int): Number of results of each search that are fused.
+        use_hnsw (bool): If true, the vector candidates are searched in the HNSW graph, see LocalVectorIndex.search.
+        ef_search (int): Size of the candidate list of the graph searches.
+        rrf_k (int): The constant of the fusion, see reciprocal_rank_fusion.
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The (number of queries, k) fused scores and rows, best first, see reciprocal_rank_fusion.
+    """
+    if index.keywords is None:
+        raise ValueError(f"The index {index.index_dir} has no keyword index, build it with keyword_fields")
+    candidates = max(candidates, k)
+    _, vector_rows = index.search(vectors, candidates, filter=filter, use_hnsw=use_hnsw, ef_search=ef_search)
+    _, keyword_rows = index.keywords.search(texts, candidates, mask=index.filter_mask(filter) if filter else None)
+    return reciprocal_rank_fusion([vector_rows, keyword_rows], k, rrf_k)
@@ -0,0 +1,139 @@
+"""BM25 keyword search of the chunks of a local vector index, built with it by vector_index.build_index
+(keyword_fields) so that both return the same rows.
+
+The inverted index is a few flat arrays, memory mapped like the vectors: the rows and term frequencies of
+the chunks of each term, one term after the other (postings.rows.npy, postings.tfs.npy), the offsets of
+each term's postings (postings.offsets.npy) and the number of tokens of each chunk (lengths.npy). The
+vocabulary is in keywords.json.
+"""
+import json
+import os
+import re
+from array import array
+from collections import Counter
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+KEYWORDS_FILE = "keywords.json"
+POSTINGS_ROWS_FILE = "postings.rows.npy"
+POSTINGS_TFS_FILE = "postings.tfs.npy"
+POSTINGS_OFFSETS_FILE = "postings.offsets.npy"
+LENGTHS_FILE = "lengths.npy"
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# term frequencies are stored as uint16
+MAX_TERM_FREQUENCY = 65535
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_REGEX.findall(text.lower())
+
+
+class KeywordIndexBuilder:
+    """Collects the postings of the chunks, added in row order, and writes them as a keyword index."""
+
+    def __init__(self):
+        self.term_ids = {}
+        self._terms = array("i")
+        self._rows = array("i")
+        self._tfs = array("H")
+        self._lengths = array("i")
+
+    def add(self, text: str):
+        tokens = tokenize(text)
+        row = len(self._lengths)
+        for term, tf in Counter(tokens).items():
+            self._terms.append(self.term_ids.setdefault(term, len(self.term_ids)))
+            self._rows.append(row)
+            self._tfs.append(min(tf, MAX_TERM_FREQUENCY))
+        self._lengths.append(len(tokens))
+
+    def write(self, index_dir: str, fields: List[str]):
+        terms = np.frombuffer(self._terms, dtype=np.int32)
+        # a stable sort keeps the rows of each term in increasing order
+        order = np.argsort(terms, kind="stable")
+        np.save(os.path.join(index_dir, POSTINGS_ROWS_FILE), np.frombuffer(self._rows, dtype=np.int32)[order])
+        np.save(os.path.join(index_dir, POSTINGS_TFS_FILE), np.frombuffer(self._tfs, dtype=np.uint16)[order])
+        offsets = np.zeros(len(self.term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self.term_ids)), out=offsets[1:])
+        np.save(os.path.join(index_dir, POSTINGS_OFFSETS_FILE), offsets)
+        np.save(os.path.join(index_dir, LENGTHS_FILE), np.frombuffer(self._lengths, dtype=np.int32))
+        with open(os.path.join(index_dir, KEYWORDS_FILE), "w") as f:
+            json.dump({"fields": fields, "terms": list(self.term_ids)}, f)
+
+
+class KeywordIndex:
+    """A keyword index written by KeywordIndexBuilder, searched with BM25.
+
+    Args:
+        index_dir (str): Directory of the index.
+        k1 (float): BM25 term frequency saturation.
+        b (float): BM25 length normalization.
+    """
+
+    def __init__(self, index_dir: str, k1: float = BM25_K1, b: float = BM25_B):
+        with open(os.path.join(index_dir, KEYWORDS_FILE)) as f:
+            keywords = json.load(f)
+        self.fields = keywords["fields"]
+        self.term_ids = {term: term_id for term_id, term in enumerate(keywords["terms"])}
+        self.k1 = k1
+        self._rows = np.load(os.path.join(index_dir, POSTINGS_ROWS_FILE), mmap_mode="r")
+        self._tfs = np.load(os.path.join(index_dir, POSTINGS_TFS_FILE), mmap_mode="r")
+        self._offsets = np.load(os.path.join(index_dir, POSTINGS_OFFSETS_FILE))
+        lengths = np.load(os.path.join(index_dir, LENGTHS_FILE))
+        self.count = len(lengths)
+        # the length dependent part of the BM25 denominator of each chunk, and the idf of each term
+        average_length = max(lengths.mean(), 1) if self.count else 1
+        self._length_norms = (k1 * (1 - b + b * lengths / average_length)).astype(np.float32)
+        document_frequencies = np.diff(self._offsets)
+        self._idfs = np.log(1 + (self.count - document_frequencies + 0.5) / (document_frequencies + 0.5)).astype(np.float32)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def search(self, queries: List[str], k: int = 5, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """The k chunks with the highest BM25 score for each query.
+
+        Args:
+            queries (List[str]): The query texts.
+            k (int): Number of chunks to return per query.
+            mask (Optional[np.ndarray]): If given, only returns the rows where it is true (see LocalVectorIndex.filter_mask).
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The (number of queries, k) scores and rows, best first. Rows are -1 (and scores -inf)
+                past the number of chunks with a query term.
+        """
+        result_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        result_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        # the scores of all the chunks, reset after each query
+        scores = np.zeros(self.count, dtype=np.float32)
+        for i, query in enumerate(queries):
+            term_ids = {self.term_ids[term] for term in tokenize(query) if term in self.term_ids}
+            num_postings = 0
+            touched = []
+            for term_id in term_ids:
+                start, stop = self._offsets[term_id], self._offsets[term_id + 1]
+                rows = self._rows[start:stop]
+                tfs = self._tfs[start:stop].astype(np.float32)
+                # the rows of a term are distinct, so the fancy indexed += adds each of them
+                scores[rows] += self._idfs[term_id] * tfs * (self.k1 + 1) / (tfs + self._length_norms[rows])
+                num_postings += len(rows)
+                touched.append(rows)
+            if not touched:
+                continue
+            # every BM25 term score is positive: the scored chunks are the non zero ones, a scan is cheaper than
+            # deduplicating postings that cover a large part of the index
+            candidates = np.flatnonzero(scores) if num_postings * 8 > self.count else np.unique(np.concatenate(touched))
+            matching = candidates[mask[candidates]] if mask is not None else candidates
+            found = min(k, len(matching))
+            if found:
+                candidate_scores = scores[matching]
+                top = np.argpartition(-candidate_scores, found - 1)[:found]
+                top = top[np.argsort(-candidate_scores[top], kind="stable")]
+                result_scores[i, :found] = candidate_scores[top]
+                result_rows[i, :found] = matching[top]
+            scores[candidates] = 0
+        return result_scores, result_rows
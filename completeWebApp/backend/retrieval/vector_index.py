@@ -0,0 +1,414 @@
+"""A local vector index of the chunks written by the data preparation scripts (the NDJSON files of
+scripts/chunk_documents.py and scripts/embed_documents.py, one chunk with its contentVector per line).
+
+The vectors are stored normalized in a float32 file that is memory mapped, so an index opens without
+reading it and a search only pages in the rows it scores. Searches are exact (the dot products of a
+batch of queries with every vector, a block of rows at a time) or, when the index was built with a graph
+and hnswlib is installed, approximate over an HNSW graph. Both can be restricted to the chunks whose
+filter fields (chosen when building the index) have given values. An index built with keyword fields can
+also be searched with BM25 (keyword_index) and by fusion of both searches (hybrid).
+
+The app searches an index with DATASOURCE_TYPE=LocalVectorIndex. From this directory, an index is built
+and its HNSW recall (and the recall of a remote index, from the ids it returned for the same queries)
+measured with:
+
+    python -m backend.retrieval.vector_index build --chunks embedded.ndjson --index-dir chunks_index --filter-fields filepath --keyword-fields title,content --hnsw
+    python -m backend.retrieval.vector_index evaluate --index-dir chunks_index --queries queries.ndjson --k 10
+"""
+import argparse
+import json
+import mmap
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from backend.retrieval.keyword_index import KEYWORDS_FILE, KeywordIndex, KeywordIndexBuilder
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+MANIFEST_FILE = "index.json"
+VECTORS_FILE = "vectors.f32"
+DOCUMENTS_FILE = "documents.ndjson"
+OFFSETS_FILE = "documents.offsets.npy"
+FILTERS_FILE = "filters.npz"
+HNSW_FILE = "hnsw.bin"
+
+# rows scored at once by an exact search, and queries per batch: 256 x 32768 float32 scores is 32MB
+BLOCK_ROWS = 32768
+QUERY_BATCH_SIZE = 256
+# filters matching at most this many chunks are searched exactly, the graph would visit most of them anyway
+HNSW_FILTER_EXACT_THRESHOLD = 20000
+HNSW_DEFAULT_EF_SEARCH = 64
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def field_values(document: Dict[str, Any], field: str) -> List[Any]:
+    """The values of a field of the document, following dots into nested dicts (e.g. "metadata.category"). A string holding
+    a json object is followed into too, as the data preparation scripts write metadata as a json string.
+    A list field has one value per item, a missing or null field has none."""
+    value = document
+    for key in field.split("."):
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return []
+        if not isinstance(value, dict):
+            return []
+        value = value.get(key)
+    if value is None:
+        return []
+    return list(value) if isinstance(value, list) else [value]
+
+
+def read_chunks(paths: Iterable[str]) -> Iterable[Dict[str, Any]]:
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def build_index(
+        chunks_paths: List[str],
+        index_dir: str,
+        vector_field: str = "contentVector",
+        filter_fields: Optional[List[str]] = None,
+        keyword_fields: Optional[List[str]] = None,
+        hnsw: bool = False,
+        hnsw_m: int = 16,
+        hnsw_ef_construction: int = 200,
+    ) -> "LocalVectorIndex":
+    """Builds a local vector index of the chunks of NDJSON files, see build_index_from_chunks.
+
+    Args:
+        chunks_paths (List[str]): NDJSON files of chunks, e.g. the output of embed_documents.py.
+    Returns:
+        LocalVectorIndex: The index, opened.
+    """
+    return build_index_from_chunks(read_chunks(chunks_paths), index_dir, vector_field, filter_fields, keyword_fields, hnsw, hnsw_m, hnsw_ef_construction)
+
+
+def build_index_from_chunks(
+        chunks: Iterable[Dict[str, Any]],
+        index_dir: str,
+        vector_field: str = "contentVector",
+        filter_fields: Optional[List[str]] = None,
+        keyword_fields: Optional[List[str]] = None,
+        hnsw: bool = False,
+        hnsw_m: int = 16,
+        hnsw_ef_construction: int = 200,
+    ) -> "LocalVectorIndex":
+    """Builds a local vector index of chunks, streaming them so that only the filter values and keyword postings are kept in memory.
+
+    Args:
+        chunks (Iterable[Dict[str, Any]]): The chunks, as written by the data preparation scripts. Their vector is removed.
+        index_dir (str): Directory to write the index to. Files of a previous index there are overwritten.
+        vector_field (str): Field of the chunks with their embedding. Chunks without it are left out.
+        filter_fields (Optional[List[str]]): Fields the searches can filter on, see field_values.
+        keyword_fields (Optional[List[str]]): If given, also builds a BM25 keyword index of the text of these fields.
+        hnsw (bool): If true, also builds an HNSW graph of the vectors (requires hnswlib).
+        hnsw_m (int): Number of neighbors of each node of the graph.
+        hnsw_ef_construction (int): Size of the candidate list while building the graph.
+    Returns:
+        LocalVectorIndex: The index, opened.
+    """
+    if hnsw and hnswlib is None:
+        raise Exception("Building an HNSW graph requires hnswlib, install it with `pip install hnswlib`")
+    filter_fields = filter_fields or []
+    os.makedirs(index_dir, exist_ok=True)
+
+    dimensions = None
+    count = 0
+    skipped = 0
+    offsets = [0]
+    # for each filter field: its distinct values, and the (row, value code) pairs
+    value_codes = [{} for _ in filter_fields]
+    filter_rows = [[] for _ in filter_fields]
+    filter_codes = [[] for _ in filter_fields]
+    keywords = KeywordIndexBuilder() if keyword_fields else None
+    with open(os.path.join(index_dir, VECTORS_FILE), "wb") as vectors_file, open(os.path.join(index_dir, DOCUMENTS_FILE), "wb") as documents_file:
+        for chunk in chunks:
+            vector = chunk.pop(vector_field, None)
+            if vector is None or len(vector) == 0:
+                skipped += 1
+                continue
+            vector = np.asarray(vector, dtype=np.float32)
+            if dimensions is None:
+                dimensions = len(vector)
+            elif len(vector) != dimensions:
+                raise ValueError(f"All vectors must have the same dimensions, got {len(vector)} and {dimensions}")
+            normalize(vector).tofile(vectors_file)
+
+            line = (json.dumps(chunk) + "\n").encode("utf-8")
+            documents_file.write(line)
+            offsets.append(offsets[-1] + len(line))
+
+            for i, field in enumerate(filter_fields):
+                for value in field_values(chunk, field):
+                    filter_rows[i].append(count)
+                    filter_codes[i].append(value_codes[i].setdefault(value, len(value_codes[i])))
+            if keywords is not None:
+                keywords.add(" ".join(str(value) for field in keyword_fields for value in field_values(chunk, field)))
+            count += 1
+
+    if count == 0:
+        raise ValueError(f"No chunks with a {vector_field}")
+    np.save(os.path.join(index_dir, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    filter_arrays = {}
+    for i in range(len(filter_fields)):
+        filter_arrays[f"rows_{i}"] = np.array(filter_rows[i], dtype=np.int64)
+        filter_arrays[f"codes_{i}"] = np.array(filter_codes[i], dtype=np.int32)
+    np.savez(os.path.join(index_dir, FILTERS_FILE), **filter_arrays)
+    if keywords is not None:
+        keywords.write(index_dir, keyword_fields)
+    elif os.path.exists(os.path.join(index_dir, KEYWORDS_FILE)):
+        os.remove(os.path.join(index_dir, KEYWORDS_FILE))
+
+    if hnsw:
+        vectors = np.memmap(os.path.join(index_dir, VECTORS_FILE), dtype=np.float32, mode="r", shape=(count, dimensions))
+        graph = hnswlib.Index(space="ip", dim=dimensions)
+        graph.init_index(max_elements=count, ef_construction=hnsw_ef_construction, M=hnsw_m)
+        for start in range(0, count, BLOCK_ROWS):
+            stop = min(count, start + BLOCK_ROWS)
+            graph.add_items(np.asarray(vectors[start:stop]), np.arange(start, stop))
+        graph.save_index(os.path.join(index_dir, HNSW_FILE))
+        del vectors
+    elif os.path.exists(os.path.join(index_dir, HNSW_FILE)):
+        os.remove(os.path.join(index_dir, HNSW_FILE))
+
+    manifest = {
+        "count": count,
+        "dimensions": dimensions,
+        "vector_field": vector_field,
+        "filter_fields": {field: list(codes) for field, codes in zip(filter_fields, value_codes)},
+        "hnsw": hnsw,
+    }
+    with open(os.path.join(index_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+    print(f"Indexed {count} chunks of {dimensions} dimensions in {index_dir}, skipped {skipped} chunks without a {vector_field}")
+    return LocalVectorIndex(index_dir)
+
+
+class LocalVectorIndex:
+    """A vector index written by build_index, opened without reading its vectors or documents into memory.
+
+    Args:
+        index_dir (str): Directory of the index.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.count = manifest["count"]
+        self.dimensions = manifest["dimensions"]
+        self.vector_field = manifest["vector_field"]
+        self.vectors = np.memmap(os.path.join(index_dir, VECTORS_FILE), dtype=np.float32, mode="r", shape=(self.count, self.dimensions))
+        self._offsets = np.load(os.path.join(index_dir, OFFSETS_FILE), mmap_mode="r")
+        with open(os.path.join(index_dir, DOCUMENTS_FILE), "rb") as f:
+            self._documents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        filter_arrays = np.load(os.path.join(index_dir, FILTERS_FILE))
+        # field -> (value -> code, rows, codes)
+        self._filters = {
+            field: ({value: code for code, value in enumerate(values)}, filter_arrays[f"rows_{i}"], filter_arrays[f"codes_{i}"])
+            for i, (field, values) in enumerate(manifest["filter_fields"].items())
+        }
+        self.keywords = KeywordIndex(index_dir) if os.path.exists(os.path.join(index_dir, KEYWORDS_FILE)) else None
+        self.graph = None
+        if manifest["hnsw"] and hnswlib is not None:
+            self.graph = hnswlib.Index(space="ip", dim=self.dimensions)
+            self.graph.load_index(os.path.join(index_dir, HNSW_FILE), max_elements=self.count)
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def filter_fields(self) -> List[str]:
+        return list(self._filters)
+
+    def document(self, row: int) -> Dict[str, Any]:
+        """The chunk of a row, without its vector."""
+        return json.loads(self._documents[self._offsets[row]:self._offsets[row + 1]])
+
+    def filter_mask(self, filter: Dict[str, Any]) -> np.ndarray:
+        """The rows matching a filter: for each field, the chunk must have the value or, when it is a list, one of the values.
+
+        Args:
+            filter (Dict[str, Any]): Values by filter field, e.g. {"filepath": ["a.pdf", "b.pdf"], "metadata.category": "report"}.
+        Returns:
+            np.ndarray: A boolean mask of the rows.
+        """
+        mask = np.ones(self.count, dtype=bool)
+        for field, wanted in filter.items():
+            if field not in self._filters:
+                raise ValueError(f"{field} is not a filter field of the index, they are {self.filter_fields}")
+            codes_by_value, rows, codes = self._filters[field]
+            wanted_codes = [codes_by_value[value] for value in (wanted if isinstance(wanted, list) else [wanted]) if value in codes_by_value]
+            field_mask = np.zeros(self.count, dtype=bool)
+            field_mask[rows[np.isin(codes, wanted_codes)]] = True
+            mask &= field_mask
+        return mask
+
+    def search(
+            self,
+            queries: np.ndarray,
+            k: int = 5,
+            filter: Optional[Dict[str, Any]] = None,
+            use_hnsw: bool = False,
+            ef_search: int = HNSW_DEFAULT_EF_SEARCH,
+        ) -> Tuple[np.ndarray, np.ndarray]:
+        """The k chunks with the highest cosine similarity to each query.
+
+        Args:
+            queries (np.ndarray): A query vector, or a (number of queries, dimensions) batch of them.
+            k (int): Number of chunks to return per query.
+            filter (Optional[Dict[str, Any]]): Only returns the chunks matching this filter, see filter_mask.
+            use_hnsw (bool): If true and the index has an HNSW graph, searches the graph instead of all the vectors.
+            ef_search (int): Size of the candidate list of graph searches, larger is slower with a better recall.
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The (number of queries, k) scores and rows, best first. Rows are -1 (and scores -inf)
+                past the number of chunks matching the filter.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[np.newaxis]
+        if queries.shape[1] != self.dimensions:
+            raise ValueError(f"The queries have {queries.shape[1]} dimensions, the index has {self.dimensions}")
+        queries = normalize(queries)
+        candidates = np.flatnonzero(self.filter_mask(filter)) if filter else None
+
+        if use_hnsw and self.graph is not None and (candidates is None or len(candidates) > HNSW_FILTER_EXACT_THRESHOLD):
+            return self._graph_search(queries, k, candidates, ef_search)
+        return self._exact_search(queries, k, candidates)
+
+    def _exact_search(self, queries: np.ndarray, k: int, candidates: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        num_rows = self.count if candidates is None else len(candidates)
+        all_scores, all_rows = [], []
+        for query_start in range(0, len(queries), QUERY_BATCH_SIZE):
+            batch = queries[query_start:query_start + QUERY_BATCH_SIZE]
+            best_scores = np.full((len(batch), k), -np.inf, dtype=np.float32)
+            best_rows = np.full((len(batch), k), -1, dtype=np.int64)
+            for start in range(0, num_rows, BLOCK_ROWS):
+                if candidates is None:
+                    block_rows = np.arange(start, min(num_rows, start + BLOCK_ROWS))
+                    block = self.vectors[start:start + BLOCK_ROWS]
+                else:
+                    block_rows = candidates[start:start + BLOCK_ROWS]
+                    block = self.vectors[block_rows]
+                scores = np.concatenate([best_scores, batch @ block.T], axis=1)
+                rows = np.concatenate([best_rows, np.broadcast_to(block_rows, (len(batch), len(block_rows)))], axis=1)
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(scores, top, axis=1)
+                best_rows = np.take_along_axis(rows, top, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind="stable")
+            all_scores.append(np.take_along_axis(best_scores, order, axis=1))
+            all_rows.append(np.take_along_axis(best_rows, order, axis=1))
+        return np.concatenate(all_scores), np.concatenate(all_rows)
+
+    def _graph_search(self, queries: np.ndarray, k: int, candidates: Optional[np.ndarray], ef_search: int) -> Tuple[np.ndarray, np.ndarray]:
+        num_rows = self.count if candidates is None else len(candidates)
+        found = min(k, num_rows)
+        self.graph.set_ef(max(ef_search, found))
+        if candidates is None:
+            rows, distances = self.graph.knn_query(queries, k=found)
+        else:
+            mask = np.zeros(self.count, dtype=bool)
+            mask[candidates] = True
+            # the filter is called back from the graph search, which then can't run on several threads
+            rows, distances = self.graph.knn_query(queries, k=found, num_threads=1, filter=lambda row: bool(mask[row]))
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        result_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        # the "ip" distance is 1 - the dot product
+        scores[:, :found] = 1 - distances
+        result_rows[:, :found] = rows
+        return scores, result_rows
+
+    def close(self):
+        self._documents.close()
+
+
+def recall(found: np.ndarray, exact: np.ndarray) -> float:
+    """The share of the exact results found, averaged over the queries (rows of both arrays, -1 is no result)."""
+    recalls = []
+    for found_rows, exact_rows in zip(found, exact):
+        exact_set = set(exact_rows[exact_rows >= 0].tolist())
+        if exact_set:
+            recalls.append(len(exact_set & set(found_rows.tolist())) / len(exact_set))
+    return float(np.mean(recalls)) if recalls else 0.0
+
+
+def evaluate(index: LocalVectorIndex, queries_path: str, k: int, ef_search: int, id_field: str, results_field: str):
+    """Prints the latency of exact searches of the queries and the recall@k of the HNSW graph and of the results of a remote index.
+
+    Args:
+        index (LocalVectorIndex): The index.
+        queries_path (str): NDJSON file of the queries, with the query vector in the index' vector field and, optionally, the ids of
+            the chunks a remote index returned for the query in results_field.
+        k (int): Number of results per query.
+        ef_search (int): Size of the candidate list of the graph searches.
+        id_field (str): Field of the chunks with the ids the remote index returned.
+        results_field (str): Field of the queries with the ids the remote index returned.
+    """
+    queries = list(read_chunks([queries_path]))
+    query_vectors = np.array([query[index.vector_field] for query in queries], dtype=np.float32)
+
+    start = time.perf_counter()
+    _, exact = index.search(query_vectors, k)
+    elapsed = time.perf_counter() - start
+    print(f"{len(queries)} queries, {len(index)} chunks: exact search {elapsed * 1000 / len(queries):.2f}ms per query ({len(queries) / elapsed:.0f} queries/s)")
+
+    if index.graph is not None:
+        start = time.perf_counter()
+        _, found = index.search(query_vectors, k, use_hnsw=True, ef_search=ef_search)
+        elapsed = time.perf_counter() - start
+        print(f"  hnsw (ef {ef_search}): recall@{k} {recall(found, exact):.3f}, {elapsed * 1000 / len(queries):.2f}ms per query ({len(queries) / elapsed:.0f} queries/s)")
+
+    if any(results_field in query for query in queries):
+        rows_by_id = {}
+        for row in range(len(index)):
+            for id in field_values(index.document(row), id_field):
+                rows_by_id[id] = row
+        remote = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            rows = [rows_by_id.get(id, -1) for id in query.get(results_field, [])[:k]]
+            remote[i, :len(rows)] = rows
+        print(f"  remote index ({results_field}): recall@{k} {recall(remote, exact):.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Build an index of NDJSON chunks")
+    build_parser.add_argument("--chunks", type=str, nargs="+", required=True, help="NDJSON files of chunks with their embedding")
+    build_parser.add_argument("--index-dir", type=str, required=True)
+    build_parser.add_argument("--vector-field", type=str, default="contentVector")
+    build_parser.add_argument("--filter-fields", type=str, default="", help="Comma separated fields to filter on, e.g. filepath,metadata.category")
+    build_parser.add_argument("--keyword-fields", type=str, default="", help="Comma separated fields to build a BM25 keyword index of, e.g. title,content")
+    build_parser.add_argument("--hnsw", action="store_true", help="Also build an HNSW graph (requires hnswlib)")
+    build_parser.add_argument("--hnsw-m", type=int, default=16)
+    build_parser.add_argument("--hnsw-ef-construction", type=int, default=200)
+    evaluate_parser = subparsers.add_parser("evaluate", help="Measure the search latency and the recall of the HNSW graph and of a remote index")
+    evaluate_parser.add_argument("--index-dir", type=str, required=True)
+    evaluate_parser.add_argument("--queries", type=str, required=True, help="NDJSON file of query vectors, see evaluate")
+    evaluate_parser.add_argument("--k", type=int, default=10)
+    evaluate_parser.add_argument("--ef-search", type=int, default=HNSW_DEFAULT_EF_SEARCH)
+    evaluate_parser.add_argument("--id-field", type=str, default="id", help="Field of the chunks with the ids returned by the remote index")
+    evaluate_parser.add_argument("--results-field", type=str, default="results", help="Field of the queries with the ids returned by the remote index")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        filter_fields = [field for field in args.filter_fields.split(",") if field]
+        keyword_fields = [field for field in args.keyword_fields.split(",") if field]
+        build_index(args.chunks, args.index_dir, args.vector_field, filter_fields, keyword_fields, args.hnsw, args.hnsw_m, args.hnsw_ef_construction)
+    else:
+        evaluate(LocalVectorIndex(args.index_dir), args.queries, args.k, args.ef_search, args.id_field, args.results_field)
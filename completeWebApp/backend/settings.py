@@ -16,10 +16,10 @@ from pydantic import (
 )
 from pydantic.alias_generators import to_snake
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import List, Literal, Optional
+from typing import Any, ClassVar, Dict, List, Literal, Optional
 from typing_extensions import Self
 from quart import Request
-from backend.utils import parse_multi_columns, generateFilterString
+from backend.utils import parse_multi_columns, generateFilterString, fetchUserGroups
 
 DOTENV_PATH = os.environ.get(
     "DOTENV_PATH",
@@ -224,6 +224,8 @@ class _SearchCommonSettings(BaseSettings):
 
 class DatasourcePayloadConstructor(BaseModel, ABC):
     _settings: '_AppSettings' = PrivateAttr()
+    # datasources the app searches itself, instead of passing them to Azure OpenAI as data_sources
+    retrieves_locally: ClassVar[bool] = False
     
     def __init__(self, settings: '_AppSettings', **data):
         super().__init__(**data)
@@ -743,6 +745,153 @@ class _MongoDbSettings(BaseSettings, DatasourcePayloadConstructor):
             "type": self._type,
             "parameters": parameters
         }
+
+
+class _LocalVectorIndexSettings(BaseSettings, DatasourcePayloadConstructor):
+    model_config = SettingsConfigDict(
+        env_prefix="LOCAL_VECTOR_INDEX_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+    _type: Literal["local_vector_index"] = PrivateAttr(default="local_vector_index")
+    _index: Any = PrivateAttr(default=None)
+    retrieves_locally: ClassVar[bool] = True
+    
+    path: str
+    query_type: Literal['vector', 'simple', 'vector_simple_hybrid'] = "vector"
+    top_k: int = Field(default=5, serialization_alias="top_n_documents")
+    enable_in_domain: bool = Field(default=True, serialization_alias="in_scope")
+    min_score: Optional[float] = None
+    use_hnsw: bool = False
+    ef_search: int = 64
+    hybrid_candidates: int = 50
+    filter: Optional[Dict[str, Any]] = None
+    content_columns: Optional[List[str]] = Field(default=None, exclude=True)
+    title_column: Optional[str] = Field(default=None, exclude=True)
+    url_column: Optional[str] = Field(default=None, exclude=True)
+    filename_column: Optional[str] = Field(default=None, exclude=True)
+    permitted_groups_column: Optional[str] = Field(default=None, exclude=True)
+    
+    # Constructed fields
+    fields_mapping: Optional[dict] = None
+    
+    @field_validator('content_columns', mode="before")
+    @classmethod
+    def split_columns(cls, comma_separated_string: str) -> List[str]:
+        if isinstance(comma_separated_string, str) and len(comma_separated_string) > 0:
+            return parse_multi_columns(comma_separated_string)
+        
+        return None
+    
+    @model_validator(mode="after")
+    def set_fields_mapping(self) -> Self:
+        self.fields_mapping = {
+            "content_fields": self.content_columns or ["content"],
+            "title_field": self.title_column or "title",
+            "url_field": self.url_column or "url",
+            "filepath_field": self.filename_column or "filepath"
+        }
+        return self
+    
+    def get_index(self):
+        # numpy is only needed by the app when it searches a local index
+        from backend.retrieval.vector_index import LocalVectorIndex
+        
+        if self._index is None:
+            self._index = LocalVectorIndex(self.path)
+            logging.debug(f"Opened the local vector index {self.path} of {len(self._index)} chunks")
+        
+        return self._index
+    
+    def _get_filter(self, request: Request) -> Optional[dict]:
+        filter = dict(self.filter or {})
+        if self.permitted_groups_column:
+            user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "") if request else ""
+            logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
+            if not user_token:
+                raise ValueError(
+                    "Document-level access control is enabled, but user access token could not be fetched."
+                )
+            
+            filter[self.permitted_groups_column] = [group["id"] for group in fetchUserGroups(user_token)]
+            
+        return filter or None
+    
+    def retrieve(
+        self,
+        query: str,
+        query_vector: Optional[List[float]] = None,
+        filter: Optional[dict] = None
+    ) -> List[dict]:
+        """The top_k chunks of the index best matching the query, by query_type: closest to the query
+        vector, BM25 on the query text or both fused, as citations (the documents Azure OpenAI returns
+        in the context of an answer grounded on a datasource)."""
+        from backend.retrieval.hybrid import hybrid_search
+        
+        index = self.get_index()
+        if self.query_type != "vector" and index.keywords is None:
+            raise ValueError(
+                f"The {self.query_type} query type requires a local vector index built with keyword fields"
+            )
+        
+        if self.query_type == "simple":
+            mask = index.filter_mask(filter) if filter else None
+            scores, rows = index.keywords.search([query], k=self.top_k, mask=mask)
+        elif self.query_type == "vector_simple_hybrid":
+            scores, rows = hybrid_search(
+                index,
+                [query],
+                [query_vector],
+                k=self.top_k,
+                filter=filter,
+                candidates=self.hybrid_candidates,
+                use_hnsw=self.use_hnsw,
+                ef_search=self.ef_search
+            )
+        else:
+            scores, rows = index.search(
+                query_vector,
+                k=self.top_k,
+                filter=filter,
+                use_hnsw=self.use_hnsw,
+                ef_search=self.ef_search
+            )
+        
+        citations = []
+        for score, row in zip(scores[0], rows[0]):
+            if row < 0:
+                continue
+            # min_score is a cosine similarity, BM25 and fused scores aren't comparable to it
+            if self.query_type == "vector" and self.min_score is not None and score < self.min_score:
+                continue
+            
+            document = index.document(row)
+            citations.append({
+                "content": "\n".join(str(document[field]) for field in self.fields_mapping["content_fields"] if document.get(field)),
+                "title": document.get(self.fields_mapping["title_field"]),
+                "url": document.get(self.fields_mapping["url_field"]),
+                "filepath": document.get(self.fields_mapping["filepath_field"]),
+                "chunk_id": str(row),
+                "score": float(score)
+            })
+        
+        return citations
+    
+    def construct_payload_configuration(
+        self,
+        *args,
+        **kwargs
+    ):
+        request = kwargs.pop('request', None)
+        parameters = self.model_dump(exclude_none=True, by_alias=True)
+        parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
+        parameters["filter"] = self._get_filter(request)
+        
+        return {
+            "type": self._type,
+            "parameters": parameters
+        }
         
         
 class _BaseSettings(BaseSettings):
@@ -819,6 +968,10 @@ class _AppSettings(BaseModel):
             elif self.base_settings.datasource_type == "MongoDB":
                 self.datasource = _MongoDbSettings(settings=self, _env_file=DOTENV_PATH)
                 logging.debug("Using Mongo DB")
+            
+            elif self.base_settings.datasource_type == "LocalVectorIndex":
+                self.datasource = _LocalVectorIndexSettings(settings=self, _env_file=DOTENV_PATH)
+                logging.debug("Using a local vector index")
                 
             else:
                 self.datasource = None
@@ -75,7 +75,7 @@ def generateFilterString(userToken):
     return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
 
 
-def format_non_streaming_response(chatCompletion, history_metadata, apim_request_id):
+def format_non_streaming_response(chatCompletion, history_metadata, apim_request_id, context=None):
     response_obj = {
         "id": chatCompletion.id,
         "model": chatCompletion.model,
@@ -89,11 +89,13 @@ def format_non_streaming_response(chatCompletion, history_metadata, apim_request
     if len(chatCompletion.choices) > 0:
         message = chatCompletion.choices[0].message
         if message:
-            if hasattr(message, "context"):
+            if context is None and hasattr(message, "context"):
+                context = message.context
+            if context is not None:
                 response_obj["choices"][0]["messages"].append(
                     {
                         "role": "tool",
-                        "content": json.dumps(message.context),
+                        "content": json.dumps(context),
                     }
                 )
             response_obj["choices"][0]["messages"].append(
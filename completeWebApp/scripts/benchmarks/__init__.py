@@ -0,0 +1,4 @@
+"""Benchmarks for the data preparation scripts.
+
+Run them from the scripts directory so data_utils can be imported, e.g. `python -m benchmarks.chunking`.
+"""
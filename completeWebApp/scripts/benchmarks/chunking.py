@@ -0,0 +1,58 @@
+"""Micro-benchmark of the chunkers (chunk_content) over synthetic cracked-pdf and html documents.
+
+Reports CPU time and how much work the tokenizer did, relative to the size of the corpus. Run it on two commits to compare:
+
+    python -m benchmarks.chunking --docs 20 --pages 50
+"""
+import argparse
+import time
+
+import data_utils
+from benchmarks.corpus import html_corpus, pdf_html_corpus
+
+
+class CountingEncoding:
+    """Wraps the tiktoken encoding used by data_utils to count the calls and the characters encoded."""
+
+    def __init__(self, encoding):
+        self._encoding = encoding
+        self.calls = 0
+        self.chars = 0
+
+    def encode(self, text, *args, **kwargs):
+        self.calls += 1
+        self.chars += len(text)
+        return self._encoding.encode(text, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._encoding, name)
+
+
+def run(name, corpus, num_tokens, **chunk_kwargs):
+    counting_encoding = CountingEncoding(data_utils.TokenEstimator.GPT2_TOKENIZER)
+    data_utils.TokenEstimator.GPT2_TOKENIZER = counting_encoding
+    try:
+        corpus_chars = sum(len(content) for _, content in corpus)
+        num_chunks = 0
+        start = time.process_time()
+        for file_name, content in corpus:
+            result = data_utils.chunk_content(content, file_name=file_name, num_tokens=num_tokens, ignore_errors=False, **chunk_kwargs)
+            num_chunks += len(result.chunks)
+        elapsed = time.process_time() - start
+    finally:
+        data_utils.TokenEstimator.GPT2_TOKENIZER = counting_encoding._encoding
+
+    print(f"{name}: {len(corpus)} docs, {corpus_chars / 1e6:.1f}M chars -> {num_chunks} chunks in {elapsed:.2f}s CPU "
+          f"({corpus_chars / 1e6 / elapsed:.2f}M chars/s), tokenizer: {counting_encoding.calls} calls, "
+          f"{counting_encoding.chars / corpus_chars:.2f} chars encoded per corpus char")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=10, help="Number of documents of each kind")
+    parser.add_argument("--pages", type=int, default=50, help="Pages per cracked pdf")
+    parser.add_argument("--num-tokens", type=int, default=1024, help="Chunk size in tokens")
+    args = parser.parse_args()
+
+    run("pdf (layout)", pdf_html_corpus(args.docs, pages_per_doc=args.pages), args.num_tokens, cracked_pdf=True, use_layout=True)
+    run("html", html_corpus(args.docs, sections_per_doc=args.pages), args.num_tokens)
@@ -0,0 +1,293 @@
+"""Synthetic documents for the benchmarks. Generation is seeded, so a given size always produces the same corpus."""
+import copy
+import json
+import os
+import random
+from typing import Dict, List, Tuple
+
+import fitz
+
+WORDS = (
+    "the service index document chunk vector search azure model token table page figure report "
+    "employee policy benefit plan claim coverage annual revenue quarter growth customer contract "
+    "section appendix summary overview data storage network security compliance review process"
+).split()
+
+# title of the pdf annotations holding the analyze result of their page, see write_pdf
+ANALYZE_ANNOTATION_TITLE = "analyze-result"
+
+
+def sentence(rng: random.Random, min_words: int = 6, max_words: int = 24) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + rng.choice([".", ".", ".", "!", "?"])
+
+
+def paragraph(rng: random.Random, num_sentences: int = 5, link_probability: float = 0.1) -> str:
+    sentences = []
+    for _ in range(num_sentences):
+        text = sentence(rng)
+        if rng.random() < link_probability:
+            text += f" See https://contoso.example.com/docs/{rng.choice(WORDS)}/{rng.randint(1, 10_000)} for details."
+        sentences.append(text)
+    return " ".join(sentences)
+
+
+def html_table(rng: random.Random, num_rows: int, num_cols: int = 4) -> str:
+    header = "".join(f"<th>{rng.choice(WORDS).title()}</th>" for _ in range(num_cols))
+    rows = [f"<tr>{header}</tr>"]
+    for _ in range(num_rows):
+        cells = "".join(f"<td>{rng.choice(WORDS)} {rng.randint(0, 99_999)}</td>" for _ in range(num_cols))
+        rows.append(f"<tr>{cells}</tr>")
+    return "<table>" + "".join(rows) + "</table>"
+
+
+def pdf_layout_html(num_pages: int, seed: int = 0, link_probability: float = 0.1) -> str:
+    """Text in the format extract_pdf_content produces with the layout model: headers as <h1>/<h2>, tables as html, figures as <img> tags."""
+    rng = random.Random(seed)
+    pages = []
+    for page_num in range(num_pages):
+        parts = []
+        if page_num % 10 == 0:
+            parts.append(f"<h1>{sentence(rng, 3, 6)}</h1>")
+        parts.append(f"<h2>{sentence(rng, 2, 5)}</h2>")
+        for _ in range(rng.randint(2, 5)):
+            parts.append(paragraph(rng, rng.randint(3, 8), link_probability))
+        if rng.random() < 0.3:
+            parts.append(html_table(rng, rng.randint(5, 80)))
+            parts.append(paragraph(rng, 2, link_probability))
+        if rng.random() < 0.2:
+            parts.append(f'<img src="IMG_{rng.randint(1000, 9999)}.jpg">{sentence(rng)}</img>')
+        pages.append("\n".join(parts) + " ")
+    return "".join(pages)
+
+
+def html_page(num_sections: int, seed: int = 0, link_probability: float = 0.1) -> str:
+    rng = random.Random(seed)
+    body = []
+    for _ in range(num_sections):
+        body.append(f"<h2>{sentence(rng, 2, 5)}</h2>")
+        for _ in range(rng.randint(1, 4)):
+            body.append(f"<p>{paragraph(rng, rng.randint(2, 6), link_probability)}</p>")
+    title = sentence(rng, 3, 6)
+    return f"<html><head><title>{title}</title></head><body><h1>{title}</h1>{''.join(body)}</body></html>"
+
+
+def markdown_page(num_sections: int, seed: int = 0, link_probability: float = 0.1, code_probability: float = 0.0) -> str:
+    rng = random.Random(seed)
+    lines = [f"# {sentence(rng, 3, 6)}", ""]
+    for _ in range(num_sections):
+        lines += [f"## {sentence(rng, 2, 5)}", ""]
+        for _ in range(rng.randint(1, 4)):
+            lines += [paragraph(rng, rng.randint(2, 6), link_probability), ""]
+        if rng.random() < 0.3:
+            lines += [f"- {sentence(rng, 3, 8)}" for _ in range(rng.randint(2, 5))] + [""]
+        if rng.random() < 0.2:
+            lines += ["| Name | Value |", "|---|---|"] + [f"| {rng.choice(WORDS)} | {rng.randint(0, 99_999)} |" for _ in range(rng.randint(2, 6))] + [""]
+        if rng.random() < code_probability:
+            lines += ["```", f"{rng.choice(WORDS)} = {rng.randint(0, 99)}", "```", ""]
+    return "\n".join(lines)
+
+
+def pdf_html_corpus(num_docs: int, pages_per_doc: int = 30, seed: int = 0) -> List[Tuple[str, str]]:
+    """(file name, content) pairs of cracked pdfs, to chunk with chunk_content(..., cracked_pdf=True, use_layout=True)."""
+    return [(f"doc_{i}.pdf", pdf_layout_html(pages_per_doc, seed=seed + i)) for i in range(num_docs)]
+
+
+def html_corpus(num_docs: int, sections_per_doc: int = 40, seed: int = 0) -> List[Tuple[str, str]]:
+    return [(f"page_{i}.html", html_page(sections_per_doc, seed=seed + i)) for i in range(num_docs)]
+
+
+def markdown_corpus(num_docs: int, sections_per_doc: int = 40, seed: int = 0, code_probability: float = 0.0) -> List[Tuple[str, str]]:
+    return [(f"page_{i}.md", markdown_page(sections_per_doc, seed=seed + i, code_probability=code_probability)) for i in range(num_docs)]
+
+
+def text_document(num_sections: int, seed: int = 0) -> str:
+    """Plain text notes: a title line, then paragraphs separated by blank lines."""
+    rng = random.Random(seed)
+    lines = [sentence(rng, 3, 6), ""]
+    for _ in range(num_sections):
+        lines += [sentence(rng, 2, 5).upper(), ""]
+        for _ in range(rng.randint(1, 4)):
+            lines += [paragraph(rng, rng.randint(2, 6)), ""]
+    return "\n".join(lines)
+
+
+def python_module(num_functions: int, seed: int = 0) -> str:
+    """A python module of documented classes and functions."""
+    rng = random.Random(seed)
+    lines = [f'"""{sentence(rng, 4, 10)}"""', "import os", ""]
+    for i in range(num_functions):
+        name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{i}"
+        indent = ""
+        if rng.random() < 0.3:
+            lines += ["", f"class {name.title().replace('_', '')}:", f'    """{sentence(rng)}"""', ""]
+            indent = "    "
+            name = f"get_{name}"
+        args = ", ".join(["self"] * bool(indent) + [rng.choice(WORDS) + f"_{j}" for j in range(rng.randint(0, 3))])
+        lines += [f"{indent}def {name}({args}):", f'{indent}    """{sentence(rng)}', "", f"{indent}    {sentence(rng)}", f'{indent}    """']
+        for _ in range(rng.randint(2, 8)):
+            lines.append(f"{indent}    {rng.choice(WORDS)} = os.getenv(\"{rng.choice(WORDS).upper()}\", {rng.randint(0, 999)})")
+        lines += [f"{indent}    return {rng.choice(WORDS)}", ""]
+    return "\n".join(lines)
+
+
+def text_corpus(num_docs: int, sections_per_doc: int = 40, seed: int = 0) -> List[Tuple[str, str]]:
+    return [(f"notes_{i}.txt", text_document(sections_per_doc, seed=seed + i)) for i in range(num_docs)]
+
+
+def python_corpus(num_docs: int, functions_per_doc: int = 40, seed: int = 0) -> List[Tuple[str, str]]:
+    return [(f"module_{i}.py", python_module(functions_per_doc, seed=seed + i)) for i in range(num_docs)]
+
+
+def analyze_pages(num_pages: int, seed: int = 0, figure_probability: float = 0.0) -> List[dict]:
+    """The pages of a Document Intelligence layout result (REST json) of a report, each with its own content and with spans relative
+    to the start of the page: paragraphs with title, heading, page header and footer roles, tables (some spanning two pages) whose
+    text is part of the content and, with figure_probability, figures whose caption is part of the content. See merge_analyze_pages."""
+    rng = random.Random(seed)
+    pages = []
+    for page_num in range(1, num_pages + 1):
+        content = []
+        length = 0
+        paragraphs, tables, figures = [], [], []
+
+        def add(text: str) -> dict:
+            nonlocal length
+            span = {"offset": length, "length": len(text)}
+            content.append(text + "\n")
+            length += len(text) + 1
+            return span
+
+        paragraphs.append({"role": "pageHeader", "content": "Annual report", "spans": [add("Annual report")]})
+        if page_num % 10 == 1:
+            title = sentence(rng, 3, 6)
+            paragraphs.append({"role": "title", "content": title, "spans": [add(title)]})
+        for _ in range(rng.randint(2, 6)):
+            if rng.random() < 0.3:
+                heading = sentence(rng, 2, 5)
+                paragraphs.append({"role": "sectionHeading", "content": heading, "spans": [add(heading)]})
+            text = paragraph(rng, rng.randint(2, 6))
+            paragraphs.append({"content": text, "spans": [add(text)]})
+        if rng.random() < 0.4:
+            num_rows, num_cols = rng.randint(3, 30), 4
+            cells = []
+            spans = []
+            for row in range(num_rows):
+                for col in range(num_cols):
+                    cell_text = rng.choice(WORDS).title() if row == 0 else f"{rng.choice(WORDS)} {rng.randint(0, 99_999)}"
+                    cell_span = add(cell_text)
+                    cells.append({"rowIndex": row, "columnIndex": col, "content": cell_text, "spans": [cell_span],
+                                  **({"kind": "columnHeader"} if row == 0 else {})})
+                    if spans and spans[-1]["offset"] + spans[-1]["length"] + 1 == cell_span["offset"]:
+                        spans[-1]["length"] += cell_span["length"] + 1
+                    else:
+                        spans.append(dict(cell_span))
+            tables.append({"rowCount": num_rows, "columnCount": num_cols, "cells": cells, "spans": spans})
+        if figure_probability and rng.random() < figure_probability:
+            caption = f"Figure {page_num}: {sentence(rng, 3, 8)}"
+            span = add(caption)
+            paragraphs.append({"content": caption, "spans": [span]})
+            # in inches, as Document Intelligence measures pdf pages
+            x, y = rng.uniform(1, 4), rng.uniform(1, 7)
+            polygon = [x, y, x + 3.5, y, x + 3.5, y + 2.5, x, y + 2.5]
+            figures.append({"spans": [dict(span)], "boundingRegions": [{"pageNumber": 1, "polygon": polygon}]})
+        footer = f"Page {page_num}"
+        paragraphs.append({"role": "pageFooter", "content": footer, "spans": [add(footer)]})
+        pages.append({"content": "".join(content), "paragraphs": paragraphs, "tables": tables, "figures": figures})
+    return pages
+
+
+def _shift_spans(node, offset: int, page_number: int):
+    if isinstance(node, list):
+        for item in node:
+            _shift_spans(item, offset, page_number)
+    elif isinstance(node, dict):
+        for key, value in node.items():
+            if key == "spans":
+                for span in value:
+                    span["offset"] += offset
+            elif key == "boundingRegions":
+                for region in value:
+                    region["pageNumber"] = page_number
+            else:
+                _shift_spans(value, offset, page_number)
+
+
+def merge_analyze_pages(pages: List[dict], model_id: str = "prebuilt-layout") -> dict:
+    """The analyze result of the given pages (of analyze_pages) as one document, with their spans moved to their place in the content."""
+    content = []
+    length = 0
+    result_pages, paragraphs, tables, figures = [], [], [], []
+    for page_number, page in enumerate(pages, start=1):
+        page = copy.deepcopy(page)
+        _shift_spans(page, length, page_number)
+        paragraphs += page["paragraphs"]
+        tables += page["tables"]
+        figures += page["figures"]
+        result_pages.append({"pageNumber": page_number, "spans": [{"offset": length, "length": len(page["content"])}]})
+        content.append(page["content"])
+        length += len(page["content"])
+
+    result = {"apiVersion": "2024-02-29-preview", "modelId": model_id, "content": "".join(content),
+              "pages": result_pages, "paragraphs": paragraphs, "tables": tables}
+    if figures:
+        result["figures"] = figures
+    return result
+
+
+def analyze_result(num_pages: int, seed: int = 0, figure_probability: float = 0.0) -> dict:
+    """A Document Intelligence layout result (REST json) of a report, see analyze_pages, to build AnalyzeResult(...) from."""
+    return merge_analyze_pages(analyze_pages(num_pages, seed, figure_probability))
+
+
+def write_pdf(file_path: str, pages: List[dict]):
+    """Writes a pdf of the given pages (of analyze_pages), with their text and a shape where each figure is.
+    The analyze result of each page is kept in a text annotation of the page, which survives splitting the pdf into
+    page ranges, so that the Document Intelligence stand-in can answer for any part of it. See read_pdf_analyze_pages."""
+    with fitz.open() as pdf:
+        for page_content in pages:
+            page = pdf.new_page(width=612, height=792)
+            page.insert_textbox(fitz.Rect(36, 36, 576, 756), page_content["content"], fontsize=6)
+            for figure in page_content["figures"]:
+                polygon = figure["boundingRegions"][0]["polygon"]
+                page.draw_rect(fitz.Rect(polygon[0] * 72, polygon[1] * 72, polygon[4] * 72, polygon[5] * 72), color=(0, 0, 0.6), fill=(0.7, 0.8, 1))
+            annotation = page.add_text_annot(fitz.Point(0, 0), json.dumps(page_content))
+            annotation.set_info(title=ANALYZE_ANNOTATION_TITLE)
+        pdf.save(file_path, garbage=1, deflate=True)
+
+
+def read_pdf_analyze_pages(pdf: fitz.Document) -> List[dict]:
+    """The analyze result of each page of a pdf written by write_pdf (or of a part of one)."""
+    pages = []
+    for page in pdf:
+        for annotation in page.annots():
+            if annotation.info["title"] == ANALYZE_ANNOTATION_TITLE:
+                pages.append(json.loads(annotation.info["content"]))
+                break
+        else:
+            raise ValueError(f"Page {page.number + 1} has no analyze result annotation")
+    return pages
+
+
+def write_corpus(directory: str, num_docs: int, pages_per_doc: int = 30, seed: int = 0, figure_probability: float = 0.2) -> Dict[str, int]:
+    """Writes num_docs documents of each kind (pdf reports, html and markdown pages, text notes and python modules) to the directory.
+    Returns:
+        Dict[str, int]: The number of bytes written, by file extension.
+    """
+    os.makedirs(directory, exist_ok=True)
+    num_bytes = {}
+
+    def write(file_name: str, content: str):
+        with open(os.path.join(directory, file_name), "w", encoding="utf-8") as f:
+            f.write(content)
+
+    corpora = html_corpus(num_docs, pages_per_doc, seed) + markdown_corpus(num_docs, pages_per_doc, seed) \
+        + text_corpus(num_docs, pages_per_doc, seed) + python_corpus(num_docs, pages_per_doc, seed)
+    for file_name, content in corpora:
+        write(file_name, content)
+    for i in range(num_docs):
+        write_pdf(os.path.join(directory, f"report_{i}.pdf"), analyze_pages(pages_per_doc, seed + i, figure_probability))
+
+    for file_name in os.listdir(directory):
+        extension = file_name.rsplit(".", 1)[-1]
+        num_bytes[extension] = num_bytes.get(extension, 0) + os.path.getsize(os.path.join(directory, file_name))
+    return num_bytes
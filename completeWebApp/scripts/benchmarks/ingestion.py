@@ -0,0 +1,166 @@
+"""End to end benchmark of the ingestion of a synthetic corpus (benchmarks.corpus.write_corpus: pdf reports with tables and figures,
+html and markdown pages, text notes and python modules) against local stand-ins of the Azure services (benchmarks.stand_ins):
+chunk_directory, with the pdfs analyzed by the Document Intelligence stand-in, then the embedding of the chunks and their upload.
+
+Reports the time of each stage, files/s, chunks/s and tokens/s, the peak memory of this process and of the chunking workers, and
+the requests made to each service. The corpus and the stand-in responses only depend on the arguments, so results of different
+commits are comparable: write them with --output and compare a later run to them with --baseline, e.g.
+
+    python -m benchmarks.ingestion --docs 20 --pages 30 --output before.json
+    git checkout <other commit>
+    python -m benchmarks.ingestion --docs 20 --pages 30 --baseline before.json
+
+--analyze-latency, --embedding-latency and --upload-latency add the time the services would take to each request.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import tempfile
+
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+
+import data_utils
+from benchmarks.corpus import write_corpus
+from benchmarks.stand_ins import LocalServices
+from data_preparation import to_upload_dict
+
+# metrics compared against the baseline, higher is better
+THROUGHPUT_METRICS = ["files/s", "chunks/s", "tokens/s", "embedded chunks/s", "uploaded chunks/s"]
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}+changes" if changes.strip() else commit
+
+
+def peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def upload_chunks(chunks, search_endpoint: str, max_concurrency: int) -> data_utils.UploadResult:
+    async def upload():
+        async with AsyncSearchClient(endpoint=search_endpoint, index_name="benchmark", credential=AzureKeyCredential("benchmark")) as search_client:
+            documents = (to_upload_dict(chunk, id) for id, chunk in enumerate(chunks))
+            return await data_utils.upload_documents_concurrently(search_client, documents, max_concurrency=max_concurrency)
+    return asyncio.run(upload())
+
+
+def run(args, work_dir: str) -> dict:
+    timing_report = data_utils.TimingReport()
+    corpus_dir = os.path.join(work_dir, "corpus")
+    with timing_report.time("ingestion", "generate corpus"):
+        corpus_bytes = write_corpus(corpus_dir, args.docs, args.pages, seed=args.seed)
+
+    with LocalServices(args.analyze_latency, args.embedding_latency, args.upload_latency) as services:
+        # the chunking workers create their Document Intelligence client from the environment
+        os.environ["FORM_RECOGNIZER_ENDPOINT"] = services.url
+        os.environ["FORM_RECOGNIZER_KEY"] = "benchmark"
+        os.environ["FORM_RECOGNIZER_PAGES_PER_REQUEST"] = str(args.pages_per_request)
+        os.environ["AZURE_OPENAI_API_KEY"] = "benchmark"
+
+        with timing_report.time("ingestion", "chunk"):
+            result = data_utils.chunk_directory(corpus_dir, num_tokens=args.num_tokens, use_layout=not args.read_model, njobs=args.njobs,
+                                                compact_vectors=True, figure_store=os.path.join(work_dir, "figures"),
+                                                local_extraction=args.local_extraction, ignore_errors=False)
+        if not args.skip_embeddings:
+            with timing_report.time("ingestion", "embed"):
+                data_utils.embed_chunks(result.chunks, services.embedding_endpoint, compact_vectors=True, max_workers=args.embedding_concurrency)
+        with timing_report.time("ingestion", "upload"):
+            upload_result = upload_chunks(result.chunks, services.url, args.upload_concurrency)
+        # the workers have exited, the stand-ins' process is still running and isn't counted
+        workers_peak_rss_mb = peak_rss_mb(resource.RUSAGE_CHILDREN) if args.njobs > 1 else None
+        requests = services.counts()
+
+    if upload_result.failed:
+        raise Exception(f"{len(upload_result.failed)} chunks failed to upload: {set(upload_result.failed.values())}")
+    timing_report.print_report()
+
+    stage_seconds = {stage: seconds for _, stage, seconds in timing_report.timings}
+    num_tokens = sum(data_utils.TOKEN_ESTIMATOR.estimate_tokens(chunk.content) for chunk in result.chunks)
+    throughput = {
+        "files/s": result.total_files / stage_seconds["chunk"],
+        "chunks/s": len(result.chunks) / stage_seconds["chunk"],
+        "tokens/s": num_tokens / stage_seconds["chunk"],
+        "uploaded chunks/s": len(result.chunks) / stage_seconds["upload"],
+    }
+    if "embed" in stage_seconds:
+        throughput["embedded chunks/s"] = len(result.chunks) / stage_seconds["embed"]
+    return {
+        "commit": git_commit(),
+        "arguments": {name: value for name, value in vars(args).items() if name not in ("output", "baseline", "work_dir")},
+        "corpus": {"files": result.total_files, "bytes": corpus_bytes, "chunks": len(result.chunks), "tokens": num_tokens,
+                   "files with errors": result.num_files_with_errors},
+        "stage seconds": stage_seconds,
+        "throughput": throughput,
+        "peak rss mb": {"process": peak_rss_mb(resource.RUSAGE_SELF), "chunking workers": workers_peak_rss_mb},
+        "requests": requests,
+    }
+
+
+def print_results(results: dict, baseline: dict = None):
+    corpus = results["corpus"]
+    print(f"Commit {results['commit']}: {corpus['files']} files, {sum(corpus['bytes'].values()) / 1e6:.1f}MB -> "
+          f"{corpus['chunks']} chunks, {corpus['tokens']} tokens")
+    if baseline is not None and baseline["arguments"] != results["arguments"]:
+        print(f"Warning: the baseline ({baseline['commit']}) was run with other arguments: {baseline['arguments']}")
+    for metric in THROUGHPUT_METRICS:
+        if metric not in results["throughput"]:
+            continue
+        line = f"  {metric:<20} {results['throughput'][metric]:12.1f}"
+        if baseline is not None and baseline["throughput"].get(metric):
+            line += f"  ({results['throughput'][metric] / baseline['throughput'][metric]:.2f}x {baseline['commit']})"
+        print(line)
+    for name, rss in results["peak rss mb"].items():
+        if rss is None:
+            continue
+        line = f"  {'peak rss ' + name:<25} {rss:7.0f}MB"
+        if baseline is not None and baseline["peak rss mb"].get(name):
+            line += f"  ({rss / baseline['peak rss mb'][name]:.2f}x {baseline['commit']})"
+        print(line)
+    print(f"  requests: {results['requests']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=10, help="Number of documents of each kind")
+    parser.add_argument("--pages", type=int, default=30, help="Pages per pdf report (and sections per html, markdown and text document)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num-tokens", type=int, default=1024, help="Chunk size in tokens")
+    parser.add_argument("--njobs", type=int, default=4, help="Number of chunking processes")
+    parser.add_argument("--read-model", action="store_true", help="Analyze the pdfs with prebuilt-read instead of prebuilt-layout")
+    parser.add_argument("--local-extraction", action="store_true", help="Extract the pdfs locally when possible, see chunk_directory")
+    parser.add_argument("--pages-per-request", type=int, default=100, help="Maximum number of pdf pages per analyze request")
+    parser.add_argument("--skip-embeddings", action="store_true", help="Upload the chunks without embedding them")
+    parser.add_argument("--embedding-concurrency", type=int, default=4, help="Number of concurrent embedding requests")
+    parser.add_argument("--upload-concurrency", type=int, default=4, help="Number of upload batches in flight")
+    parser.add_argument("--analyze-latency", type=float, default=0.0, help="Seconds until an analyze operation succeeds")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Seconds spent on each embeddings request")
+    parser.add_argument("--upload-latency", type=float, default=0.0, help="Seconds spent on each upload request")
+    parser.add_argument("--work-dir", type=str, help="Directory to write the corpus and figures to (kept), instead of a temporary one")
+    parser.add_argument("--output", type=str, help="Write the results to this json file")
+    parser.add_argument("--baseline", type=str, help="Compare the results to those of this json file (of --output)")
+    args = parser.parse_args()
+
+    if args.work_dir:
+        results = run(args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run(args, work_dir)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,76 @@
+"""Benchmark of PdfTextSplitter.mask_urls_and_imgs and of unmasking the chunks, on link-heavy documents.
+
+Compares against the previous implementation (kept below as a reference: one str.replace per unique url/image,
+and one per placeholder for every chunk) and checks that chunks unmask to the same text.
+
+    python -m benchmarks.masking --pages 200 --link-probability 0.8
+"""
+import argparse
+import re
+import time
+
+import data_utils
+from benchmarks.corpus import pdf_layout_html
+
+
+def reference_mask_urls_and_imgs(text):
+    regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^()\s<>]+|\(([^()\s<>]+|(\([^()\s<>]+\)))*\))+(?:\(([^()\s<>]+|(\([^()\s<>]+\)))*\)|[^()\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
+    urls = set(x[0] for x in re.findall(regex, text))
+    content_dict = {}
+    masked_text = text
+    for i, url in enumerate(urls):
+        masked_text = masked_text.replace(url, f"##URL{i}##")
+        content_dict[f"##URL{i}##"] = url
+    imgs = set(re.findall(r'(<img\s+src="[^"]+"[^>]*>.*?</img>)', text, re.DOTALL))
+    for i, img in enumerate(imgs):
+        masked_text = masked_text.replace(img, f"##IMG{i}##")
+        content_dict[f"##IMG{i}##"] = img
+    return content_dict, masked_text
+
+
+def reference_unmask(text, content_dict):
+    if "##URL" in text or "##IMG" in text:
+        for key, value in content_dict.items():
+            text = text.replace(key, value)
+    return text
+
+
+def unmask(text, content_dict):
+    return data_utils.MASK_PLACEHOLDER_REGEX.sub(lambda match: content_dict.get(match.group(0), match.group(0)), text)
+
+
+def time_masking(mask, unmask, text, chunk_chars):
+    start = time.process_time()
+    content_dict, masked_text = mask(text)
+    mask_time = time.process_time() - start
+
+    # cut the chunks at spaces, so no placeholder is cut in two
+    chunks = []
+    start = 0
+    while start < len(masked_text):
+        end = masked_text.find(" ", start + chunk_chars)
+        end = len(masked_text) if end == -1 else end + 1
+        chunks.append(masked_text[start:end])
+        start = end
+    start = time.process_time()
+    unmasked = "".join(unmask(chunk, content_dict) for chunk in chunks)
+    unmask_time = time.process_time() - start
+    return mask_time, unmask_time, len(content_dict), unmasked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--link-probability", type=float, default=0.8, help="Probability of a link after each sentence")
+    parser.add_argument("--chunk-chars", type=int, default=4000, help="Size of the chunks to unmask, in characters")
+    args = parser.parse_args()
+
+    text = pdf_layout_html(args.pages, link_probability=args.link_probability)
+    splitter = data_utils.PdfTextSplitter(chunk_size=1024)
+    for name, mask, unmask_fn in [
+        ("reference", reference_mask_urls_and_imgs, reference_unmask),
+        ("current", splitter.mask_urls_and_imgs, unmask),
+    ]:
+        mask_time, unmask_time, num_masked, unmasked = time_masking(mask, unmask_fn, text, args.chunk_chars)
+        print(f"{name}: {len(text) / 1e6:.2f}M chars, {num_masked} unique urls/images, "
+              f"mask {mask_time:.3f}s, unmask {unmask_time:.3f}s, round trip {'ok' if unmasked == text else 'MISMATCH'}")
@@ -0,0 +1,82 @@
+"""Benchmark of HTMLParser and MarkdownParser, the parsers of .html and .md files, on synthetic pages.
+
+Compares against the previous implementation (kept below as a reference: the whole document parsed to a BeautifulSoup
+tree for its title, and markdown converted with a new converter for each document) and checks that both produce the
+same documents. Markdown pages are parsed with and without fenced code blocks, which take the html title path.
+
+    python -m benchmarks.parsing --docs 200 --sections 40
+"""
+import argparse
+import time
+
+import markdown
+from bs4 import BeautifulSoup
+
+import data_utils
+from benchmarks.corpus import html_corpus, markdown_corpus
+
+
+class ReferenceHTMLParser(data_utils.HTMLParser):
+    def parse(self, content, file_name=None):
+        soup = BeautifulSoup(content, 'html.parser')
+
+        # Extract the title
+        title = ''
+        if soup.title and soup.title.string:
+            title = soup.title.string
+        else:
+            # Try to find the first <h1> tag
+            h1_tag = soup.find('h1')
+            if h1_tag:
+                title = h1_tag.get_text(strip=True)
+            else:
+                h2_tag = soup.find('h2')
+                if h2_tag:
+                    title = h2_tag.get_text(strip=True)
+        if title is None or title == '':
+            # if title is still not found, guess using the next string
+            try:
+                title = next(soup.stripped_strings)
+                title = self.token_estimator.construct_tokens_with_size(title, self.TITLE_MAX_TOKENS)
+
+            except StopIteration:
+                title = file_name
+
+        # Parse the content as it is without any formatting changes
+        result = content
+        if title is None:
+            title = '' # ensure no 'None' type title
+
+        return data_utils.Document(content=data_utils.cleanup_content(result), title=str(title))
+
+
+class ReferenceMarkdownParser(data_utils.MarkdownParser):
+    def __init__(self):
+        super().__init__()
+        self._html_parser = ReferenceHTMLParser()
+
+    def parse(self, content, file_name=None):
+        html_content = markdown.markdown(content, extensions=['fenced_code', 'toc', 'tables', 'sane_lists'])
+        return self._html_parser.parse(html_content, file_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--sections", type=int, default=40)
+    args = parser.parse_args()
+
+    corpora = [
+        ("html", html_corpus(args.docs, args.sections), ReferenceHTMLParser(), data_utils.HTMLParser()),
+        ("markdown", markdown_corpus(args.docs, args.sections), ReferenceMarkdownParser(), data_utils.MarkdownParser()),
+        ("markdown with code", markdown_corpus(args.docs, args.sections, code_probability=0.3), ReferenceMarkdownParser(), data_utils.MarkdownParser()),
+    ]
+    for corpus_name, corpus, reference_parser, current_parser in corpora:
+        num_chars = sum(len(content) for _, content in corpus)
+        documents = {}
+        for name, doc_parser in [("reference", reference_parser), ("current", current_parser)]:
+            start = time.process_time()
+            documents[name] = [doc_parser.parse(content, file_name) for file_name, content in corpus]
+            elapsed = time.process_time() - start
+            print(f"{name} ({corpus_name}): {args.docs} docs, {num_chars / 1e6:.2f}M chars, {elapsed:.3f}s")
+        print(f"output {'identical' if documents['reference'] == documents['current'] else 'MISMATCH'}")
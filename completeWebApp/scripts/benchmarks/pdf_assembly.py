@@ -0,0 +1,101 @@
+"""Benchmark of assembling the text of analyzed pdfs (data_utils.assemble_pdf_text) on synthetic layout results of large reports.
+
+Compares against the previous implementation (kept below as a reference: the page text built one character at a time,
+with a table id per character of the page and every table of the document checked on every page) and checks that
+both produce the same text.
+
+    python -m benchmarks.pdf_assembly --pages 1000
+"""
+import argparse
+import time
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+import data_utils
+from benchmarks.corpus import analyze_result
+
+
+def reference_assemble_pdf_text(form_recognizer_results, use_layout=False):
+    offset = 0
+    page_map = []
+
+    # (if using layout) mark all the positions of headers
+    roles_start = {}
+    roles_end = {}
+    for paragraph in form_recognizer_results.paragraphs:
+        if paragraph.role!=None:
+            para_start = paragraph.spans[0].offset
+            para_end = paragraph.spans[0].offset + paragraph.spans[0].length
+            roles_start[para_start] = paragraph.role
+            roles_end[para_end] = paragraph.role
+
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+
+        if use_layout:
+            tables_on_page = []
+            for table in form_recognizer_results.tables:
+                # If the table is empty, the span is empty, so we skip it
+                if len(table.spans) > 0:
+                    table_offset = table.spans[0].offset
+                    table_length = table.spans[0].length
+                    if page_offset <= table_offset and table_offset + table_length < page_offset + page_length:
+                        tables_on_page.append(table)
+        else:
+            tables_on_page = []
+
+        # (if using layout) mark all positions of the table spans in the page
+        table_chars = [-1]*page_length
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                # replace all table spans with "table_id" in table_chars array
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >=0 and idx < page_length:
+                        table_chars[idx] = table_id
+
+        # build page text by replacing charcters in table spans with table html and replace the characters corresponding to headers with html headers, if using layout
+        page_text = ""
+        added_tables = set()
+        for idx, table_id in enumerate(table_chars):
+            if table_id == -1:
+                position = page_offset + idx
+                if position in roles_start.keys():
+                    role = roles_start[position]
+                    if role in data_utils.PDF_HEADERS:
+                        page_text += f"<{data_utils.PDF_HEADERS[role]}>"
+                if position in roles_end.keys():
+                    role = roles_end[position]
+                    if role in data_utils.PDF_HEADERS:
+                        page_text += f"</{data_utils.PDF_HEADERS[role]}>"
+
+                page_text += form_recognizer_results.content[page_offset + idx]
+                
+            elif not table_id in added_tables:
+                page_text += data_utils.table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+
+        page_text += " "
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+
+    return "".join([page_text for _, _, page_text in page_map])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--docs", type=int, default=1)
+    args = parser.parse_args()
+
+    results = [AnalyzeResult(analyze_result(args.pages, seed=seed)) for seed in range(args.docs)]
+    num_chars = sum(len(result.content) for result in results)
+    for use_layout in (False, True):
+        texts = {}
+        for name, assemble in [("reference", reference_assemble_pdf_text), ("current", data_utils.assemble_pdf_text)]:
+            start = time.process_time()
+            texts[name] = [assemble(result, use_layout) for result in results]
+            elapsed = time.process_time() - start
+            print(f"{name} ({'layout' if use_layout else 'read'}): {args.docs * args.pages} pages, {num_chars / 1e6:.2f}M chars, {elapsed:.3f}s")
+        print(f"output {'identical' if texts['reference'] == texts['current'] else 'MISMATCH'}")
@@ -0,0 +1,222 @@
+"""Local stand-ins of the Azure services used by the data preparation, to benchmark it without them: Document Intelligence
+(analyze operations on the pdfs of benchmarks.corpus.write_pdf), Azure OpenAI embeddings and Azure AI Search document uploads.
+
+They serve the REST routes the Azure SDKs call, from one http server on localhost, and can add a latency to each request
+to model the time spent in the services. Responses are deterministic, so runs on different commits do the same work.
+"""
+import base64
+import hashlib
+import itertools
+import json
+import multiprocessing
+import random
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+import fitz
+
+from benchmarks.corpus import merge_analyze_pages, read_pdf_analyze_pages
+
+ANALYZE_PATH_REGEX = re.compile(r"/documentintelligence/documentModels/(?P<model_id>[^/:]+):analyze$")
+ANALYZE_RESULT_PATH_REGEX = re.compile(r"/documentintelligence/documentModels/(?P<model_id>[^/]+)/analyzeResults/(?P<result_id>[^/]+)$")
+EMBEDDINGS_PATH_REGEX = re.compile(r"/openai/deployments/(?P<deployment_id>[^/]+)/embeddings$")
+SEARCH_INDEX_PATH_REGEX = re.compile(r"/indexes\('(?P<index_name>[^']+)'\)/docs/search\.index$")
+
+COUNTS_PATH = "/stand-ins/counts"
+
+DEFAULT_EMBEDDING_DIMENSION = 1536
+
+
+def embedding(text: str, dimension: int) -> list:
+    """A deterministic embedding of the text: random (but seeded by the text) coordinates in [-1, 1)."""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    return [rng.random() * 2 - 1 for _ in range(dimension)]
+
+
+def analyze(pdf_content: bytes, model_id: str) -> dict:
+    """The analyze result of a pdf written by benchmarks.corpus.write_pdf, or of a page range of one. As with the read model of
+    Document Intelligence, prebuilt-read results have no tables, figures nor paragraph roles."""
+    with fitz.open(stream=pdf_content, filetype="pdf") as pdf:
+        pages = read_pdf_analyze_pages(pdf)
+    if model_id == "prebuilt-read":
+        for page in pages:
+            page["tables"], page["figures"] = [], []
+            for paragraph in page["paragraphs"]:
+                paragraph.pop("role", None)
+    return merge_analyze_pages(pages, model_id)
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StandInServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+    def send_json(self, status: int, body=None, headers: Dict[str, str] = {}):
+        content = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if match := ANALYZE_PATH_REGEX.search(path):
+            self.server.count("analyze")
+            self.start_analyze(match.group("model_id"), self.read_json())
+        elif match := EMBEDDINGS_PATH_REGEX.search(path):
+            self.server.count("embeddings")
+            time.sleep(self.server.embedding_latency)
+            self.embed(match.group("deployment_id"), self.read_json())
+        elif SEARCH_INDEX_PATH_REGEX.search(path):
+            self.server.count("upload")
+            time.sleep(self.server.upload_latency)
+            self.upload(self.read_json())
+        else:
+            self.send_json(404, {"error": {"code": "NotFound", "message": f"No stand-in for POST {path}"}})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if match := ANALYZE_RESULT_PATH_REGEX.search(path):
+            self.server.count("analyze polls")
+            self.get_analyze_result(match.group("result_id"))
+        elif path == COUNTS_PATH:
+            with self.server._lock:
+                self.send_json(200, dict(self.server.counts))
+        else:
+            self.send_json(404, {"error": {"code": "NotFound", "message": f"No stand-in for GET {path}"}})
+
+    def start_analyze(self, model_id: str, request: dict):
+        try:
+            result = analyze(base64.b64decode(request["base64Source"]), model_id)
+        except Exception as e:
+            self.send_json(400, {"error": {"code": "InvalidRequest", "message": f"Not a benchmark pdf: {e}"}})
+            return
+        result_id = self.server.add_operation(result)
+        operation_location = f"{self.server.url}/documentintelligence/documentModels/{model_id}/analyzeResults/{result_id}?api-version={result['apiVersion']}"
+        # the operation is polled again as soon as it is done (and not after the client's polling interval)
+        self.send_json(202, headers={"Operation-Location": operation_location, "retry-after-ms": str(max(1, int(self.server.analyze_latency * 1000)))})
+
+    def get_analyze_result(self, result_id: str):
+        operation = self.server.get_operation(result_id)
+        if operation is None:
+            self.send_json(404, {"error": {"code": "NotFound", "message": f"No analyze operation {result_id}"}})
+            return
+        ready_time, result = operation
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        remaining = ready_time - time.monotonic()
+        if remaining > 0:
+            self.send_json(200, {"status": "running", "createdDateTime": timestamp, "lastUpdatedDateTime": timestamp},
+                           headers={"retry-after-ms": str(max(1, int(remaining * 1000)))})
+            return
+        self.server.remove_operation(result_id)
+        self.send_json(200, {"status": "succeeded", "createdDateTime": timestamp, "lastUpdatedDateTime": timestamp, "analyzeResult": result})
+
+    def embed(self, deployment_id: str, request: dict):
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        dimension = request.get("dimensions", DEFAULT_EMBEDDING_DIMENSION)
+        data = []
+        for index, text in enumerate(texts):
+            vector = embedding(text, dimension)
+            if request.get("encoding_format") == "base64":
+                # the openai client asks for the float32 values, base64 encoded, when numpy is installed
+                vector = base64.b64encode(struct.pack(f"<{dimension}f", *vector)).decode()
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        num_tokens = sum(len(text.split()) for text in texts)
+        self.send_json(200, {"object": "list", "data": data, "model": deployment_id, "usage": {"prompt_tokens": num_tokens, "total_tokens": num_tokens}})
+
+    def upload(self, request: dict):
+        self.server.count("uploaded documents", len(request["value"]))
+        results = [{"key": document["id"], "status": True, "errorMessage": None, "statusCode": 201} for document in request["value"]]
+        self.send_json(200, {"value": results})
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, analyze_latency: float, embedding_latency: float, upload_latency: float):
+        super().__init__(("127.0.0.1", 0), StandInRequestHandler)
+        self.analyze_latency = analyze_latency
+        self.embedding_latency = embedding_latency
+        self.upload_latency = upload_latency
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        # number of requests (and uploaded documents) by api
+        self.counts = {}
+        self._operations = {}
+        self._operation_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_operation(self, result: dict) -> str:
+        with self._lock:
+            result_id = str(next(self._operation_ids))
+            self._operations[result_id] = (time.monotonic() + self.analyze_latency, result)
+        return result_id
+
+    def get_operation(self, result_id: str):
+        with self._lock:
+            return self._operations.get(result_id)
+
+    def remove_operation(self, result_id: str):
+        with self._lock:
+            self._operations.pop(result_id, None)
+
+
+def _serve(latencies: tuple, port_queue: multiprocessing.Queue):
+    server = StandInServer(*latencies)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class LocalServices:
+    """The stand-ins, served on a free port of localhost by a separate process (so that their work isn't measured
+    as the benchmarked process' own) while used as a context manager:
+
+        with LocalServices(analyze_latency=1.0) as services:
+            engine = DocumentAnalysisEngine(services.url, AzureKeyCredential("benchmark"))
+            get_embeddings(texts, services.embedding_endpoint, "benchmark")
+
+    Args:
+        analyze_latency (float): Seconds until an analyze operation succeeds.
+        embedding_latency (float): Seconds spent on each embeddings request.
+        upload_latency (float): Seconds spent on each document upload request.
+    """
+
+    def __init__(self, analyze_latency: float = 0.0, embedding_latency: float = 0.0, upload_latency: float = 0.0):
+        self.latencies = (analyze_latency, embedding_latency, upload_latency)
+        self.url = None
+        self.embedding_endpoint = None
+        self._process = None
+
+    def counts(self) -> Dict[str, int]:
+        """The number of requests served (and of documents uploaded) so far, by api."""
+        with urlopen(f"{self.url}{COUNTS_PATH}") as response:
+            return json.load(response)
+
+    def __enter__(self):
+        port_queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_serve, args=(self.latencies, port_queue), daemon=True)
+        self._process.start()
+        self.url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+        self.embedding_endpoint = f"{self.url}/openai/deployments/embedding/embeddings?api-version=2024-02-01"
+        return self
+
+    def __exit__(self, *args):
+        self._process.terminate()
+        self._process.join()
@@ -0,0 +1,145 @@
+"""Recall of truncated and compressed vector indexes (the vector_dimensions and vector_compression of an index config), against
+a locally stored exact baseline.
+
+Does locally what such an index does to a vector query: the vectors are truncated to the index dimensions and rescaled to unit
+length (as truncate_vector does), quantized to int8 (scalar) or to 1 bit per dimension (binary), the query is scored against
+the quantized vectors, and the oversampling * k best candidates are reranked with the full precision vectors. recall@k is the
+share of the exact top k (full size, full precision, cosine similarity) that is found. The exact top k are computed once and
+kept in the --baseline file, and later runs with the same vectors and queries are compared to it.
+
+The vectors are the contentVector of the NDJSON chunks written by the ingestion (e.g. by embed_documents.py), or synthetic
+ones whose variance decreases along the dimensions, like the embeddings of Matryoshka models. The queries are the vectors of
+--queries, or vectors of chunks with noise added.
+
+    python -m benchmarks.vector_recall --vectors 100000 --dimensions 1536 --baseline recall_baseline.npz
+    python -m benchmarks.vector_recall --chunks embedded.ndjson --truncate 1536,512,256 --baseline recall_baseline.npz
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from data_utils import VECTOR_DEFAULT_OVERSAMPLING
+
+QUERY_BATCH_SIZE = 256
+# bytes per dimension of the vector index, by compression
+BYTES_PER_DIMENSION = {"none": 4, "scalar": 1, "binary": 1 / 8}
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def read_vectors(ndjson_path: str, field: str = "contentVector") -> np.ndarray:
+    with open(ndjson_path) as f:
+        vectors = [document[field] for document in map(json.loads, filter(str.strip, f)) if document.get(field)]
+    return np.array(vectors, dtype=np.float32)
+
+
+def synthetic_vectors(num_vectors: int, dimensions: int, seed: int = 0, num_clusters: int = 100) -> np.ndarray:
+    """Clustered unit vectors whose variance decreases along the dimensions, so that the first dimensions carry the most information."""
+    rng = np.random.default_rng(seed)
+    scale = 1 / np.sqrt(1 + np.arange(dimensions) / 32)
+    centers = rng.normal(size=(num_clusters, dimensions)).astype(np.float32) * scale
+    vectors = centers[rng.integers(num_clusters, size=num_vectors)] + rng.normal(scale=0.7, size=(num_vectors, dimensions)).astype(np.float32) * scale
+    return normalize(vectors)
+
+
+def noisy_queries(vectors: np.ndarray, num_queries: int, seed: int = 0, noise: float = 0.5) -> np.ndarray:
+    rng = np.random.default_rng(seed + 1)
+    queries = vectors[rng.choice(len(vectors), size=num_queries, replace=False)]
+    return normalize(queries + rng.normal(scale=noise / np.sqrt(vectors.shape[1]), size=queries.shape).astype(np.float32))
+
+
+def top_k(queries: np.ndarray, vectors: np.ndarray, k: int) -> np.ndarray:
+    """The indexes of the k vectors with the highest dot product with each query, best first."""
+    results = []
+    for start in range(0, len(queries), QUERY_BATCH_SIZE):
+        scores = queries[start:start + QUERY_BATCH_SIZE] @ vectors.T
+        candidates = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+        results.append(np.take_along_axis(candidates, order, axis=1))
+    return np.concatenate(results)
+
+
+def load_or_compute_baseline(baseline_path: str, vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """The exact top k of each query, read from baseline_path if it was computed for the same vectors, queries and k, else computed and saved there."""
+    fingerprint = np.array([len(vectors), vectors.shape[1], k, float(vectors.sum()), float(queries.sum())])
+    if baseline_path and os.path.exists(baseline_path):
+        baseline = np.load(baseline_path)
+        if np.array_equal(baseline["fingerprint"], fingerprint):
+            print(f"Using the exact top {k} of {baseline_path}")
+            return baseline["top_k"]
+        print(f"{baseline_path} was computed for other vectors, queries or k, recomputing it")
+    start = time.perf_counter()
+    exact = top_k(queries, vectors, k)
+    print(f"Exact top {k} of {len(queries)} queries computed in {time.perf_counter() - start:.1f}s")
+    if baseline_path:
+        np.savez(baseline_path, fingerprint=fingerprint, top_k=exact)
+    return exact
+
+
+def quantize(vectors: np.ndarray, compression: str) -> np.ndarray:
+    """The vectors as the index scores them: int8 per dimension (scaled to the range of each dimension) or 1 bit per dimension."""
+    if compression == "scalar":
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        step = np.where(high > low, (high - low) / 255, 1)
+        return np.round((vectors - low) / step) * step + low
+    if compression == "binary":
+        return np.where(vectors > 0, 1, -1).astype(np.float32)
+    return vectors
+
+
+def search(queries: np.ndarray, vectors: np.ndarray, k: int, compression: str, oversampling: float) -> np.ndarray:
+    if compression == "none":
+        return top_k(queries, vectors, k)
+    scored_queries = np.where(queries > 0, 1, -1).astype(np.float32) if compression == "binary" else queries
+    candidates = top_k(scored_queries, quantize(vectors, compression), max(k, int(k * oversampling)))
+    if oversampling <= 1:
+        return candidates[:, :k]
+    # rerank the candidates with the full precision vectors
+    scores = np.einsum("qd,qcd->qc", queries, vectors[candidates])
+    order = np.argsort(-scores, axis=1)[:, :k]
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def recall(found: np.ndarray, exact: np.ndarray) -> float:
+    return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, exact)]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=str, help="NDJSON chunks with a contentVector, instead of synthetic vectors")
+    parser.add_argument("--queries", type=str, help="NDJSON documents with the query vectors in contentVector, instead of noisy chunk vectors")
+    parser.add_argument("--vectors", type=int, default=100_000, help="Number of synthetic vectors")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Dimensions of the synthetic vectors")
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--truncate", type=str, default="1536,1024,512,256", help="Comma separated index dimensions to evaluate")
+    parser.add_argument("--compressions", type=str, default="none,scalar,binary", help="Comma separated compressions to evaluate")
+    parser.add_argument("--oversampling", type=float, default=VECTOR_DEFAULT_OVERSAMPLING, help="Oversampling of the reranked compressed searches")
+    parser.add_argument("--baseline", type=str, help="File (.npz) to keep the exact top k in, and to read them from in later runs")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = normalize(read_vectors(args.chunks)) if args.chunks else synthetic_vectors(args.vectors, args.dimensions, args.seed)
+    queries = normalize(read_vectors(args.queries)) if args.queries else noisy_queries(vectors, args.num_queries, args.seed)
+    exact = load_or_compute_baseline(args.baseline, vectors, queries, args.k)
+
+    full_mb = vectors.size * 4 / 1e6
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions ({full_mb:.0f}MB as float32), {len(queries)} queries, recall@{args.k}:")
+    print(f"  {'dimensions':>10} {'compression':<12} {'rerank':<8} {'recall':>7} {'index MB':>9} {'search s':>9}")
+    for dimensions in sorted({int(d) for d in args.truncate.split(",") if int(d) <= vectors.shape[1]}, reverse=True):
+        truncated_vectors = normalize(vectors[:, :dimensions])
+        truncated_queries = normalize(queries[:, :dimensions])
+        for compression in args.compressions.split(","):
+            for oversampling in ([1] if compression == "none" else [1, args.oversampling]):
+                start = time.perf_counter()
+                found = search(truncated_queries, truncated_vectors, args.k, compression, oversampling)
+                elapsed = time.perf_counter() - start
+                index_mb = len(vectors) * dimensions * BYTES_PER_DIMENSION[compression] / 1e6
+                rerank = f"x{oversampling:g}" if oversampling > 1 else "-"
+                print(f"  {dimensions:>10} {compression:<12} {rerank:<8} {recall(found, exact):7.3f} {index_mb:9.1f} {elapsed:9.2f}")
@@ -1,20 +1,19 @@
 import argparse
-import dataclasses
 import json
 import os
 
 from azure.identity import DefaultAzureCredential
 from azure.core.credentials import AzureKeyCredential
-from azure.keyvault.secrets import SecretClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
-from data_utils import chunk_directory
+from data_utils import chunk_directory, get_keyvault_secret
 
-def get_document_intelligence_client(config, secret_client):
+def get_document_intelligence_client(config, credential):
     print("Setting up Document Intelligence client...")
     secret_name = config.get("document_intelligence_secret_name")
 
-    if not secret_client or not secret_name:
+    keyvault_url = config.get("keyvault_url")
+    if not keyvault_url or not secret_name:
         print("No keyvault url or secret name provided in config file. Document Intelligence client will not be set up.")
         return None
 
@@ -24,11 +23,11 @@ def get_document_intelligence_client(config, secret_client):
         return None
     
     try:
-        document_intelligence_secret = secret_client.get_secret(secret_name)
+        document_intelligence_key = get_keyvault_secret(keyvault_url, secret_name, credential)
         os.environ["FORM_RECOGNIZER_ENDPOINT"] = endpoint
-        os.environ["FORM_RECOGNIZER_KEY"] = document_intelligence_secret.value
+        os.environ["FORM_RECOGNIZER_KEY"] = document_intelligence_key
 
-        document_intelligence_credential = AzureKeyCredential(document_intelligence_secret.value)
+        document_intelligence_credential = AzureKeyCredential(document_intelligence_key)
 
         document_intelligence_client = DocumentAnalysisClient(endpoint, document_intelligence_credential)
         print("Document Intelligence client set up.")
@@ -55,16 +54,8 @@ if __name__ == "__main__":
         config = [config]
     
     for index_config in config:
-        # Keyvault Secret Client
-        keyvault_url = index_config.get("keyvault_url")
-        if not keyvault_url:
-            print("No keyvault url provided in config file. Secret client will not be set up.")
-            secret_client = None
-        else:
-            secret_client = SecretClient(keyvault_url, credential)
-
         # Optional client for cracking documents
-        document_intelligence_client = get_document_intelligence_client(index_config, secret_client)
+        document_intelligence_client = get_document_intelligence_client(index_config, credential)
 
         # Crack and chunk documents
         print("Cracking and chunking documents...")
@@ -75,6 +66,7 @@ if __name__ == "__main__":
                             token_overlap=index_config.get("token_overlap", 128),
                             form_recognizer_client=document_intelligence_client,
                             use_layout=index_config.get("use_layout", False),
+                            local_extraction=index_config.get("local_extraction", False),
                             njobs=1)
         
         print(f"Processed {chunking_result.total_files} files")
@@ -86,9 +78,8 @@ if __name__ == "__main__":
         with open(args.output_file_path, "w") as f:
             for chunk in chunking_result.chunks:
                 id = 0
-                d = dataclasses.asdict(chunk)
                 # add id to documents
-                d.update({"id": str(id)})
+                d = chunk.to_dict(id=str(id))
                 f.write(json.dumps(d) + "\n")
                 id += 1
         print("Chunking result written to {}.".format(args.output_file_path))
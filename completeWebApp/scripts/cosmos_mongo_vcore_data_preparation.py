@@ -2,17 +2,17 @@
 import argparse
 import json
 import os
-import uuid
 
 import requests
 from data_utils import Document
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureCliCredential
+from pymongo import ReplaceOne
 from pymongo.mongo_client import MongoClient
 from typing import List
 
-from data_utils import chunk_directory
+from data_utils import chunk_directory, get_document_id, vector_to_list, write_batches_concurrently, print_batch_write_report, BatchWriteReport
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -122,27 +122,29 @@ def upsert_documents_to_index(
         mongo_client: MongoClient,
         database_name: str,
         collection_name: str,
-        docs: List[Document]
-        ):
-    for document in docs:
+        docs: List[Document],
+        batch_size: int = 100,
+        max_workers: int = 4
+        ) -> BatchWriteReport:
+    mongo_collection = mongo_client[database_name][collection_name]
+
+    def to_replace_one(document: Document) -> ReplaceOne:
         finalDocChunk:dict = {}
-        finalDocChunk["_id"] = f"doc:{uuid.uuid4()}"
+        finalDocChunk["_id"] = f"doc:{get_document_id(document)}"
         finalDocChunk['title'] = document.title
         finalDocChunk["filepath"] = document.filepath
         finalDocChunk["url"] = document.url
         finalDocChunk["content"] = document.content
-        finalDocChunk["contentvector"] = document.contentVector
+        finalDocChunk["contentvector"] = vector_to_list(document.contentVector)
         finalDocChunk["metadata"] = document.metadata
+        return ReplaceOne({"_id": finalDocChunk["_id"]}, finalDocChunk, upsert=True)
 
-        mongo_collection = mongo_client[database_name][collection_name]
+    def upsert_batch(batch: List[Document]):
+        # unordered so one bad document doesn't stop the rest of the batch
+        mongo_collection.bulk_write([to_replace_one(document) for document in batch], ordered=False)
 
-        try:
-            mongo_collection.insert_one(finalDocChunk)
-            print(f"Upsert doc chunk {document.id} successfully")
-        
-        except Exception as e:
-            print(f"Failed to upsert doc chunk {document.id}")
-            continue
+    # ids are deterministic, so retried or re-run batches replace the same documents
+    return write_batches_concurrently(docs, upsert_batch, get_id=get_document_id, batch_size=batch_size, max_workers=max_workers)
 
 def validate_index(
         mongo_client: MongoClient,
@@ -209,7 +211,9 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
 
     # upsert documents to index
     print("Upserting documents to index...")
-    upsert_documents_to_index(mongo_client, database_name, collection_name, result.chunks)
+    report = upsert_documents_to_index(mongo_client, database_name, collection_name, result.chunks,
+                                       batch_size=config.get("upsert_batch_size", 100), max_workers=config.get("upsert_max_workers", 4))
+    print_batch_write_report(report)
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -1,20 +1,25 @@
 """Data Preparation Script for an Azure Cognitive Search Index."""
 import argparse
-import dataclasses
+import asyncio
+import hashlib
+import itertools
 import json
 import os
 import subprocess
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import requests
-from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureCliCredential
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from dotenv import load_dotenv
 from tqdm import tqdm
 
-from data_utils import chunk_directory, chunk_blob_container
+from data_utils import chunk_directory, chunk_blob_container, upload_documents_concurrently, DocumentAnalysisEngine, BlobManifest, TimingReport, RETRY_COUNT, UPLOAD_MAX_BATCH_SIZE, DEDUP_POLICIES, FIGURE_MAX_EDGE, \
+    VECTOR_COMPRESSIONS, VECTOR_DEFAULT_OVERSAMPLING, truncate_vector, vector_to_list
 
 # Configure environment variables  
 load_dotenv() # take environment variables from .env.
@@ -136,6 +141,17 @@ def create_search_service(
         raise Exception(
             f"Failed to create search service. Error: {response.text}")
 
+@lru_cache(maxsize=None)
+def get_search_admin_key(service_name, subscription_id, resource_group):
+    # looked up once per search service, the indexes of a run share it
+    return json.loads(
+        subprocess.run(
+            f"az search admin-key show --subscription {subscription_id} --resource-group {resource_group} --service-name {service_name}",
+            shell=True,
+            capture_output=True,
+        ).stdout
+    )["primaryKey"]
+
 def create_or_update_search_index(
         service_name, 
         subscription_id=None, 
@@ -145,21 +161,22 @@ def create_or_update_search_index(
         credential=None, 
         language=None,
         vector_config_name=None,
-        admin_key=None):
-    
+        admin_key=None,
+        vector_dimensions=None,
+        vector_compression=None,
+        vector_oversampling=VECTOR_DEFAULT_OVERSAMPLING):
+    """Creates the index, or updates its schema.
+    The vector field has vector_dimensions dimensions (VECTOR_DIMENSION by default). With a vector_compression (scalar or binary,
+    see VECTOR_COMPRESSIONS), the vector index keeps the vectors quantized, which makes it several times smaller and faster to
+    search, and vector queries rerank vector_oversampling times k candidates with the full precision vectors to recover recall.
+    """
     if credential is None and admin_key is None:
         raise ValueError("credential and admin key cannot be None")
     
     if not admin_key:
-        admin_key = json.loads(
-            subprocess.run(
-                f"az search admin-key show --subscription {subscription_id} --resource-group {resource_group} --service-name {service_name}",
-                shell=True,
-                capture_output=True,
-            ).stdout
-        )["primaryKey"]
-
-    url = f"https://{service_name}.search.windows.net/indexes/{index_name}?api-version=2024-03-01-Preview"
+        admin_key = get_search_admin_key(service_name, subscription_id, resource_group)
+
+    url = f"https://{service_name}.search.windows.net/indexes/{index_name}?api-version=2024-07-01"
     headers = {
         "Content-Type": "application/json",
         "api-key": admin_key,
@@ -241,7 +258,7 @@ def create_or_update_search_index(
             "searchable": True,
             "retrievable": True,
             "stored": True,
-            "dimensions": int(os.getenv("VECTOR_DIMENSION", 1536)),
+            "dimensions": vector_dimensions or int(os.getenv("VECTOR_DIMENSION", 1536)),
             "vectorSearchProfile": vector_config_name
         })
 
@@ -266,6 +283,18 @@ def create_or_update_search_index(
         ]
         }
 
+        if vector_compression:
+            compression = {
+                "name": "my-compression-config-1",
+                "kind": VECTOR_COMPRESSIONS[vector_compression],
+                "rerankWithOriginalVectors": True,
+                "defaultOversampling": vector_oversampling
+            }
+            if vector_compression == "scalar":
+                compression["scalarQuantizationParameters"] = {"quantizedDataType": "int8"}
+            body["vectorSearch"]["compressions"] = [compression]
+            body["vectorSearch"]["profiles"][0]["compression"] = compression["name"]
+
     response = requests.put(url, json=body, headers=headers)
     if response.status_code == 201:
         print(f"Created search index {index_name}")
@@ -277,62 +306,97 @@ def create_or_update_search_index(
     return True
 
 
-def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential=None, upload_batch_size = 50, admin_key=None):
-    if credential is None and admin_key is None:
-        raise ValueError("credential and admin_key cannot be None")
-    
-    to_upload_dicts = []
-
-    id = 0
-    for d in docs:
-        if type(d) is not dict:
-            d = dataclasses.asdict(d)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(id)})
+def validate_vector_config(config):
+    """Checks the vector_dimensions and vector_compression of an index config."""
+    vector_dimensions = config.get("vector_dimensions")
+    embedding_dimensions = int(os.getenv("VECTOR_DIMENSION", 1536))
+    if vector_dimensions is not None and not 0 < vector_dimensions <= embedding_dimensions:
+        raise ValueError(f"vector_dimensions of index {config.get('index_name')} must be between 1 and the {embedding_dimensions} dimensions of the embeddings (VECTOR_DIMENSION), got {vector_dimensions}")
+    vector_compression = config.get("vector_compression")
+    if vector_compression is not None and vector_compression not in VECTOR_COMPRESSIONS:
+        raise ValueError(f"vector_compression of index {config.get('index_name')} must be one of {list(VECTOR_COMPRESSIONS)}, got {vector_compression}")
+
+def to_upload_dict(d, id, vector_dimensions=None):
+    # add id to documents
+    upload_fields = {"@search.action": "upload", "id": str(id)}
+    if type(d) is not dict:
+        d = d.to_dict(**upload_fields)
+    else:
+        d.update(upload_fields)
         if "contentVector" in d and d["contentVector"] is None:
             del d["contentVector"]
-        to_upload_dicts.append(d)
-        id += 1
-    
+    # the chunks may be shared with other indexes, only the uploaded dict gets the truncated vector
+    if vector_dimensions and "contentVector" in d:
+        d["contentVector"] = vector_to_list(truncate_vector(d["contentVector"], vector_dimensions))
+    return d
+
+
+def get_blob_chunk_id(blob_url, document):
+    """Returns a deterministic id for a chunk of a blob, from the blob url and the chunk position (metadata holds the chunk id),
+    so that the chunks of a blob chunked again overwrite its previous chunks."""
+    return hashlib.sha1(f"{blob_url}|{document.metadata}".encode("utf-8")).hexdigest()
+
+
+def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential=None, upload_batch_size = UPLOAD_MAX_BATCH_SIZE, admin_key=None,
+                              max_concurrency=4, progress_callback=None, first_id=0, batch_callback=None, vector_dimensions=None, ids=None):
+    if credential is None and admin_key is None:
+        raise ValueError("credential and admin_key cannot be None")
+
     endpoint = "https://{}.search.windows.net/".format(service_name)
     if not admin_key:
-        admin_key = json.loads(
-            subprocess.run(
-                f"az search admin-key show --subscription {subscription_id} --resource-group {resource_group} --service-name {service_name}",
-                shell=True,
-                capture_output=True,
-            ).stdout
-        )["primaryKey"]
-
-    search_client = SearchClient(
-        endpoint=endpoint,
-        index_name=index_name,
-        credential=AzureKeyCredential(admin_key),
-    )
-    # Upload the documents in batches of upload_batch_size
-    for i in tqdm(range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."):
-        batch = to_upload_dicts[i: i + upload_batch_size]
-        results = search_client.upload_documents(documents=batch)
-        num_failures = 0
-        errors = set()
-        for result in results:
-            if not result.succeeded:
-                print(f"Indexing Failed for {result.key} with ERROR: {result.error_message}")
-                num_failures += 1
-                errors.add(result.error_message)
-        if num_failures > 0:
-            raise Exception(f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
-                            f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}")
+        admin_key = get_search_admin_key(service_name, subscription_id, resource_group)
+
+    # docs are converted lazily, only the batches in flight are held as dicts. Without ids, they are numbered from first_id
+    if ids is None:
+        ids = itertools.count(first_id)
+    to_upload_dicts = (to_upload_dict(d, id, vector_dimensions) for id, d in zip(ids, docs))
+
+    progress = tqdm(total=len(docs) if hasattr(docs, "__len__") else None, desc="Indexing Chunks...")
+    def update_progress(num_succeeded, num_failed):
+        progress.update(num_succeeded + num_failed)
+        if progress_callback:
+            progress_callback(num_succeeded, num_failed)
+
+    async def upload():
+        async with AsyncSearchClient(endpoint=endpoint, index_name=index_name, credential=AzureKeyCredential(admin_key)) as search_client:
+            return await upload_documents_concurrently(search_client, to_upload_dicts, max_batch_size=upload_batch_size,
+                                                       max_concurrency=max_concurrency, progress_callback=update_progress,
+                                                       batch_callback=batch_callback)
+
+    # Upload the documents in batches of at most upload_batch_size, with max_concurrency batches in flight
+    with progress:
+        result = asyncio.run(upload())
+
+    if result.failed:
+        errors = set(result.failed.values())
+        raise Exception(f"INDEXING FAILED for {len(result.failed)} documents after {RETRY_COUNT} attempts. Re-running the upload will only overwrite existing documents. "
+                        f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}")
+    return result
+
+def delete_documents_from_index(service_name, subscription_id, resource_group, index_name, ids, credential=None, admin_key=None, batch_size=UPLOAD_MAX_BATCH_SIZE):
+    if credential is None and admin_key is None:
+        raise ValueError("credential and admin_key cannot be None")
+
+    endpoint = "https://{}.search.windows.net/".format(service_name)
+    if not admin_key:
+        admin_key = get_search_admin_key(service_name, subscription_id, resource_group)
+
+    async def delete():
+        failed = []
+        async with AsyncSearchClient(endpoint=endpoint, index_name=index_name, credential=AzureKeyCredential(admin_key)) as search_client:
+            for start in range(0, len(ids), batch_size):
+                # deleting a document that doesn't exist succeeds
+                results = await search_client.delete_documents(documents=[{"id": id} for id in ids[start:start + batch_size]])
+                failed.extend(f"{result.key}: {result.error_message}" for result in results if not result.succeeded)
+        return failed
+
+    failed = asyncio.run(delete())
+    if failed:
+        raise Exception(f"DELETING FAILED for {len(failed)} documents. Error Messages: {failed[:10]}")
 
 def validate_index(service_name, subscription_id, resource_group, index_name):
     api_version = "2024-03-01-Preview"
-    admin_key = json.loads(
-        subprocess.run(
-            f"az search admin-key show --subscription {subscription_id} --resource-group {resource_group} --service-name {service_name}",
-            shell=True,
-            capture_output=True,
-        ).stdout
-    )["primaryKey"]
+    admin_key = get_search_admin_key(service_name, subscription_id, resource_group)
 
     headers = {
         "Content-Type": "application/json", 
@@ -364,7 +428,21 @@ def validate_index(service_name, subscription_id, resource_group, index_name):
                 print(f"Request failed. Please investigate. Status code: {response.status_code}")
             break
 
-def create_index(config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, captioning_model_endpoint=None, captioning_model_key=None):
+def get_data_configs(config):
+    data_configs = []
+    if "data_path" in config:
+        data_configs.append({
+            "path": config["data_path"],
+            "url_prefix": config.get("url_prefix", None),
+        })
+    if "data_paths" in config:
+        data_configs.extend(config["data_paths"])
+    return data_configs
+
+def get_index_target(config):
+    return f"{config['search_service_name']}/{config['index_name']}"
+
+def prepare_search_index(config, credential):
     service_name = config["search_service_name"]
     subscription_id = config["subscription_id"]
     resource_group = config["resource_group"]
@@ -392,54 +470,195 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
 
     # create or update search index with compatible schema
     admin_key = os.environ.get("AZURE_SEARCH_ADMIN_KEY", None)
-    if not create_or_update_search_index(service_name, subscription_id, resource_group, index_name, config["semantic_config_name"], credential, language, vector_config_name=config.get("vector_config_name", None), admin_key=admin_key):
+    if not create_or_update_search_index(service_name, subscription_id, resource_group, index_name, config["semantic_config_name"], credential, language, vector_config_name=config.get("vector_config_name", None), admin_key=admin_key,
+                                         vector_dimensions=config.get("vector_dimensions"), vector_compression=config.get("vector_compression"),
+                                         vector_oversampling=config.get("vector_oversampling", VECTOR_DEFAULT_OVERSAMPLING)):
         raise Exception(f"Failed to create or update index {index_name}")
-    
-    data_configs = []
-    if "data_path" in config:
-        data_configs.append({
-            "path": config["data_path"],
-            "url_prefix": config.get("url_prefix", None),
-        })
-    if "data_paths" in config:
-        data_configs.extend(config["data_paths"])
 
-    for data_config in data_configs:
-        # chunk directory
-        print(f"Chunking path {data_config['path']}...")
-        add_embeddings = False
-        if config.get("vector_config_name") and embedding_model_endpoint:
-            add_embeddings = True
-
-        if "blob.core" in data_config["path"]:
-            result = chunk_blob_container(data_config["path"], credential=credential, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
+def chunk_data_path(data_config, config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, captioning_model_endpoint=None, captioning_model_key=None, compact_vectors=False, analyze_cache_dir=None, caption_cache_dir=None, blob_manifest=None, dedup_threshold=None, dedup_policy="keep-first", figure_store=None, figure_max_edge=FIGURE_MAX_EDGE, local_extraction=False):
+    # chunk directory
+    print(f"Chunking path {data_config['path']}...")
+    add_embeddings = False
+    if config.get("vector_config_name") and embedding_model_endpoint:
+        add_embeddings = True
+
+    if "blob.core" in data_config["path"]:
+        result = chunk_blob_container(data_config["path"], credential=credential, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
+                            azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
+                            add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"],
+                            compact_vectors=compact_vectors, analyze_cache_dir=analyze_cache_dir, blob_manifest=blob_manifest,
+                            dedup_threshold=dedup_threshold, dedup_policy=dedup_policy, figure_store=figure_store, figure_max_edge=figure_max_edge,
+                            local_extraction=local_extraction)
+    elif os.path.exists(data_config["path"]):
+        result = chunk_directory(data_config["path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
                                 azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                                add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"])
-        elif os.path.exists(data_config["path"]):
-            result = chunk_directory(data_config["path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
-                                    azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                                    add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"],
-                                    captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
-        else:
-            raise Exception(f"Path {data_config['path']} does not exist and is not a blob URL. Please check the path and try again.")
-
-        if len(result.chunks) == 0:
-            raise Exception("No chunks found. Please check the data path and chunk size.")
-
-        print(f"Processed {result.total_files} files")
-        print(f"Unsupported formats: {result.num_unsupported_format_files} files")
-        print(f"Files with errors: {result.num_files_with_errors} files")
-        print(f"Found {len(result.chunks)} chunks")
-
-        # upload documents to index
-        print("Uploading documents to index...")
-        upload_documents_to_index(service_name, subscription_id, resource_group, index_name, result.chunks, credential)
+                                add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"],
+                                captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key,
+                                compact_vectors=compact_vectors, analyze_cache_dir=analyze_cache_dir, caption_cache_dir=caption_cache_dir,
+                                dedup_threshold=dedup_threshold, dedup_policy=dedup_policy, figure_store=figure_store, figure_max_edge=figure_max_edge,
+                                local_extraction=local_extraction)
+    else:
+        raise Exception(f"Path {data_config['path']} does not exist and is not a blob URL. Please check the path and try again.")
+
+    print(f"Processed {result.total_files} files")
+    print(f"Unsupported formats: {result.num_unsupported_format_files} files")
+    print(f"Files with errors: {result.num_files_with_errors} files")
+    if dedup_threshold is not None:
+        print(f"Duplicate chunks dropped: {result.num_exact_duplicate_chunks} exact, {result.num_near_duplicate_chunks} near duplicates")
+    if local_extraction:
+        print(f"Extracted locally: {result.num_locally_extracted_files} files")
+    print(f"Found {len(result.chunks)} chunks")
+    return result
+
+def upload_chunking_result(config, result, credential, blob_manifest=None, first_id=0):
+    """Uploads the chunks of a data path to the index of the config.
+    With a blob manifest, only the changed blobs were chunked: their chunks get ids derived from the blob (see get_blob_chunk_id)
+    instead of being numbered from first_id, so they overwrite the previous chunks of the blob, and the previous chunks a blob
+    no longer has (recorded in the manifest) are deleted first. The chunks of the unchanged blobs are left as they are.
+    """
+    ids = None
+    stale_ids = []
+    if blob_manifest is not None:
+        ids = [get_blob_chunk_id(result.blob_urls[chunk.filepath], chunk) for chunk in result.chunks]
+        ids_by_blob = {blob_url: [] for blob_url in result.blob_urls.values()}
+        for chunk, id in zip(result.chunks, ids):
+            ids_by_blob[result.blob_urls[chunk.filepath]].append(id)
+        for blob_url, blob_ids in ids_by_blob.items():
+            stale_ids.extend(blob_manifest.replace_chunk_ids(blob_url, blob_ids))
+
+    if stale_ids:
+        print(f"Deleting {len(stale_ids)} previous chunks of changed blobs from index {config['index_name']}...")
+        delete_documents_from_index(config["search_service_name"], config["subscription_id"], config["resource_group"], config["index_name"], stale_ids, credential)
+    if len(result.chunks) == 0 and (result.num_unchanged_files or stale_ids):
+        print(f"{result.num_unchanged_files} files are unchanged since the last run, nothing to upload")
+        blob_manifest.save()
+        return
+    if len(result.chunks) == 0:
+        raise Exception("No chunks found. Please check the data path and chunk size.")
+
+    # upload documents to index
+    print(f"Uploading documents to index {config['index_name']}...")
+    upload_documents_to_index(config["search_service_name"], config["subscription_id"], config["resource_group"], config["index_name"], result.chunks, credential,
+                              first_id=first_id, vector_dimensions=config.get("vector_dimensions"), ids=ids)
+    if blob_manifest is not None:
+        blob_manifest.save()
+
+def create_index(config, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, captioning_model_endpoint=None, captioning_model_key=None, compact_vectors=False, analyze_cache_dir=None, caption_cache_dir=None, blob_manifest_dir=None, dedup_threshold=None, dedup_policy="keep-first", figure_store=None, figure_max_edge=FIGURE_MAX_EDGE, local_extraction=False):
+    prepare_search_index(config, credential)
+
+    # ids continue across data paths, so that the chunks of a path don't overwrite those of the previous ones
+    first_id = 0
+    for data_config in get_data_configs(config):
+        blob_manifest = None
+        if blob_manifest_dir and "blob.core" in data_config["path"]:
+            blob_manifest = BlobManifest(os.path.join(blob_manifest_dir, f"{config['index_name']}.json"))
+        result = chunk_data_path(data_config, config, credential, form_recognizer_client=form_recognizer_client, embedding_model_endpoint=embedding_model_endpoint,
+                                 use_layout=config.get("form_rec_use_layout", use_layout), njobs=njobs,
+                                 captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key, compact_vectors=compact_vectors,
+                                 analyze_cache_dir=analyze_cache_dir, caption_cache_dir=caption_cache_dir, blob_manifest=blob_manifest,
+                                 dedup_threshold=dedup_threshold, dedup_policy=dedup_policy, figure_store=figure_store, figure_max_edge=figure_max_edge,
+                                 local_extraction=local_extraction)
+        upload_chunking_result(config, result, credential, blob_manifest=blob_manifest, first_id=first_id)
+        first_id += len(result.chunks)
 
     # check if index is ready/validate index
     print("Validating index...")
-    validate_index(service_name, subscription_id, resource_group, index_name)
+    validate_index(config["search_service_name"], config["subscription_id"], config["resource_group"], config["index_name"])
     print("Index validation completed")
 
+def plan_chunking_jobs(configs, embedding_model_endpoint=None, use_layout=False, blob_manifest_dir=None):
+    """Groups the data paths of the index configs by chunking settings, so that data shared by several indexes is chunked once.
+    Returns:
+        List[Tuple[dict, dict, List[dict]]]: For each chunking job, the data config, the index config whose chunking settings
+            to use, and all the index configs the chunks are uploaded to.
+    """
+    jobs = {}
+    for config in configs:
+        add_embeddings = bool(config.get("vector_config_name") and embedding_model_endpoint)
+        for data_config in get_data_configs(config):
+            key = (data_config["path"], data_config.get("url_prefix"), config["chunk_size"], config.get("token_overlap", 0),
+                   config.get("form_rec_use_layout", use_layout), add_embeddings)
+            if blob_manifest_dir and "blob.core" in data_config["path"]:
+                # blob manifests are per index, each index chunks the blobs that changed since it was last updated
+                key += (get_index_target(config),)
+            jobs.setdefault(key, (data_config, config, []))[2].append(config)
+    return list(jobs.values())
+
+def create_indexes(configs, credential, form_recognizer_client=None, embedding_model_endpoint=None, use_layout=False, njobs=4, captioning_model_endpoint=None, captioning_model_key=None, compact_vectors=False, analyze_cache_dir=None, caption_cache_dir=None, blob_manifest_dir=None, max_parallel_indexes=4, dedup_threshold=None, dedup_policy="keep-first", figure_store=None, figure_max_edge=FIGURE_MAX_EDGE, local_extraction=False):
+    """Prepares all the indexes of the config, sharing the work they have in common.
+    Data paths used by several indexes with the same chunking settings are chunked once, and the Form Recognizer results of
+    paths chunked with different settings are shared through the analyze cache. The indexes are created, uploaded to and
+    validated concurrently (max_parallel_indexes at a time), while the chunking jobs run one after the other, each with njobs processes.
+    A timing report per stage and index is printed at the end.
+    """
+    timing_report = TimingReport()
+    jobs = plan_chunking_jobs(configs, embedding_model_endpoint, use_layout, blob_manifest_dir)
+    print(f"Chunking {len(jobs)} data paths for {len(configs)} indexes")
+
+    def timed(target, stage, fn, *args, **kwargs):
+        with timing_report.time(target, stage):
+            return fn(*args, **kwargs)
+
+    def upload_when_index_ready(index_future, config, data_config, result, blob_manifest, first_id):
+        index_future.result()
+        timed(get_index_target(config), f"upload {data_config['path']}", upload_chunking_result, config, result, credential, blob_manifest, first_id)
+
+    with tempfile.TemporaryDirectory() as run_analyze_cache_dir, ThreadPoolExecutor(max_workers=max_parallel_indexes) as executor:
+        data_paths = [data_config["path"] for data_config, _, _ in jobs]
+        if analyze_cache_dir is None and len(set(data_paths)) < len(data_paths):
+            analyze_cache_dir = run_analyze_cache_dir
+
+        index_futures = {}
+        for config in configs:
+            target = get_index_target(config)
+            if target not in index_futures:
+                index_futures[target] = executor.submit(timed, target, "create index", prepare_search_index, config, credential)
+
+        # the next id of each index, so that the chunks of a path don't overwrite those of the previous ones
+        next_ids = {target: 0 for target in index_futures}
+        upload_futures = {target: [] for target in index_futures}
+        # one manifest per index, shared by its data paths so that their uploads don't overwrite each other's entries
+        blob_manifests = {}
+        for data_config, chunking_config, job_configs in jobs:
+            blob_manifest = None
+            if blob_manifest_dir and "blob.core" in data_config["path"]:
+                manifest_path = os.path.join(blob_manifest_dir, f"{chunking_config['index_name']}.json")
+                if manifest_path not in blob_manifests:
+                    blob_manifests[manifest_path] = BlobManifest(manifest_path)
+                blob_manifest = blob_manifests[manifest_path]
+            result = timed(data_config["path"], f"chunk ({chunking_config['chunk_size']} tokens)", chunk_data_path, data_config, chunking_config, credential,
+                           form_recognizer_client=form_recognizer_client, embedding_model_endpoint=embedding_model_endpoint,
+                           use_layout=chunking_config.get("form_rec_use_layout", use_layout), njobs=njobs,
+                           captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key, compact_vectors=compact_vectors,
+                           analyze_cache_dir=analyze_cache_dir, caption_cache_dir=caption_cache_dir, blob_manifest=blob_manifest,
+                           dedup_threshold=dedup_threshold, dedup_policy=dedup_policy, figure_store=figure_store, figure_max_edge=figure_max_edge,
+                           local_extraction=local_extraction)
+            for config in job_configs:
+                target = get_index_target(config)
+                upload_futures[target].append(executor.submit(upload_when_index_ready, index_futures[target], config, data_config, result, blob_manifest, next_ids[target]))
+                next_ids[target] += len(result.chunks)
+
+        # each index is validated as soon as its uploads are done, a failed index doesn't stop the others
+        errors = []
+        validate_futures = []
+        for target, config in {get_index_target(config): config for config in configs}.items():
+            try:
+                index_futures[target].result()
+                for future in upload_futures[target]:
+                    future.result()
+            except Exception as e:
+                print(f"Data preparation for index {target} failed with error: {e}")
+                errors.append(e)
+                continue
+            validate_futures.append(executor.submit(timed, target, "validate", validate_index,
+                                                    config["search_service_name"], config["subscription_id"], config["resource_group"], config["index_name"]))
+        for future in validate_futures:
+            future.result()
+
+    timing_report.print_report()
+    if errors:
+        raise errors[0]
+
 
 def valid_range(n):
     n = int(n)
@@ -453,12 +672,24 @@ if __name__ == "__main__":
     parser.add_argument("--form-rec-resource", type=str, help="Name of your Form Recognizer resource to use for PDF cracking.")
     parser.add_argument("--form-rec-key", type=str, help="Key for your Form Recognizer resource to use for PDF cracking.")
     parser.add_argument("--form-rec-use-layout", default=True, action='store_true', help="Whether to use Layout model for PDF cracking, if False will use Read model.")
+    parser.add_argument("--form-rec-max-concurrency", type=int, default=4, help="Maximum number of Form Recognizer analyze operations in flight per job. Default=4")
+    parser.add_argument("--form-rec-pages-per-request", type=int, default=100, help="Large PDFs are split into page ranges of this many pages, analyzed concurrently. Default=100")
+    parser.add_argument("--form-rec-cache-dir", type=str, help="Directory to cache Form Recognizer results in. Files already in the cache are re-chunked without calling Form Recognizer.")
     parser.add_argument("--njobs", type=valid_range, default=4, help="Number of jobs to run (between 1 and 32). Default=4")
     parser.add_argument("--embedding-model-endpoint", type=str, help="Endpoint for the embedding model to use for vector search. Format: 'https://<AOAI resource name>.openai.azure.com/openai/deployments/<Ada deployment name>/embeddings?api-version=2024-03-01-Preview'")
     parser.add_argument("--embedding-model-key", type=str, help="Key for the embedding model to use for vector search.")
     parser.add_argument("--search-admin-key", type=str, help="Admin key for the search service. If not provided, will use Azure CLI to get the key.")
     parser.add_argument("--azure-openai-endpoint", type=str, help="Endpoint for the (Azure) OpenAI API. Format: 'https://<AOAI resource name>.openai.azure.com/openai/deployments/<vision model name>/chat/completions?api-version=2024-04-01-preview'")
     parser.add_argument("--azure-openai-key", type=str, help="Key for the (Azure) OpenAI API.")
+    parser.add_argument("--caption-cache-dir", type=str, help="Directory to cache image captions in. Images already in the cache are not sent to the captioning model again.")
+    parser.add_argument("--blob-manifest-dir", type=str, help="Directory to keep a manifest of the ingested blobs in (one per index). Blobs unchanged since the last run are skipped.")
+    parser.add_argument("--max-parallel-indexes", type=int, default=4, help="Maximum number of indexes of the config created and uploaded to concurrently. Default=4")
+    parser.add_argument("--dedup-threshold", type=float, help="Drop chunks that duplicate a previous chunk of the same data path before embedding and upload: exact duplicates, and near duplicates with a word shingle Jaccard similarity of at least this value (1.0 for exact duplicates only).")
+    parser.add_argument("--dedup-policy", type=str, default="keep-first", choices=DEDUP_POLICIES, help="keep-first drops the duplicate chunks, merge-urls also records their urls in the duplicate_urls of the kept chunk's metadata. Default=keep-first")
+    parser.add_argument("--figure-store", type=str, help="Local directory or blob container url to store the pdf figures and images in. The chunks then reference them by asset id (local) or blob url, instead of holding them as base64.")
+    parser.add_argument("--figure-max-edge", type=int, default=FIGURE_MAX_EDGE, help=f"Maximum number of pixels per edge of the pdf figures stored with --figure-store. Default={FIGURE_MAX_EDGE}")
+    parser.add_argument("--local-extraction", default=False, action='store_true', help="Extract the text of pdf, docx, pptx and xlsx files locally when possible, and only send scanned or layout critical documents to Form Recognizer.")
+    parser.add_argument("--compact-vectors", default=False, action='store_true', help="Keep embeddings as float32 buffers instead of lists of floats. Reduces memory use for large corpora.")
     args = parser.parse_args()
 
     with open(args.config) as f:
@@ -474,16 +705,21 @@ if __name__ == "__main__":
     if args.form_rec_resource and args.form_rec_key:
         os.environ["FORM_RECOGNIZER_ENDPOINT"] = f"https://{args.form_rec_resource}.cognitiveservices.azure.com/"
         os.environ["FORM_RECOGNIZER_KEY"] = args.form_rec_key
+        os.environ["FORM_RECOGNIZER_MAX_CONCURRENCY"] = str(args.form_rec_max_concurrency)
+        os.environ["FORM_RECOGNIZER_PAGES_PER_REQUEST"] = str(args.form_rec_pages_per_request)
         if args.njobs==1:
-            form_recognizer_client = DocumentIntelligenceClient(endpoint=f"https://{args.form_rec_resource}.cognitiveservices.azure.com/", credential=AzureKeyCredential(args.form_rec_key))
+            form_recognizer_client = DocumentAnalysisEngine(endpoint=f"https://{args.form_rec_resource}.cognitiveservices.azure.com/", credential=AzureKeyCredential(args.form_rec_key),
+                                                            max_concurrency=args.form_rec_max_concurrency, pages_per_request=args.form_rec_pages_per_request)
         print(f"Using Form Recognizer resource {args.form_rec_resource} for PDF cracking, with the {'Layout' if args.form_rec_use_layout else 'Read'} model.")
 
     for index_config in config:
-        print("Preparing data for index:", index_config["index_name"])
         if index_config.get("vector_config_name") and not args.embedding_model_endpoint:
             raise Exception("ERROR: Vector search is enabled in the config, but no embedding model endpoint and key were provided. Please provide these values or disable vector search.")
-    
-        create_index(index_config, credential, form_recognizer_client, embedding_model_endpoint=args.embedding_model_endpoint, use_layout=args.form_rec_use_layout, njobs=args.njobs, captioning_model_endpoint=args.azure_openai_endpoint, captioning_model_key=args.azure_openai_key)
-        print("Data preparation for index", index_config["index_name"], "completed")
+        validate_vector_config(index_config)
+
+    print("Preparing data for indexes:", ", ".join(index_config["index_name"] for index_config in config))
+    create_indexes(config, credential, form_recognizer_client, embedding_model_endpoint=args.embedding_model_endpoint, use_layout=args.form_rec_use_layout, njobs=args.njobs, captioning_model_endpoint=args.azure_openai_endpoint, captioning_model_key=args.azure_openai_key, compact_vectors=args.compact_vectors, analyze_cache_dir=args.form_rec_cache_dir, caption_cache_dir=args.caption_cache_dir, blob_manifest_dir=args.blob_manifest_dir,
+                   max_parallel_indexes=args.max_parallel_indexes, dedup_threshold=args.dedup_threshold, dedup_policy=args.dedup_policy,
+                   figure_store=args.figure_store, figure_max_edge=args.figure_max_edge, local_extraction=args.local_extraction)
 
     print(f"Data preparation script completed. {len(config)} indexes updated.")
\ No newline at end of file
@@ -1,20 +1,40 @@
 """Data utilities for index preparation."""
 import ast
+import asyncio
+import codecs
+import gzip
+import hashlib
 import html
+import html.parser
+import io
 import json
+import math
+import mmap
 import os
+import queue
+import random
 import re
 import ssl
 import subprocess
 import tempfile
+import threading
 import time
+import urllib.error
 import urllib.request
+import xml.etree.ElementTree as ET
+import zipfile
 from abc import ABC, abstractmethod
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
-from functools import partial
-from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Union
-from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
+from importlib.metadata import entry_points
+from itertools import accumulate
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Sequence, Tuple, Union
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult, DocumentTable
 import fitz
 import requests
 import base64
@@ -23,15 +43,25 @@ import markdown
 import requests
 import tiktoken
 from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ServiceRequestError
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import ContainerClient
+from azure.keyvault.secrets import SecretClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.storage.blob import ContainerClient, ContentSettings
 from bs4 import BeautifulSoup
+from markdown.treeprocessors import Treeprocessor
 from dotenv import load_dotenv
 from langchain.text_splitter import TextSplitter, MarkdownTextSplitter, RecursiveCharacterTextSplitter, PythonCodeTextSplitter
 from openai import AzureOpenAI
 from tqdm import tqdm
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Configure environment variables  
 load_dotenv() # take environment variables from .env.
 
@@ -45,6 +75,7 @@ FILE_FORMAT_DICT = {
         "pdf": "pdf",
         "docx": "docx",
         "pptx": "pptx",
+        "xlsx": "xlsx",
         "png": "png",
         "jpg": "jpg",
         "jpeg": "jpeg",
@@ -54,6 +85,69 @@ FILE_FORMAT_DICT = {
 
 RETRY_COUNT = 5
 
+# array typecode used for compact (float32) embeddings
+VECTOR_TYPECODE = "f"
+
+# compressions of the index vectors (scalarQuantization to int8, binaryQuantization to 1 bit per dimension), see create_or_update_search_index
+VECTOR_COMPRESSIONS = {"scalar": "scalarQuantization", "binary": "binaryQuantization"}
+# compressed vector searches retrieve this many times k candidates, and rerank them with the full precision vectors
+VECTOR_DEFAULT_OVERSAMPLING = 10.0
+
+# Azure AI Search accepts at most 1000 documents and 16 MB per indexing request
+UPLOAD_MAX_BATCH_SIZE = 1000
+UPLOAD_MAX_BATCH_BYTES = 16 * 1024 * 1024
+# request and per-document status codes that are worth retrying: throttling and transient service errors
+UPLOAD_RETRY_STATUS_CODES = {409, 422, 429, 503}
+
+# images sent for captioning are downscaled to fit this many pixels per edge, and re-encoded as jpeg
+CAPTION_MAX_IMAGE_EDGE = 1024
+CAPTION_JPEG_QUALITY = 85
+CAPTION_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# pdf figures stored in a figure store are rendered to fit this many pixels per edge
+FIGURE_MAX_EDGE = 1024
+# number of figures hashed and written (or uploaded) to the figure store concurrently
+FIGURE_STORE_MAX_WORKERS = 8
+
+# relative cost per byte of chunking each format, used to schedule the most expensive files first
+FILE_FORMAT_COSTS = {"pdf": 20, "docx": 10, "pptx": 10, "xlsx": 10, "png": 20, "jpg": 20, "jpeg": 20, "webp": 20}
+# files are grouped in tasks of about total cost / (njobs * CHUNKING_TASKS_PER_JOB), so that small files don't each pay a round trip to a worker
+CHUNKING_TASKS_PER_JOB = 16
+# number of slowest files reported after chunking a directory
+NUM_SLOWEST_FILES_REPORTED = 10
+
+# text files of at least this size are chunked as they are read, a block at a time, instead of as one string
+TEXT_STREAMING_MIN_BYTES = 16 * 1024 * 1024
+TEXT_STREAM_BLOCK_BYTES = 1024 * 1024
+# bytes of the start of a file (and around its first undecodable byte) that its encoding is detected from, when it isn't utf-8
+ENCODING_SAMPLE_BYTES = 64 * 1024
+
+# formats that are cracked into text by Document Intelligence, unless a local extractor can do it (see DocumentExtractor)
+DOCUMENT_INTELLIGENCE_FORMATS = ["pdf", "docx", "pptx", "xlsx"]
+# formats only chunked with local extraction: they were skipped as unsupported before it, so runs without it are unchanged
+LOCAL_EXTRACTION_ONLY_FORMATS = ["xlsx"]
+# entry point group of parser plugins: the entry point name is the file extension, the object a BaseParser or DocumentExtractor (class or instance)
+PARSER_ENTRY_POINT_GROUP = "data_preparation.parsers"
+# a pdf page with images and less text than this is taken to be scanned, and the pdf is sent to Document Intelligence
+PDF_SCANNED_PAGE_MAX_CHARS = 32
+# an xlsx sheet whose table (the rows and columns with values) has more cells than this is sent to Document Intelligence
+XLSX_MAX_SHEET_CELLS = 1000000
+
+# Document Intelligence API version the analyze results (and the analyze result cache) are keyed on
+DOCUMENT_INTELLIGENCE_API_VERSION = "2024-02-29-preview"
+# per page fields of analyze results that extract_pdf_content doesn't use, and that make up most of their size
+ANALYZE_CACHE_DROPPED_PAGE_FIELDS = ("words", "lines", "selectionMarks", "barcodes", "formulas")
+
+# chunks are compared as sets of word shingles of this many words, using MinHash signatures of this many hashes
+DEDUP_SHINGLE_SIZE = 5
+DEDUP_NUM_HASHES = 64
+# policies for the near duplicates of a chunk: drop them, or drop them and record their urls in the kept chunk's metadata
+DEDUP_POLICIES = ("keep-first", "merge-urls")
+# number of chunks embedded per request when chunks are embedded after deduplication
+EMBEDDING_BATCH_SIZE = 16
+# status codes of failed embedding requests that are worth retrying, other client errors fail right away
+EMBEDDING_RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
 SENTENCE_ENDINGS = [".", "!", "?"]
 WORDS_BREAKS = list(reversed([",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]))
 
@@ -64,13 +158,57 @@ PDF_HEADERS = {
     "sectionHeading": "h2"
 }
 
+URL_PATTERN = r"\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^()\s<>]+|\(([^()\s<>]+|(\([^()\s<>]+\)))*\))+(?:\(([^()\s<>]+|(\([^()\s<>]+\)))*\)|[^()\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
+IMG_PATTERN = r'<img\s+src="[^"]+"[^>]*>.*?</img>'
+# image tags are tried first, so a url inside an image caption stays part of the image
+URL_OR_IMG_REGEX = re.compile(f"(?P<img>(?s:{IMG_PATTERN}))|(?P<url>(?i:{URL_PATTERN}))")
+MASK_PLACEHOLDER_REGEX = re.compile(r"##(?:URL|IMG)\d+##")
+
+# token counts of strings up to this length are memoized: the splitters measure the same splits several times while merging
+TOKEN_COUNT_CACHE_SIZE = 2 ** 16
+TOKEN_COUNT_CACHE_MAX_CHARS = 16 * 1024
+
 class TokenEstimator(object):
     GPT2_TOKENIZER = tiktoken.get_encoding("gpt2")
 
     def estimate_tokens(self, text: Union[str, List]) -> int:
-
+        if isinstance(text, str) and len(text) <= TOKEN_COUNT_CACHE_MAX_CHARS:
+            return TokenEstimator._count_tokens_cached(text)
         return len(self.GPT2_TOKENIZER.encode(text, allowed_special="all"))
 
+    @staticmethod
+    @lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+    def _count_tokens_cached(text: str) -> int:
+        return len(TokenEstimator.GPT2_TOKENIZER.encode(text, allowed_special="all"))
+
+    def split_by_tokens(self, text: str, num_tokens: int) -> List[str]:
+        """Splits text into pieces of at most num_tokens tokens, encoding it only once.
+        Pieces are cut at token boundaries (moved back to the start of a character if a token ends inside one),
+        so joining the pieces gives back the original text.
+        Args:
+            text (str): The text to split.
+            num_tokens (int): The maximum number of tokens in each piece.
+        Returns:
+            List[str]: The pieces.
+        """
+        tokens = self.GPT2_TOKENIZER.encode(text, allowed_special="all")
+        if len(tokens) <= num_tokens:
+            return [text]
+
+        text_bytes = text.encode("utf-8")
+        token_ends = list(accumulate(len(token_bytes) for token_bytes in self.GPT2_TOKENIZER.decode_tokens_bytes(tokens)))
+        pieces = []
+        start = 0
+        for i in range(num_tokens, len(tokens), num_tokens):
+            end = token_ends[i - 1]
+            while end > start and (text_bytes[end] & 0xC0) == 0x80: # utf-8 continuation byte
+                end -= 1
+            if end > start:
+                pieces.append(text_bytes[start:end].decode("utf-8"))
+                start = end
+        pieces.append(text_bytes[start:].decode("utf-8"))
+        return pieces
+
     def construct_tokens_with_size(self, tokens: str, numofTokens: int) -> str:
         newTokens = self.GPT2_TOKENIZER.decode(
             self.GPT2_TOKENIZER.encode(tokens, allowed_special="all")[:numofTokens]
@@ -81,12 +219,15 @@ TOKEN_ESTIMATOR = TokenEstimator()
 
 class PdfTextSplitter(TextSplitter):
     def __init__(self, length_function: Callable[[str], int] =TOKEN_ESTIMATOR.estimate_tokens, separator: str = "\n\n", **kwargs: Any):
-        """Create a new TextSplitter for htmls from extracted pdfs."""
-        super().__init__(**kwargs)
+        """Create a new TextSplitter for htmls from extracted pdfs.
+        The pieces are split without overlap, chunk_overlap is applied when they are merged into chunks (see merge_chunks_serially)."""
+        self._token_overlap = kwargs.pop("chunk_overlap", 0)
+        super().__init__(chunk_overlap=0, **kwargs)
         self._table_tags = HTML_TABLE_TAGS
         self._separators = separator or ["\n\n", "\n", " ", ""]
         self._length_function = length_function
         self._noise = 50 # tokens to accommodate differences in token calculation, we don't want the chunking-on-the-fly to inadvertently chunk anything due to token calc mismatch
+        self._token_estimator = TOKEN_ESTIMATOR
 
     def extract_caption(self, text):
         separator = self._separators[-1]
@@ -118,33 +259,41 @@ class PdfTextSplitter(TextSplitter):
         return caption
     
     def mask_urls_and_imgs(self, text) -> Tuple[Dict[str, str], str]:
-
-        def find_urls(string):
-            regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^()\s<>]+|\(([^()\s<>]+|(\([^()\s<>]+\)))*\))+(?:\(([^()\s<>]+|(\([^()\s<>]+\)))*\)|[^()\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-            urls = re.findall(regex, string)
-            return [x[0] for x in urls]
-        
-        def find_imgs(string):
-            regex = r'(<img\s+src="[^"]+"[^>]*>.*?</img>)'
-            imgs = re.findall(regex, string, re.DOTALL)
-            return imgs
-        
+        """Replaces urls and image tags with placeholders (##URL<i>## / ##IMG<i>##) so they are never split.
+        Single pass over the text: the pieces between matches are collected and joined once.
+        Returns:
+            Tuple[Dict[str, str], str]: The placeholders mapped to what they replace, and the masked text.
+        """
         content_dict = {}
-        masked_text = text
-        urls = set(find_urls(text))
-
-        for i, url in enumerate(urls):
-            masked_text = masked_text.replace(url, f"##URL{i}##")
-            content_dict[f"##URL{i}##"] = url
-
-        imgs = set(find_imgs(text))
-        for i, img in enumerate(imgs):
-            masked_text = masked_text.replace(img, f"##IMG{i}##")
-            content_dict[f"##IMG{i}##"] = img
+        placeholders = {}
+        num_urls = 0
+        num_imgs = 0
+        parts = []
+        last_end = 0
+        for match in URL_OR_IMG_REGEX.finditer(text):
+            masked = match.group(0)
+            placeholder = placeholders.get(masked)
+            if placeholder is None:
+                if match.group("img") is not None:
+                    placeholder = f"##IMG{num_imgs}##"
+                    num_imgs += 1
+                else:
+                    placeholder = f"##URL{num_urls}##"
+                    num_urls += 1
+                placeholders[masked] = placeholder
+                content_dict[placeholder] = masked
+            parts.append(text[last_end:match.start()])
+            parts.append(placeholder)
+            last_end = match.end()
+        parts.append(text[last_end:])
 
-        return content_dict, masked_text
+        return content_dict, "".join(parts)
 
     def split_text(self, text: str) -> List[str]:
+        return [chunk for chunk, chunk_size in self.split_text_with_sizes(text)]
+
+    def split_text_with_sizes(self, text: str) -> List[Tuple[str, int]]:
+        """Splits the text like split_text, also returning the token count of each chunk (so callers don't count again)."""
         content_dict, masked_text = self.mask_urls_and_imgs(text)
         start_tag = self._table_tags["table_open"]
         end_tag = self._table_tags["table_close"]
@@ -169,9 +318,7 @@ class PdfTextSplitter(TextSplitter):
                 table_caption_prefix = ""
             
 
-        final_final_chunks = [chunk for chunk, chunk_size in merge_chunks_serially(final_chunks, self._chunk_size, content_dict)]
-
-        return final_final_chunks
+        return list(merge_chunks_serially(final_chunks, self._chunk_size, content_dict, token_overlap=self._token_overlap))
 
 
 
@@ -184,11 +331,11 @@ class PdfTextSplitter(TextSplitter):
             if _s in item:
                 separator = _s
                 break
+        if not separator:
+            # no separator left: cut by token offsets, encoding the text once instead of measuring every character
+            return self._token_estimator.split_by_tokens(item, self._chunk_size - self._noise)
         chunks = []
-        if separator:
-            splits = item.split(separator)
-        else:
-            splits = list(item)
+        splits = item.split(separator)
         _good_splits = []
         for s in splits:
             if self._length_function(s) < self._chunk_size - self._noise:
@@ -214,13 +361,21 @@ class PdfTextSplitter(TextSplitter):
                 headers += re.search("<th.*>.*</th>", table).group() # extract the header out. Opening tag may contain rowspan/colspan
             splits = table.split(self._table_tags["row_open"]) #split by row tag
             tables = []
+            table_tags = [self._table_tags["table_open"], self._table_tags["table_close"]]
+            # keep a running token count of the current table instead of re-tokenizing it on every row
+            new_table_prefix = "\n".join([caption, self._table_tags["table_open"], headers])
+            new_table_prefix_size = self._length_function(new_table_prefix)
             current_table = caption + "\n"
+            current_table_size = self._length_function(current_table)
             for part in splits:
                 if len(part)>0:
-                    if self._length_function(current_table + self._table_tags["row_open"] + part) < self._chunk_size: # if current table length is within permissible limit, keep adding rows
-                        if part not in [self._table_tags["table_open"], self._table_tags["table_close"]]: # need add the separator (row tag) when the part is not a table tag
-                            current_table += self._table_tags["row_open"]
-                        current_table += part
+                    row = self._table_tags["row_open"] + part
+                    row_size = self._length_function(row)
+                    # need add the separator (row tag) when the part is not a table tag
+                    addition, addition_size = (part, self._length_function(part)) if part in table_tags else (row, row_size)
+                    if current_table_size + row_size < self._chunk_size: # if current table length is within permissible limit, keep adding rows
+                        current_table += addition
+                        current_table_size += addition_size
                         
                     else:
                         
@@ -229,10 +384,8 @@ class PdfTextSplitter(TextSplitter):
                         tables.append(current_table)
 
                         # start a new table
-                        current_table = "\n".join([caption, self._table_tags["table_open"], headers])
-                        if part not in [self._table_tags["table_open"], self._table_tags["table_close"]]:
-                            current_table += self._table_tags["row_open"]
-                        current_table += part
+                        current_table = new_table_prefix + addition
+                        current_table_size = new_table_prefix_size + addition_size
 
             
             # TO DO: fix the case where the last mini table only contain tags
@@ -245,7 +398,49 @@ class PdfTextSplitter(TextSplitter):
             return tables
 
     
-@dataclass
+def to_compact_vector(vector: Optional[Sequence[float]]) -> Optional[Sequence[float]]:
+    """Converts an embedding to a packed float32 buffer.
+    A list of Python floats costs ~32 bytes per dimension, a packed buffer costs 4.
+    NumPy float32 arrays and array('f') are returned as they are.
+    Args:
+        vector (Sequence[float]): The embedding to convert.
+    Returns:
+        Sequence[float]: The embedding as array('f') (or the original float32 buffer).
+    """
+    if vector is None or isinstance(vector, array):
+        return vector
+    if np is not None and isinstance(vector, np.ndarray):
+        return vector if vector.dtype == np.float32 else vector.astype(np.float32)
+    return array(VECTOR_TYPECODE, vector)
+
+def vector_to_list(vector: Optional[Sequence[float]]) -> Optional[List[float]]:
+    """Returns the embedding as a list of floats, the only form json can serialize."""
+    if vector is None or isinstance(vector, list):
+        return vector
+    return vector.tolist()
+
+def truncate_vector(vector: Optional[Sequence[float]], dimensions: int) -> Optional[Sequence[float]]:
+    """Shortens the embedding of a Matryoshka model (e.g. text-embedding-3-small/large) to its first dimensions, rescaled to
+    unit length. This is what the embeddings API returns when asked for that many dimensions, so one embedding of the full
+    size can be uploaded to indexes of several sizes. Vectors of at most dimensions are returned as is.
+    Args:
+        vector (Sequence[float]): The embedding, a list of floats or a float32 buffer.
+        dimensions (int): The number of dimensions to keep.
+    Returns:
+        Sequence[float]: The truncated embedding, of the same kind as vector.
+    """
+    if vector is None or len(vector) <= dimensions:
+        return vector
+    if np is not None and isinstance(vector, np.ndarray):
+        head = vector[:dimensions].astype(np.float32)
+        return head / (np.linalg.norm(head) or 1.0)
+    head = vector[:dimensions]
+    norm = math.sqrt(sum(x * x for x in head)) or 1.0
+    if isinstance(vector, array):
+        return array(VECTOR_TYPECODE, (x / norm for x in head))
+    return [x / norm for x in head]
+
+@dataclass(slots=True)
 class Document(object):
     """A data class for storing documents
 
@@ -256,6 +451,9 @@ class Document(object):
         filepath (Optional[str]): The filepath of the document.
         url (Optional[str]): The url of the document.
         metadata (Optional[Dict]): The metadata of the document.    
+        contentVector (Optional[Sequence[float]]): The embedding, either a list of floats or a compact
+            float32 buffer (array('f') / numpy.float32), see to_compact_vector.
+        image_mapping (Optional[Dict]): The image tags in the content mapped to the image data.
     """
 
     content: str
@@ -264,9 +462,42 @@ class Document(object):
     filepath: Optional[str] = None
     url: Optional[str] = None
     metadata: Optional[Dict] = None
-    contentVector: Optional[List[float]] = None
+    contentVector: Optional[Sequence[float]] = None
     image_mapping: Optional[Dict] = None
 
+    def to_dict(self, **extra_fields) -> Dict[str, Any]:
+        """Returns the document as a json serializable dict.
+        Unlike dataclasses.asdict this makes a single shallow dict, the vector is the only field converted.
+        contentVector is left out when it is None.
+        Args:
+            extra_fields: Fields to add to (or override in) the dict, e.g. {"@search.action": "upload"}.
+        Returns:
+            Dict[str, Any]: The document fields.
+        """
+        d = {field_name: getattr(self, field_name) for field_name in DOCUMENT_FIELDS}
+        if self.contentVector is None:
+            del d["contentVector"]
+        else:
+            d["contentVector"] = vector_to_list(self.contentVector)
+        d.update(extra_fields)
+        return d
+
+DOCUMENT_FIELDS = tuple(document_field.name for document_field in fields(Document))
+
+def get_document_id(document: Document) -> str:
+    """Returns a deterministic id for a chunk, so re-running an ingestion overwrites chunks instead of duplicating them.
+    Chunks are identified by their file and position (metadata holds the chunk id), or by their content if they have no file.
+    Args:
+        document (Document): The chunk.
+    Returns:
+        str: The id.
+    """
+    if document.filepath is not None:
+        key = f"{document.filepath}|{document.url}|{document.metadata}"
+    else:
+        key = f"{document.url}|{document.content}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
 def cleanup_content(content: str) -> str:
     """Cleans up the given content using regexes
     Args:
@@ -280,6 +511,41 @@ def cleanup_content(content: str) -> str:
 
     return output.strip()
 
+# a block of content can be cut between two of these characters without changing how it is cleaned up
+CLEANUP_UNSAFE_CHARACTER_REGEX = re.compile(r"[\s-]")
+
+def cleanup_content_blocks(blocks: Iterable[str]) -> Generator[str, None, None]:
+    """Cleans up content given in blocks. The blocks cleaned up are cut where no run of newlines, spaces or dashes is split,
+    so that they join into cleanup_content of the whole content.
+    Args:
+        blocks (Iterable[str]): The consecutive blocks of the content.
+    Returns:
+        Generator[str]: The cleaned up blocks.
+    """
+    pending = ""
+    is_start = True
+    for block in blocks:
+        text = pending + block
+        cut = len(text) - 1
+        while cut > 0 and (CLEANUP_UNSAFE_CHARACTER_REGEX.match(text, cut - 1) or CLEANUP_UNSAFE_CHARACTER_REGEX.match(text, cut)):
+            cut -= 1
+        if cut <= 0:
+            pending = text
+            continue
+        output = re.sub(r"\n{2,}", "\n", text[:cut])
+        output = re.sub(r"[^\S\n]{2,}", " ", output)
+        output = re.sub(r"-{2,}", "--", output)
+        if is_start:
+            output = output.lstrip()
+            is_start = not output
+        pending = text[cut:]
+        if output:
+            yield output
+    # after a cut, the rest starts with a character that isn't whitespace, so only its end is stripped
+    output = cleanup_content(pending)
+    if output:
+        yield output
+
 class BaseParser(ABC):
     """A parser parses content to produce a document."""
 
@@ -318,12 +584,110 @@ class BaseParser(ABC):
                 documents.append(self.parse_file(file_path))
         return documents
 
+class HTMLTitleExtractor(html.parser.HTMLParser):
+    """Finds the string of the first <title> of an html document without building the document tree, when the title is
+    only text. The document is tokenized by html.parser, as BeautifulSoup(content, 'html.parser') does, up to the end of the title.
+    """
+    TITLE_TAG_REGEX = re.compile("<title", re.IGNORECASE)
+
+    class Done(Exception):
+        pass
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.in_title = False
+        self.parts = []
+        self.title = None
+
+    def extract(self, content: str) -> Optional[str]:
+        """Returns the string of the first <title>, or None if there is none or it holds anything but text (tags, character
+        references, comments...), which BeautifulSoup handles its own way."""
+        if not self.TITLE_TAG_REGEX.search(content):
+            return None
+        try:
+            self.feed(content)
+            self.close()
+        except HTMLTitleExtractor.Done:
+            pass
+        return self.title
+
+    def stop(self):
+        if self.in_title:
+            raise HTMLTitleExtractor.Done()
+
+    def handle_starttag(self, tag, attrs):
+        self.stop()
+        self.in_title = tag == "title"
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == "title":
+            raise HTMLTitleExtractor.Done()
+        self.stop()
+
+    def handle_endtag(self, tag):
+        # BeautifulSoup collapses whitespace only strings
+        if self.in_title and tag == "title" and "".join(self.parts).strip():
+            self.title = "".join(self.parts)
+        self.stop()
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.parts.append(data)
+
+    def handle_charref(self, name):
+        self.stop()
+
+    def handle_entityref(self, name):
+        self.stop()
+
+    def handle_comment(self, data):
+        self.stop()
+
+    def handle_decl(self, data):
+        self.stop()
+
+    def handle_pi(self, data):
+        self.stop()
+
+    def unknown_decl(self, data):
+        self.stop()
+
+class MarkdownTitleTreeprocessor(Treeprocessor):
+    """Keeps the element tree of the converted markdown, to read the title from it instead of parsing the html output."""
+
+    def run(self, root):
+        self.root = root
+
 class MarkdownParser(BaseParser):
     """Parses Markdown content."""
+    EXTENSIONS = ['fenced_code', 'toc', 'tables', 'sane_lists']
 
     def __init__(self) -> None:
         super().__init__()
         self._html_parser = HTMLParser()
+        # one converter per thread, reset between documents instead of loading the extensions for each one
+        self._local = threading.local()
+
+    def _get_converter(self) -> Tuple[markdown.Markdown, MarkdownTitleTreeprocessor]:
+        if not hasattr(self._local, "converter"):
+            converter = markdown.Markdown(extensions=self.EXTENSIONS)
+            title_treeprocessor = MarkdownTitleTreeprocessor(converter)
+            # runs last, once the inline markup and escapes are resolved
+            converter.treeprocessors.register(title_treeprocessor, "title", -100)
+            self._local.converter = (converter, title_treeprocessor)
+        return self._local.converter
+
+    def _get_title(self, root) -> Optional[Tuple[Optional[str], bool]]:
+        """Reads the title from the element tree as HTMLParser would from the html: there is no <title> in converted markdown,
+        so it is the text of the first <h1> or <h2>, else the first string."""
+        for heading in ("h1", "h2"):
+            element = next(root.iter(heading), None)
+            if element is not None:
+                title = "".join(text.strip() for text in element.itertext())
+                if title:
+                    return title, False
+                break
+        return next((text.strip() for text in root.itertext() if text.strip()), None), True
 
     def parse(self, content: str, file_name: Optional[str] = None) -> Document:
         """Parses the given content.
@@ -333,9 +697,21 @@ class MarkdownParser(BaseParser):
         Returns:
             Document: The parsed document.
         """
-        html_content = markdown.markdown(content, extensions=['fenced_code', 'toc', 'tables', 'sane_lists'])
+        converter, title_treeprocessor = self._get_converter()
+        converter.reset()
+        # the tree isn't built for blank content
+        title_treeprocessor.root = None
+        html_content = converter.convert(content)
 
-        return self._html_parser.parse(html_content, file_name)
+        # raw html (and fenced code) is kept aside from the tree and put back in the output, then only the output has the whole document
+        title = None
+        if title_treeprocessor.root is not None and not converter.htmlStash.html_counter:
+            title = self._get_title(title_treeprocessor.root)
+            if title is not None and title[0] is not None and (markdown.util.STX in title[0] or markdown.util.ETX in title[0]):
+                title = None
+        if title is None:
+            return self._html_parser.parse(html_content, file_name)
+        return self._html_parser.make_document(html_content, file_name, *title)
 
 
 class HTMLParser(BaseParser):
@@ -355,6 +731,14 @@ class HTMLParser(BaseParser):
         Returns:
             Document: The parsed document.
         """
+        # a plain text <title> is found without building the document tree, see HTMLTitleExtractor
+        title = HTMLTitleExtractor().extract(content)
+        if title is not None:
+            return self.make_document(content, file_name, title, False)
+        return self.make_document(content, file_name, *self._get_soup_title(content))
+
+    def _get_soup_title(self, content: str) -> Tuple[Optional[str], bool]:
+        """Returns the title, from the document tree, and whether it is the first string of the document."""
         soup = BeautifulSoup(content, 'html.parser')
 
         # Extract the title
@@ -370,16 +754,18 @@ class HTMLParser(BaseParser):
                 h2_tag = soup.find('h2')
                 if h2_tag:
                     title = h2_tag.get_text(strip=True)
-        if title is None or title == '':
-            # if title is still not found, guess using the next string
-            try:
-                title = next(soup.stripped_strings)
-                title = self.token_estimator.construct_tokens_with_size(title, self.TITLE_MAX_TOKENS)
-
-            except StopIteration:
+        if title:
+            return str(title), False
+        # if title is still not found, guess using the next string
+        return next(soup.stripped_strings, None), True
+
+    def make_document(self, content: str, file_name: Optional[str], title: Optional[str], is_first_string: bool) -> Document:
+        if is_first_string:
+            # the title was guessed from the first string of the document
+            if title is None:
                 title = file_name
-
-                # Helper function to process text nodes
+            else:
+                title = self.token_estimator.construct_tokens_with_size(title, self.TITLE_MAX_TOKENS)
 
         # Parse the content as it is without any formatting changes
         result = content
@@ -426,6 +812,20 @@ class TextParser(BaseParser):
 
         return Document(content=cleanup_content(content), title=title or file_name)
 
+    def get_title(self, lines: Iterable[str], file_name: Optional[str] = None, property: str = "title: ") -> Optional[str]:
+        """Returns the title parse gives the content of the lines, in one pass over them (see TextFileReader.lines)."""
+        first_alphanum_line = None
+        for line in lines:
+            if property is not None and line.startswith(property):
+                title = line[len(property) :].strip()
+                if title:
+                    return title
+                # only the first line with the property counts
+                property = None
+            if first_alphanum_line is None and any(c.isalnum() for c in line):
+                first_alphanum_line = line.strip()
+        return first_alphanum_line or file_name
+
 
 class PythonParser(BaseParser):
     def _get_topdocstring(self, text):
@@ -455,7 +855,312 @@ class ImageParser(BaseParser):
     def parse(self, content: str, file_name: Optional[str] = None) -> Document:
         return Document(content=content, title=file_name)
 
+class DocumentExtractor(ABC):
+    """Extracts the text of a binary document (pdf, docx...) locally, in the format of extract_pdf_content: with use_layout,
+    headers are marked as html headers (see PDF_HEADERS) and tables are html tables.
+    Documents that need Document Intelligence, e.g. scanned pages or layout that can't be recovered locally, are routed to it.
+    """
+
+    @abstractmethod
+    def extract(self, file_path: str, use_layout: bool = False) -> Optional[str]:
+        """Extracts the text of the document.
+        Args:
+            file_path (str): The document to extract.
+            use_layout (bool): If true, headers and tables are marked as html, as with the Layout model.
+        Returns:
+            str: The text of the document, or None if the document should be sent to Document Intelligence instead.
+        """
+        pass
+
+    @staticmethod
+    def header(text: str, role: str, use_layout: bool) -> str:
+        return f"<{PDF_HEADERS[role]}>{text}</{PDF_HEADERS[role]}>" if use_layout else text
+
+    @staticmethod
+    def table(rows: List[List[Tuple[str, int, int]]], use_layout: bool) -> str:
+        """Returns the table, given as rows of (text, column span, row span) cells, as html with use_layout, else as lines of text."""
+        if not use_layout:
+            return "\n".join(" ".join(text for text, _, _ in row if text) for row in rows)
+        cells = []
+        for row_index, row in enumerate(rows):
+            for column_index, (text, column_span, row_span) in enumerate(row):
+                cells.append({"rowIndex": row_index, "columnIndex": column_index, "content": text, "columnSpan": column_span, "rowSpan": row_span})
+        return table_to_html(DocumentTable({"rowCount": len(rows), "columnCount": max((len(row) for row in rows), default=0), "cells": cells}))
+
+class OfficeOpenXmlExtractor(DocumentExtractor):
+    """Base of the extractors of Office Open XML documents (docx, pptx, xlsx): zip archives of xml parts.
+    These are born digital, so their text is always extracted locally, unless there is none (e.g. a docx of scanned images).
+    """
+    NAMESPACES = {
+        "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+        "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+        "p": "http://schemas.openxmlformats.org/presentationml/2006/main",
+        "s": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+        "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+        "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+    }
+
+    @classmethod
+    def qname(cls, name: str) -> str:
+        prefix, local_name = name.split(":")
+        return f"{{{cls.NAMESPACES[prefix]}}}{local_name}"
+
+    @classmethod
+    def read_part(cls, archive: zipfile.ZipFile, part_name: str) -> Optional[ET.Element]:
+        try:
+            return ET.fromstring(archive.read(part_name))
+        except KeyError:
+            return None
+
+    @classmethod
+    def read_relationships(cls, archive: zipfile.ZipFile, part_name: str) -> Dict[str, str]:
+        """Returns the targets of the relationships of the part, as part names, by relationship id."""
+        directory, name = os.path.split(part_name)
+        relationships = cls.read_part(archive, f"{directory}/_rels/{name}.rels")
+        if relationships is None:
+            return {}
+        targets = {}
+        for relationship in relationships.iter(cls.qname("rel:Relationship")):
+            target = relationship.get("Target", "")
+            targets[relationship.get("Id")] = target.lstrip("/") if target.startswith("/") else os.path.normpath(f"{directory}/{target}").replace(os.sep, "/")
+        return targets
+
+    def extract(self, file_path: str, use_layout: bool = False) -> Optional[str]:
+        with zipfile.ZipFile(file_path) as archive:
+            text = self.extract_archive(archive, use_layout)
+        return text if text.strip() else None
+
+    @abstractmethod
+    def extract_archive(self, archive: zipfile.ZipFile, use_layout: bool) -> str:
+        pass
+
+class DocxExtractor(OfficeOpenXmlExtractor):
+    """Extracts the paragraphs and tables of a docx, in document order. Title and heading styles are the headers."""
+
+    def paragraph_text(self, paragraph: ET.Element) -> str:
+        parts = []
+        for element in paragraph.iter():
+            if element.tag == self.qname("w:t"):
+                parts.append(element.text or "")
+            elif element.tag == self.qname("w:tab"):
+                parts.append("\t")
+            elif element.tag in (self.qname("w:br"), self.qname("w:cr")):
+                parts.append("\n")
+        return "".join(parts)
+
+    def paragraph_role(self, paragraph: ET.Element) -> Optional[str]:
+        style = paragraph.find("w:pPr/w:pStyle", self.NAMESPACES)
+        style_id = style.get(self.qname("w:val"), "").lower() if style is not None else ""
+        if style_id == "title":
+            return "title"
+        if style_id.startswith("heading"):
+            return "sectionHeading"
+        return None
+
+    def table_rows(self, table: ET.Element) -> List[List[Tuple[str, int, int]]]:
+        rows = []
+        # cells vertically merged into the cell above them are dropped, and the row span of the cell above is extended
+        merge_starts = {}
+        for row in table.findall("w:tr", self.NAMESPACES):
+            cells = []
+            column = 0
+            for cell in row.findall("w:tc", self.NAMESPACES):
+                properties = cell.find("w:tcPr", self.NAMESPACES)
+                grid_span = properties.find("w:gridSpan", self.NAMESPACES) if properties is not None else None
+                column_span = int(grid_span.get(self.qname("w:val"), 1)) if grid_span is not None else 1
+                vertical_merge = properties.find("w:vMerge", self.NAMESPACES) if properties is not None else None
+                if vertical_merge is not None and vertical_merge.get(self.qname("w:val")) != "restart" and column in merge_starts:
+                    row_index, cell_index = merge_starts[column]
+                    text, start_column_span, row_span = rows[row_index][cell_index]
+                    rows[row_index][cell_index] = (text, start_column_span, row_span + 1)
+                else:
+                    text = "\n".join(self.paragraph_text(paragraph) for paragraph in cell.iter(self.qname("w:p")))
+                    merge_starts[column] = (len(rows), len(cells))
+                    cells.append((text, column_span, 1))
+                column += column_span
+            rows.append(cells)
+        return rows
+
+    def block_elements(self, parent: ET.Element) -> Generator[ET.Element, None, None]:
+        # paragraphs and tables can be wrapped in content controls
+        for element in parent:
+            if element.tag == self.qname("w:sdt"):
+                content = element.find("w:sdtContent", self.NAMESPACES)
+                if content is not None:
+                    yield from self.block_elements(content)
+            else:
+                yield element
+
+    def extract_archive(self, archive: zipfile.ZipFile, use_layout: bool) -> str:
+        document = self.read_part(archive, "word/document.xml")
+        body = document.find("w:body", self.NAMESPACES) if document is not None else None
+        if body is None:
+            return ""
+        parts = []
+        for element in self.block_elements(body):
+            if element.tag == self.qname("w:p"):
+                text = self.paragraph_text(element)
+                role = self.paragraph_role(element)
+                parts.append(self.header(text, role, use_layout) if role and text.strip() else text)
+            elif element.tag == self.qname("w:tbl"):
+                parts.append(self.table(self.table_rows(element), use_layout))
+        return "\n".join(parts)
+
+class PptxExtractor(OfficeOpenXmlExtractor):
+    """Extracts the text of the shapes and tables of each slide of a pptx, in slide order. Slide titles are the headers."""
+
+    def paragraphs_text(self, element: ET.Element) -> str:
+        paragraphs = []
+        for paragraph in element.iter(self.qname("a:p")):
+            parts = []
+            for child in paragraph.iter():
+                if child.tag == self.qname("a:t"):
+                    parts.append(child.text or "")
+                elif child.tag == self.qname("a:br"):
+                    parts.append("\n")
+            paragraphs.append("".join(parts))
+        return "\n".join(paragraphs)
+
+    def table_rows(self, table: ET.Element) -> List[List[Tuple[str, int, int]]]:
+        rows = []
+        for row in table.findall("a:tr", self.NAMESPACES):
+            cells = []
+            for cell in row.findall("a:tc", self.NAMESPACES):
+                # cells covered by a merged cell are flagged, the merged cell holds the text and the spans
+                if cell.get("hMerge") == "1" or cell.get("vMerge") == "1":
+                    continue
+                cells.append((self.paragraphs_text(cell), int(cell.get("gridSpan", 1)), int(cell.get("rowSpan", 1))))
+            rows.append(cells)
+        return rows
+
+    def slide_text(self, slide: ET.Element, use_layout: bool) -> str:
+        parts = []
+        shape_tree = slide.find("p:cSld/p:spTree", self.NAMESPACES)
+        if shape_tree is None:
+            return ""
+        for shape in shape_tree.iter():
+            if shape.tag == self.qname("p:sp"):
+                text = self.paragraphs_text(shape)
+                if not text.strip():
+                    continue
+                placeholder = shape.find("p:nvSpPr/p:nvPr/p:ph", self.NAMESPACES)
+                placeholder_type = placeholder.get("type") if placeholder is not None else None
+                if placeholder_type in ("title", "ctrTitle"):
+                    parts.append(self.header(text, "title" if placeholder_type == "ctrTitle" else "sectionHeading", use_layout))
+                else:
+                    parts.append(text)
+            elif shape.tag == self.qname("a:tbl"):
+                parts.append(self.table(self.table_rows(shape), use_layout))
+        return "\n".join(parts)
+
+    def extract_archive(self, archive: zipfile.ZipFile, use_layout: bool) -> str:
+        presentation_part = "ppt/presentation.xml"
+        presentation = self.read_part(archive, presentation_part)
+        if presentation is None:
+            return ""
+        targets = self.read_relationships(archive, presentation_part)
+        slides = []
+        for slide_id in presentation.iterfind("p:sldIdLst/p:sldId", self.NAMESPACES):
+            slide = self.read_part(archive, targets.get(slide_id.get(self.qname("r:id")), ""))
+            if slide is not None:
+                slides.append(self.slide_text(slide, use_layout))
+        return "\n".join(slides)
+
+class XlsxExtractor(OfficeOpenXmlExtractor):
+    """Extracts the cell values of each sheet of an xlsx as a table, in sheet order. Sheet names are the headers.
+    Workbooks with a sheet of more than XLSX_MAX_SHEET_CELLS cells are sent to Document Intelligence."""
+    CELL_REFERENCE_REGEX = re.compile(r"([A-Z]+)(\d+)")
+
+    def rich_text(self, element: ET.Element) -> str:
+        return "".join(text.text or "" for text in element.iter(self.qname("s:t")))
+
+    @staticmethod
+    def column_index(column: str) -> int:
+        index = 0
+        for letter in column:
+            index = index * 26 + ord(letter) - ord("A") + 1
+        return index - 1
+
+    def sheet_rows(self, sheet: ET.Element, shared_strings: List[str]) -> Optional[List[List[Tuple[str, int, int]]]]:
+        """Returns the table of the sheet: its rows and columns with values, or None if it has more than XLSX_MAX_SHEET_CELLS cells."""
+        values = {}
+        for row_position, row in enumerate(sheet.iterfind("s:sheetData/s:row", self.NAMESPACES)):
+            row_index = int(row.get("r", row_position + 1)) - 1
+            for column_position, cell in enumerate(row.findall("s:c", self.NAMESPACES)):
+                match = self.CELL_REFERENCE_REGEX.match(cell.get("r", ""))
+                column_index = self.column_index(match.group(1)) if match else column_position
+                cell_type = cell.get("t")
+                if cell_type == "inlineStr":
+                    inline_string = cell.find("s:is", self.NAMESPACES)
+                    text = self.rich_text(inline_string) if inline_string is not None else ""
+                else:
+                    value = cell.find("s:v", self.NAMESPACES)
+                    text = (value.text or "") if value is not None else ""
+                    if cell_type == "s" and text:
+                        try:
+                            text = shared_strings[int(text)]
+                        except (ValueError, IndexError):
+                            # a corrupt shared string index is an empty cell
+                            text = ""
+                    elif cell_type == "b":
+                        text = "TRUE" if text == "1" else "FALSE"
+                if text:
+                    values[row_index, column_index] = text
+        # empty rows and columns are left out, so that a few far apart cells don't make a huge table
+        row_indexes = sorted({row_index for row_index, _ in values})
+        column_indexes = sorted({column_index for _, column_index in values})
+        if len(row_indexes) * len(column_indexes) > XLSX_MAX_SHEET_CELLS:
+            return None
+        return [[(values.get((row_index, column_index), ""), 1, 1) for column_index in column_indexes] for row_index in row_indexes]
+
+    def extract_archive(self, archive: zipfile.ZipFile, use_layout: bool) -> str:
+        workbook_part = "xl/workbook.xml"
+        workbook = self.read_part(archive, workbook_part)
+        if workbook is None:
+            return ""
+        targets = self.read_relationships(archive, workbook_part)
+        shared_strings_part = self.read_part(archive, "xl/sharedStrings.xml")
+        shared_strings = [self.rich_text(item) for item in shared_strings_part.iterfind("s:si", self.NAMESPACES)] if shared_strings_part is not None else []
+        parts = []
+        for sheet_entry in workbook.iterfind("s:sheets/s:sheet", self.NAMESPACES):
+            sheet = self.read_part(archive, targets.get(sheet_entry.get(self.qname("r:id")), ""))
+            rows = self.sheet_rows(sheet, shared_strings) if sheet is not None else []
+            if rows is None:
+                # no text routes the workbook to Document Intelligence
+                return ""
+            if rows:
+                parts.append(self.header(sheet_entry.get("name", ""), "sectionHeading", use_layout))
+                parts.append(self.table(rows, use_layout))
+        return "\n".join(parts)
+
+class PdfExtractor(DocumentExtractor):
+    """Extracts the text layer of a pdf with PyMuPDF. Pdfs with pages that may need OCR (no text layer, or images and next to
+    no text) are sent to Document Intelligence, and so are pdfs with figures or tables when using layout, since their layout
+    can't be recovered locally.
+    """
+
+    def extract(self, file_path: str, use_layout: bool = False) -> Optional[str]:
+        pages = []
+        with fitz.open(file_path) as document:
+            for page in document:
+                page_text = page.get_text()
+                page_chars = len(page_text.strip())
+                has_images = bool(page.get_images(full=False))
+                # a page without text may be scanned, or have its text drawn as vector paths
+                if page_chars == 0 or (has_images and page_chars < PDF_SCANNED_PAGE_MAX_CHARS):
+                    return None
+                if use_layout and (has_images or page.find_tables().tables):
+                    return None
+                pages.append(page_text)
+        # pages are separated by a space, as in assemble_pdf_text
+        text = " ".join(pages) + " "
+        return text if text.strip() else None
+
 class ParserFactory:
+    """Registry of the parsers by file format, and of the extractors of binary formats. Parsers and extractors of other
+    formats can be added with register, or installed as plugins: entry points of the PARSER_ENTRY_POINT_GROUP group,
+    named after the file extension they handle.
+    """
     def __init__(self):
         self._parsers = {
             "html": HTMLParser(),
@@ -468,12 +1173,43 @@ class ParserFactory:
             "gif": ImageParser(),
             "webp": ImageParser()
         }
+        self._extractors = {
+            "pdf": PdfExtractor(),
+            "docx": DocxExtractor(),
+            "pptx": PptxExtractor(),
+            "xlsx": XlsxExtractor()
+        }
+        self.load_plugins()
 
     @property
     def supported_formats(self) -> List[str]:
         "Returns a list of supported formats"
         return list(self._parsers.keys())
 
+    def register(self, file_format: str, parser: Union[BaseParser, DocumentExtractor], extensions: Optional[List[str]] = None):
+        """Registers the parser (or extractor) of the format, and the file extensions of the format (by default the format itself).
+        A parser parses the text of the files, an extractor extracts the text of binary files, that is then chunked as a cracked pdf.
+        """
+        if isinstance(parser, DocumentExtractor):
+            self._extractors[file_format] = parser
+        elif isinstance(parser, BaseParser):
+            self._parsers[file_format] = parser
+        else:
+            raise TypeError(f"The parser of {file_format} must be a BaseParser or a DocumentExtractor, not {type(parser).__name__}")
+        for extension in extensions or [file_format]:
+            FILE_FORMAT_DICT[extension] = file_format
+
+    def load_plugins(self):
+        for entry_point in entry_points(group=PARSER_ENTRY_POINT_GROUP):
+            try:
+                plugin = entry_point.load()
+                self.register(entry_point.name, plugin() if isinstance(plugin, type) else plugin)
+            except Exception as e:
+                print(f"Failed to load parser plugin {entry_point.name} ({entry_point.value}): {e}")
+
+    def get_extractor(self, file_format: str) -> Optional[DocumentExtractor]:
+        return self._extractors.get(file_format, None)
+
     def __call__(self, file_format: str) -> BaseParser:
         parser = self._parsers.get(file_format, None)
         if parser is None:
@@ -498,6 +1234,12 @@ class ChunkingResult:
         num_unsupported_format_files (int): Number of files with unsupported format.
         num_files_with_errors (int): Number of files with errors.
         skipped_chunks (int): Number of chunks skipped.
+        num_unchanged_files (int): Number of files skipped because they are unchanged since the last run.
+        num_exact_duplicate_chunks (int): Number of chunks dropped because they are identical to a previous chunk.
+        num_near_duplicate_chunks (int): Number of chunks dropped because they are near duplicates of a previous chunk.
+        num_locally_extracted_files (int): Number of pdf, docx, pptx and xlsx files extracted locally instead of by Document Intelligence.
+        file_seconds (Dict[str, float]): Time spent chunking each file, to find the slow documents.
+        blob_urls (Dict[str, str]): The url of the blob of each chunked file (by filepath), set by chunk_blob_container.
     """
     chunks: List[Document]
     total_files: int
@@ -505,6 +1247,16 @@ class ChunkingResult:
     num_files_with_errors: int = 0
     # some chunks might be skipped to small number of tokens
     skipped_chunks: int = 0
+    # files that were not chunked again since they didn't change since the last run
+    num_unchanged_files: int = 0
+    file_seconds: Dict[str, float] = field(default_factory=dict)
+    # chunks dropped by deduplication, see ChunkDeduplicator
+    num_exact_duplicate_chunks: int = 0
+    num_near_duplicate_chunks: int = 0
+    # files extracted by a DocumentExtractor, see chunk_file
+    num_locally_extracted_files: int = 0
+    # blobs chunked by chunk_blob_container, to identify their chunks
+    blob_urls: Dict[str, str] = field(default_factory=dict)
 
 def extractStorageDetailsFromUrl(url):
     matches = re.fullmatch(r'https:\/\/([^\/.]*)\.blob\.core\.windows\.net\/([^\/]*)\/(.*)', url)
@@ -532,6 +1284,102 @@ def downloadBlobUrlToLocalFolder(blob_url, local_folder, credential):
             stream = blob_client.download_blob()
             local_file.write(stream.readall())
 
+class BlobManifest:
+    """Records the ETag and Content-MD5 of the ingested blobs in a json file, so that unchanged blobs can be skipped on the next run.
+    The ids of the chunks uploaded for each blob are recorded too, so that the chunks a changed blob no longer has can be deleted."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.blobs = {}
+        # the manifest of an index is shared by the uploads of its data paths, which can run concurrently
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.blobs = json.load(f)
+
+    @staticmethod
+    def get_blob_version(blob) -> Dict[str, Optional[str]]:
+        content_md5 = blob.content_settings.content_md5 if blob.content_settings else None
+        return {
+            "etag": blob.etag,
+            "content_md5": base64.b64encode(content_md5).decode("ascii") if content_md5 else None,
+        }
+
+    def is_unchanged(self, blob_url: str, blob_version: Dict[str, Optional[str]]) -> bool:
+        ingested_version = self.blobs.get(blob_url)
+        if ingested_version is None:
+            return False
+        # the md5 also matches when identical content was uploaded again (new etag)
+        if blob_version["content_md5"] and blob_version["content_md5"] == ingested_version.get("content_md5"):
+            return True
+        return blob_version["etag"] == ingested_version.get("etag")
+
+    def update(self, blob_url: str, blob_version: Dict[str, Optional[str]]):
+        # the chunk ids of the previous version are kept until replace_chunk_ids
+        with self._lock:
+            chunk_ids = self.blobs.get(blob_url, {}).get("chunk_ids", [])
+            self.blobs[blob_url] = dict(blob_version, chunk_ids=chunk_ids)
+
+    def replace_chunk_ids(self, blob_url: str, chunk_ids: List[str]) -> List[str]:
+        """Records the ids of the chunks uploaded for a blob.
+        Returns:
+            List[str]: The ids of the previous chunks of the blob that are not in chunk_ids, to delete from the index.
+        """
+        with self._lock:
+            entry = self.blobs.setdefault(blob_url, {})
+            previous_ids = entry.get("chunk_ids", [])
+            entry["chunk_ids"] = chunk_ids
+        kept_ids = set(chunk_ids)
+        return [chunk_id for chunk_id in previous_ids if chunk_id not in kept_ids]
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with self._lock:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.blobs, f, indent=1)
+            os.replace(temp_path, self.path)
+
+def download_blob_to_file(container_client: ContainerClient, blob_name: str, destination_path: str) -> str:
+    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+    with open(file=destination_path, mode='wb') as local_file:
+        # streams the blob to the file in chunks instead of reading it all in memory
+        container_client.download_blob(blob_name).readinto(local_file)
+    return destination_path
+
+def read_ndjson(file_path: str, start_offset: int = 0, read_ahead: int = 1000) -> Generator[Tuple[int, Dict], None, None]:
+    """Streams the documents of an NDJSON file, parsed by a reader thread that stays at most read_ahead documents ahead.
+    Args:
+        file_path (str): The NDJSON file.
+        start_offset (int): The byte offset to start reading at, e.g. to resume.
+        read_ahead (int): The maximum number of parsed documents buffered.
+    Returns:
+        Generator[Tuple[int, Dict]]: The byte offset right after each document, and the document.
+    """
+    buffer = queue.Queue(maxsize=read_ahead)
+    end_of_file = object()
+
+    def read():
+        try:
+            with open(file_path, "rb") as f:
+                f.seek(start_offset)
+                for line in iter(f.readline, b""):
+                    if line.strip():
+                        buffer.put((f.tell(), json.loads(line)))
+            buffer.put(end_of_file)
+        except Exception as e:
+            buffer.put(e)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is end_of_file:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
 def get_files_recursively(directory_path: str) -> List[str]:
     """Gets all files in the given directory recursively.
     Args:
@@ -570,7 +1418,13 @@ def _get_file_format(file_name: str, extensions_to_process: List[str]) -> Option
 
 def table_to_html(table):
     table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    # cells are bucketed by row in one pass, instead of scanning all the cells for each row
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        row_index = cell.row_index
+        if 0 <= row_index < table.row_count:
+            rows[row_index].append(cell)
+    rows = [sorted(row_cells, key=lambda cell: cell.column_index) for row_cells in rows]
     for row_cells in rows:
         table_html += "<tr>"
         for cell in row_cells:
@@ -590,77 +1444,387 @@ def polygon_to_bbox(polygon, dpi=72):
     x1, y1 = max(x_coords)*dpi, max(y_coords)*dpi
     return x0, y0, x1, y1
 
-def extract_pdf_content(file_path, form_recognizer_client, use_layout=False): 
-    offset = 0
-    page_map = []
-    model = "prebuilt-layout" if use_layout else "prebuilt-read"
-    
-    base64file = base64.b64encode(open(file_path, "rb").read()).decode()
-    poller = form_recognizer_client.begin_analyze_document(model, AnalyzeDocumentRequest(bytes_source=base64file))
-    form_recognizer_results = poller.result()
+def split_pdf_pages(file_path: str, pages_per_range: int) -> List[Tuple[int, bytes]]:
+    """Splits a pdf into smaller pdfs of at most pages_per_range pages.
+    Args:
+        file_path (str): The pdf to split.
+        pages_per_range (int): The maximum number of pages of each part.
+    Returns:
+        List[Tuple[int, bytes]]: The (0-based) first page of each part and its content.
+    """
+    with fitz.open(file_path) as pdf:
+        if pdf.page_count <= pages_per_range:
+            return [(0, pdf.tobytes())]
+        page_ranges = []
+        for first_page in range(0, pdf.page_count, pages_per_range):
+            with fitz.open() as part:
+                part.insert_pdf(pdf, from_page=first_page, to_page=min(first_page + pages_per_range, pdf.page_count) - 1)
+                page_ranges.append((first_page, part.tobytes()))
+        return page_ranges
+
+def _shift_analyze_result(node, content_offset: int, page_offset: int, element_counts: Dict[str, int]):
+    # moves spans, page numbers and element pointers (e.g. "/paragraphs/3") of a page range result to their place in the whole document
+    # only the top level index of a pointer moves, what follows it (e.g. "/tables/2/cells/5") is within that element
+    if isinstance(node, list):
+        for item in node:
+            _shift_analyze_result(item, content_offset, page_offset, element_counts)
+    elif isinstance(node, MutableMapping):
+        for key in list(node.keys()):
+            value = node[key]
+            if key in ("spans", "span"):
+                for span in (value if isinstance(value, list) else [value]):
+                    span["offset"] += content_offset
+            elif key == "pageNumber":
+                node[key] = value + page_offset
+            elif key == "elements" and isinstance(value, list):
+                shifted = []
+                for pointer in value:
+                    parts = pointer.split("/")
+                    if len(parts) >= 3 and parts[2].isdigit():
+                        parts[2] = str(int(parts[2]) + element_counts.get(parts[1], 0))
+                    shifted.append("/".join(parts))
+                node[key] = shifted
+            else:
+                _shift_analyze_result(value, content_offset, page_offset, element_counts)
+
+def merge_analyze_results(page_range_results: List[Tuple[int, Any]]) -> Any:
+    """Stitches the analyze results of the page ranges of a document back into one result, as if it had been analyzed whole.
+    Contents are joined with a newline and the spans, page numbers and element pointers of each range are offset accordingly.
+    Args:
+        page_range_results (List[Tuple[int, AnalyzeResult]]): The (0-based) first page of each range and its result.
+    Returns:
+        AnalyzeResult: The merged result (the first range's result, extended in place).
+    """
+    page_range_results = sorted(page_range_results, key=lambda page_range_result: page_range_result[0])
+    first_page, merged = page_range_results[0]
+    if first_page:
+        _shift_analyze_result([merged[key] for key in merged.keys() if isinstance(merged[key], list)], 0, first_page, {})
+    for first_page, result in page_range_results[1:]:
+        content_offset = len(merged["content"]) + 1
+        element_counts = {key: len(merged[key]) for key in merged.keys() if isinstance(merged[key], list)}
+        list_keys = [key for key in result.keys() if isinstance(result[key], list)]
+        _shift_analyze_result([result[key] for key in list_keys], content_offset, first_page, element_counts)
+        merged["content"] = merged["content"] + "\n" + result["content"]
+        for key in list_keys:
+            if isinstance(merged.get(key), list):
+                merged[key].extend(result[key])
+            else:
+                merged[key] = result[key]
+    return merged
+
+class DocumentAnalysisEngine:
+    """Analyzes documents with Document Intelligence, splitting large pdfs into page ranges that are analyzed concurrently.
+    The long running operations are polled with asyncio, so waiting on them doesn't hold a thread, and at most
+    max_concurrency analyze operations are in flight against the endpoint (per engine, i.e. per process).
+    Can be used everywhere a form_recognizer_client is accepted.
+    """
+
+    def __init__(self, endpoint: str, credential, max_concurrency: int = 4, pages_per_request: int = 100, polling_interval: int = 2, headers: Optional[Dict[str, str]] = None,
+                 api_version: str = DOCUMENT_INTELLIGENCE_API_VERSION):
+        self.endpoint = endpoint
+        self.credential = credential
+        self.api_version = api_version
+        self.max_concurrency = max_concurrency
+        self.pages_per_request = pages_per_request
+        self.polling_interval = polling_interval
+        self.headers = headers or {"x-ms-useragent": "sample-app-aoai-chatgpt/1.0.0"}
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # a semaphore belongs to one event loop, analyze() runs a new loop for each document
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def analyze_async(self, file_path: str, model_id: str):
+        """Analyzes the given file with the given model (e.g. prebuilt-layout).
+        Returns:
+            AnalyzeResult: The result, with the page ranges of large pdfs stitched back together.
+        """
+        if file_path.endswith(".pdf"):
+            page_ranges = split_pdf_pages(file_path, self.pages_per_request)
+        else:
+            with open(file_path, "rb") as f:
+                page_ranges = [(0, f.read())]
+        semaphore = self._get_semaphore()
+
+        async with AsyncDocumentIntelligenceClient(endpoint=self.endpoint, credential=self.credential, headers=self.headers, api_version=self.api_version) as client:
+            async def analyze_page_range(first_page: int, content: bytes):
+                async with semaphore:
+                    request = AnalyzeDocumentRequest(bytes_source=base64.b64encode(content).decode())
+                    poller = await client.begin_analyze_document(model_id, request, polling_interval=self.polling_interval)
+                    return first_page, await poller.result()
+
+            results = await asyncio.gather(*(analyze_page_range(first_page, content) for first_page, content in page_ranges))
+        return merge_analyze_results(results)
+
+    def analyze(self, file_path: str, model_id: str):
+        return asyncio.run(self.analyze_async(file_path, model_id))
+
+def get_file_hash(file_path: str, block_size: int = 1024 * 1024) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def get_api_version(form_recognizer_client) -> str:
+    if isinstance(form_recognizer_client, DocumentAnalysisEngine):
+        return form_recognizer_client.api_version
+    return getattr(getattr(form_recognizer_client, "_config", None), "api_version", None) or DOCUMENT_INTELLIGENCE_API_VERSION
+
+class AnalyzeResultCache:
+    """On disk cache of Document Intelligence analyze results, keyed by file hash, model id and API version.
+    Results are stored as gzipped json at <cache_dir>/<model_id>/<api_version>/<file hash>.json.gz, without the
+    per page words and lines, so re-chunking a document with other settings doesn't analyze it again.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def get_path(self, file_hash: str, model_id: str, api_version: str) -> str:
+        return os.path.join(self.cache_dir, model_id, api_version, f"{file_hash}.json.gz")
+
+    def get(self, file_hash: str, model_id: str, api_version: str):
+        path = self.get_path(file_hash, model_id, api_version)
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return AnalyzeResult(json.load(f))
+
+    def put(self, file_hash: str, model_id: str, api_version: str, result):
+        result = result.as_dict()
+        for page in result.get("pages", []):
+            for page_field in ANALYZE_CACHE_DROPPED_PAGE_FIELDS:
+                page.pop(page_field, None)
+        path = self.get_path(file_hash, model_id, api_version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so that concurrent workers never read a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp_path, path)
+
+def analyze_document(file_path: str, form_recognizer_client, model_id: str, analyze_result_cache: Optional[AnalyzeResultCache] = None):
+    """Runs the Document Intelligence model on the given file, with either a DocumentAnalysisEngine or a DocumentIntelligenceClient.
+    Args:
+        file_path (str): The file to analyze.
+        form_recognizer_client: The client to use. Can be None if the result is in the cache.
+        model_id (str): The model to use, prebuilt-layout or prebuilt-read.
+        analyze_result_cache (AnalyzeResultCache): Optional cache to read the result from, and to store it in.
+    Returns:
+        AnalyzeResult: The analyze result.
+    """
+    if analyze_result_cache is not None:
+        file_hash = get_file_hash(file_path)
+        api_version = get_api_version(form_recognizer_client)
+        cached_result = analyze_result_cache.get(file_hash, model_id, api_version)
+        if cached_result is not None:
+            return cached_result
+
+    if isinstance(form_recognizer_client, DocumentAnalysisEngine):
+        result = form_recognizer_client.analyze(file_path, model_id)
+    elif hasattr(form_recognizer_client, "begin_analyze_document"):
+        base64file = base64.b64encode(open(file_path, "rb").read()).decode()
+        poller = form_recognizer_client.begin_analyze_document(model_id, AnalyzeDocumentRequest(bytes_source=base64file))
+        result = poller.result()
+    else:
+        raise UnsupportedFormatError(f"form_recognizer_client is required for {os.path.basename(file_path)}, which is not in the analyze result cache")
+
+    if analyze_result_cache is not None:
+        analyze_result_cache.put(file_hash, model_id, api_version, result)
+    return result
+
+class FigureAssetStore(ABC):
+    """Stores figure images out of band, so that chunks reference them instead of carrying them as base64 data urls.
+    Images are content addressed (named by the sha256 of their bytes), so an image repeated across pages and documents
+    is stored once. Thread safe.
+    """
+
+    def __init__(self, max_workers: int = FIGURE_STORE_MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # asset name -> reference, for the images already stored by this process
+        self.stored = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_asset_name(image_bytes: bytes, file_ext: str) -> str:
+        return f"{hashlib.sha256(image_bytes).hexdigest()}.{file_ext}"
 
-    # (if using layout) mark all the positions of headers
+    @abstractmethod
+    def store(self, asset_name: str, image_bytes: bytes, file_ext: str) -> str:
+        """Stores the image under asset_name unless it is stored already, and returns its reference."""
+
+    def put(self, image_bytes: bytes, file_ext: str = "jpg") -> str:
+        """Stores the image and returns the reference the chunks hold for it."""
+        asset_name = self.get_asset_name(image_bytes, file_ext)
+        with self.lock:
+            reference = self.stored.get(asset_name)
+        if reference is None:
+            reference = self.store(asset_name, image_bytes, file_ext)
+            with self.lock:
+                self.stored[asset_name] = reference
+        return reference
+
+    def put_many(self, images: List[Tuple[bytes, str]]) -> List[str]:
+        """Stores the (image bytes, format) pairs concurrently, returning their references in order."""
+        return list(self.executor.map(lambda image: self.put(*image), images))
+
+class LocalFigureAssetStore(FigureAssetStore):
+    """Stores the images as files of a local directory. The reference of an image is its asset id, the file name in the directory."""
+
+    def __init__(self, directory: str, max_workers: int = FIGURE_STORE_MAX_WORKERS):
+        super().__init__(max_workers)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def store(self, asset_name: str, image_bytes: bytes, file_ext: str) -> str:
+        path = os.path.join(self.directory, asset_name)
+        if not os.path.exists(path):
+            # write then rename, so that concurrent workers never read a partial file
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(image_bytes)
+            os.replace(temp_path, path)
+        return asset_name
+
+class BlobFigureAssetStore(FigureAssetStore):
+    """Stores the images as blobs under the given container url (and optional folder). The reference of an image is its blob url."""
+
+    def __init__(self, blob_url: str, credential, max_workers: int = FIGURE_STORE_MAX_WORKERS):
+        super().__init__(max_workers)
+        (storage_account, container_name, path) = extractStorageDetailsFromUrl(blob_url if blob_url.count("/") > 3 else blob_url + "/")
+        self.container_url = f"https://{storage_account}.blob.core.windows.net/{container_name}"
+        self.container_client = ContainerClient.from_container_url(self.container_url, credential=credential)
+        self.prefix = path if not path or path.endswith("/") else path + "/"
+
+    def store(self, asset_name: str, image_bytes: bytes, file_ext: str) -> str:
+        blob_name = self.prefix + asset_name
+        content_type = "image/jpeg" if file_ext in ("jpg", "jpeg") else f"image/{file_ext}"
+        try:
+            self.container_client.upload_blob(blob_name, image_bytes, content_settings=ContentSettings(content_type=content_type))
+        except ResourceExistsError:
+            # same name, same content
+            pass
+        return f"{self.container_url}/{blob_name}"
+
+@lru_cache(maxsize=None)
+def get_figure_asset_store(figure_store: str) -> FigureAssetStore:
+    """Returns the figure store of this process for figure_store, a local directory or a blob container (folder) url."""
+    if "blob.core" in figure_store:
+        return BlobFigureAssetStore(figure_store, DefaultAzureCredential())
+    return LocalFigureAssetStore(figure_store)
+
+def get_header_tags(paragraphs) -> Dict[int, str]:
+    """Returns the html header tags to insert in the analyzed content, by offset: the opening tag at the start of title and
+    section heading paragraphs and the closing tag at their end (an opening tag goes before a closing one at the same offset)."""
     roles_start = {}
     roles_end = {}
-    for paragraph in form_recognizer_results.paragraphs:
+    for paragraph in paragraphs or []:
         if paragraph.role!=None:
             para_start = paragraph.spans[0].offset
             para_end = paragraph.spans[0].offset + paragraph.spans[0].length
             roles_start[para_start] = paragraph.role
             roles_end[para_end] = paragraph.role
 
-    for page_num, page in enumerate(form_recognizer_results.pages):
-        page_offset = page.spans[0].offset
-        page_length = page.spans[0].length
-
-        if use_layout:
-            tables_on_page = []
-            for table in form_recognizer_results.tables:
-                # If the table is empty, the span is empty, so we skip it
-                if len(table.spans) > 0:
-                    table_offset = table.spans[0].offset
-                    table_length = table.spans[0].length
-                    if page_offset <= table_offset and table_offset + table_length < page_offset + page_length:
-                        tables_on_page.append(table)
+    header_tags = {}
+    for position, role in roles_start.items():
+        if role in PDF_HEADERS:
+            header_tags[position] = f"<{PDF_HEADERS[role]}>"
+    for position, role in roles_end.items():
+        if role in PDF_HEADERS:
+            header_tags[position] = header_tags.get(position, "") + f"</{PDF_HEADERS[role]}>"
+    return header_tags
+
+def get_table_segments(page_offset: int, page_end: int, tables_on_page) -> List[Tuple[int, int, int]]:
+    """Returns the (start, end, table id) intervals of the page covered by the spans of its tables, in order.
+    Where spans of several tables overlap, the table listed last covers the interval."""
+    intervals = []
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            start = max(span.offset, page_offset)
+            end = min(span.offset + span.length, page_end)
+            if start < end:
+                intervals.append((start, end, table_id))
+    if not intervals:
+        return []
+
+    segments = []
+    boundaries = sorted({boundary for start, end, _ in intervals for boundary in (start, end)})
+    for start, end in zip(boundaries, boundaries[1:]):
+        table_ids = [table_id for span_start, span_end, table_id in intervals if span_start <= start and end <= span_end]
+        if not table_ids:
+            continue
+        table_id = max(table_ids)
+        if segments and segments[-1][1] == start and segments[-1][2] == table_id:
+            segments[-1] = (segments[-1][0], end, table_id)
         else:
-            tables_on_page = []
-
-        # (if using layout) mark all positions of the table spans in the page
-        table_chars = [-1]*page_length
-        for table_id, table in enumerate(tables_on_page):
-            for span in table.spans:
-                # replace all table spans with "table_id" in table_chars array
-                for i in range(span.length):
-                    idx = span.offset - page_offset + i
-                    if idx >=0 and idx < page_length:
-                        table_chars[idx] = table_id
-
-        # build page text by replacing charcters in table spans with table html and replace the characters corresponding to headers with html headers, if using layout
-        page_text = ""
+            segments.append((start, end, table_id))
+    return segments
+
+def assemble_pdf_text(form_recognizer_results, use_layout: bool = False) -> str:
+    """Builds the text of the analyzed document page by page, each page followed by a space.
+    If using layout, title and section heading paragraphs are wrapped in html headers, and the tables starting
+    and ending on a page replace their text with their html, at the position of their first character.
+    Pages are assembled from slices of the content between the header and table boundaries, which are sorted once.
+    Args:
+        form_recognizer_results (AnalyzeResult): The result of the Read or Layout model.
+        use_layout (bool): Whether the result is from the Layout model.
+    Returns:
+        str: The text of the document.
+    """
+    content = form_recognizer_results.content
+    header_tags = get_header_tags(form_recognizer_results.paragraphs)
+    header_positions = sorted(header_tags)
+
+    # the tables with a span, by offset of their first span (and document order, which decides overlaps)
+    tables = []
+    if use_layout:
+        tables = sorted((table.spans[0].offset, table_index, table)
+                        for table_index, table in enumerate(form_recognizer_results.tables or []) if len(table.spans) > 0)
+    table_offsets = [table_offset for table_offset, _, _ in tables]
+
+    def add_text(parts, start, end):
+        i = bisect_left(header_positions, start)
+        while i < len(header_positions) and header_positions[i] < end:
+            position = header_positions[i]
+            parts.append(content[start:position])
+            parts.append(header_tags[position])
+            start = position
+            i += 1
+        parts.append(content[start:end])
+
+    parts = []
+    for page in form_recognizer_results.pages:
+        page_offset = page.spans[0].offset
+        page_end = page_offset + page.spans[0].length
+
+        tables_starting_on_page = sorted(tables[bisect_left(table_offsets, page_offset):bisect_left(table_offsets, page_end)], key=lambda table: table[1])
+        tables_on_page = [table for table_offset, _, table in tables_starting_on_page if table_offset + table.spans[0].length < page_end]
+
+        position = page_offset
         added_tables = set()
-        for idx, table_id in enumerate(table_chars):
-            if table_id == -1:
-                position = page_offset + idx
-                if position in roles_start.keys():
-                    role = roles_start[position]
-                    if role in PDF_HEADERS:
-                        page_text += f"<{PDF_HEADERS[role]}>"
-                if position in roles_end.keys():
-                    role = roles_end[position]
-                    if role in PDF_HEADERS:
-                        page_text += f"</{PDF_HEADERS[role]}>"
-
-                page_text += form_recognizer_results.content[page_offset + idx]
-                
-            elif not table_id in added_tables:
-                page_text += table_to_html(tables_on_page[table_id])
+        for start, end, table_id in get_table_segments(page_offset, page_end, tables_on_page):
+            add_text(parts, position, start)
+            if table_id not in added_tables:
+                parts.append(table_to_html(tables_on_page[table_id]))
                 added_tables.add(table_id)
+            position = end
+        add_text(parts, position, page_end)
+        parts.append(" ")
+
+    return "".join(parts)
 
-        page_text += " "
-        page_map.append((page_num, offset, page_text))
-        offset += len(page_text)
+def extract_pdf_content(file_path, form_recognizer_client, use_layout=False, analyze_result_cache=None, captioning_engine=None, figure_asset_store=None, figure_max_edge=FIGURE_MAX_EDGE): 
+    model = "prebuilt-layout" if use_layout else "prebuilt-read"
+    
+    form_recognizer_results = analyze_document(file_path, form_recognizer_client, model, analyze_result_cache)
 
-    full_text = "".join([page_text for _, _, page_text in page_map])
+    # the text of the pages, with the headers and tables as html if using layout
+    full_text = assemble_pdf_text(form_recognizer_results, use_layout)
 
     # Extract any images
     image_mapping = {}
@@ -668,7 +1832,21 @@ def extract_pdf_content(file_path, form_recognizer_client, use_layout=False):
     if "figures" in form_recognizer_results.keys() and file_path.endswith(".pdf"):
         document = fitz.open(file_path)
 
+        figure_images = []
         for figure in form_recognizer_results["figures"]:
+            # Identify the text that corresponds to the figure
+            replace_start = figure["spans"][0]["offset"]
+            replace_end = figure["spans"][0]["offset"] + figure["spans"][0]["length"]
+
+            # Sometimes the figure doesn't correspond to any text, in which case we skip it
+            if replace_start == replace_end:
+                continue
+            
+            original_text = form_recognizer_results.content[replace_start:replace_end]
+
+            if original_text not in full_text:
+                continue
+
             bounding_box = figure.bounding_regions[0]
 
             page_number = bounding_box['pageNumber'] - 1  # Page numbers in PyMuPDF start from 0
@@ -682,77 +1860,137 @@ def extract_pdf_content(file_path, form_recognizer_client, use_layout=False):
                 zoom = 2.0
             else:
                 zoom = 1.0 
+            # stored figures are kept within figure_max_edge pixels per edge, the base64 data urls are rendered as before
+            if figure_asset_store is not None:
+                zoom = min(zoom, figure_max_edge / max(bbox.width, bbox.height, 1))
             mat = fitz.Matrix(zoom, zoom)
             image = page.get_pixmap(matrix=mat, clip=bbox)
+            figure_images.append((original_text, image.tobytes(output='jpg')))
 
-            # Save the extracted image to a base64 string
-            image_data = image.tobytes(output='jpg')
-            image_base64 = base64.b64encode(image_data).decode("utf-8")
-            image_base64 = f"data:image/jpg;base64,{image_base64}"
+        # (if captioning) describe the figures, concurrently, and keep the recognized text after the caption
+        if captioning_engine is not None and figure_images:
+            captions = captioning_engine.caption_many([(image_data, "jpeg") for _, image_data in figure_images])
+        else:
+            captions = [None] * len(figure_images)
 
-            # Identify the text that corresponds to the figure
-            replace_start = figure["spans"][0]["offset"]
-            replace_end = figure["spans"][0]["offset"] + figure["spans"][0]["length"]
+        # (if using a figure store) the chunks reference the stored images, instead of holding them as base64 data urls
+        # PyMuPDF can't render from several threads, the figures are only hashed and stored concurrently
+        if figure_asset_store is not None:
+            image_references = figure_asset_store.put_many([(image_data, "jpg") for _, image_data in figure_images])
+        else:
+            image_references = [f"data:image/jpg;base64,{base64.b64encode(image_data).decode('utf-8')}" for _, image_data in figure_images]
 
-            # Sometimes the figure doesn't correspond to any text, in which case we skip it
-            if replace_start == replace_end:
-                continue
-            
+        for (original_text, _), caption, image_reference in zip(figure_images, captions, image_references):
             # Now we get the image tag
-            original_text = form_recognizer_results.content[replace_start:replace_end]
-
-            if original_text not in full_text:
-                continue
-            
-            img_tag = image_content_to_tag(original_text)
+            img_tag = image_content_to_tag(f"{caption}\n{original_text}" if caption else original_text)
             
             # We replace only the first occurrence of the original text
             full_text = full_text.replace(original_text, img_tag, 1)
-            image_mapping[img_tag] = image_base64
+            image_mapping[img_tag] = image_reference
 
     return full_text, image_mapping
 
-def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, content_dict: Dict[str, str]={}) -> Generator[Tuple[str, int], None, None]:
-    def unmask_urls_and_imgs(text, content_dict={}):
-        if "##URL" in text or "##IMG" in text:
-            for key, value in content_dict.items():
-                text = text.replace(key, value)
-        return text
-    # TODO: solve for token overlap
-    current_chunk = ""
-    total_size = 0
+def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, content_dict: Dict[str, str]={}, token_overlap: int = 0) -> Generator[Tuple[str, int], None, None]:
+    """Merges consecutive pieces into chunks of at most num_tokens tokens (a larger piece is a chunk by itself).
+    The pieces are unmasked and encoded once into a single token array, and each chunk is a span of token offsets
+    into it that is decoded once, so chunks are never grown by concatenation or tokenized again.
+    Args:
+        chunked_content_list (List[str]): The pieces, in order, possibly masked (see PdfTextSplitter.mask_urls_and_imgs).
+        num_tokens (int): The maximum number of tokens in a chunk.
+        content_dict (Dict[str, str]): The masked urls and image tags by placeholder.
+        token_overlap (int): The number of tokens from the end of a chunk repeated at the start of the next one.
+            The overlap is shortened so the next chunk stays within num_tokens, and it never starts inside a character
+            or inside an unmasked url or image tag.
+    Returns:
+        Generator[Tuple[str, int]]: The chunks and their number of tokens.
+    """
+    tokenizer = TOKEN_ESTIMATOR.GPT2_TOKENIZER
+    tokens = []
+    # token spans of the unmasked urls and image tags, in order, that an overlap must not start inside
+    protected_starts = []
+    protected_ends = []
+
+    def unmask_urls_and_imgs(text):
+        """Returns the unmasked text and the utf-8 byte ranges of what was unmasked (only needed for overlaps)."""
+        if not content_dict or ("##URL" not in text and "##IMG" not in text):
+            return text, []
+        if token_overlap <= 0:
+            # only the placeholders present in this chunk are looked up
+            return MASK_PLACEHOLDER_REGEX.sub(lambda match: content_dict.get(match.group(0), match.group(0)), text), []
+        parts = []
+        byte_ranges = []
+        num_bytes = 0
+        last_end = 0
+        for match in MASK_PLACEHOLDER_REGEX.finditer(text):
+            before = text[last_end:match.start()]
+            unmasked = content_dict.get(match.group(0), match.group(0))
+            num_bytes += len(before.encode("utf-8"))
+            byte_ranges.append((num_bytes, num_bytes + len(unmasked.encode("utf-8"))))
+            num_bytes = byte_ranges[-1][1]
+            parts.append(before)
+            parts.append(unmasked)
+            last_end = match.end()
+        parts.append(text[last_end:])
+        return "".join(parts), byte_ranges
+
+    def overlap_start(chunk_start, chunk_end, next_piece_size):
+        """Token offset where the chunk after the span [chunk_start, chunk_end) starts."""
+        overlap = min(token_overlap, num_tokens - next_piece_size, chunk_end - chunk_start - 1)
+        start = chunk_end - max(0, overlap)
+        while start < chunk_end:
+            i = bisect_right(protected_starts, start) - 1
+            if i >= 0 and protected_starts[i] < start < protected_ends[i]:
+                start = protected_ends[i]
+            elif (tokenizer.decode_tokens_bytes([tokens[start]])[0][0] & 0xC0) == 0x80: # utf-8 continuation byte
+                start += 1
+            else:
+                break
+        return start
+
+    chunk_start = 0
     for chunked_content in chunked_content_list:
-        chunked_content = unmask_urls_and_imgs(chunked_content, content_dict)
-        chunk_size = TOKEN_ESTIMATOR.estimate_tokens(chunked_content)
-        if total_size > 0:
-            new_size = total_size + chunk_size
-            if new_size > num_tokens:
-                yield current_chunk, total_size
-                current_chunk = ""
-                total_size = 0
-        total_size += chunk_size
-        current_chunk += chunked_content
-    if total_size > 0:
-        yield current_chunk, total_size
+        chunked_content, byte_ranges = unmask_urls_and_imgs(chunked_content)
+        piece_tokens = tokenizer.encode(chunked_content, allowed_special="all")
+        piece_start = len(tokens)
+        if piece_start > chunk_start and piece_start - chunk_start + len(piece_tokens) > num_tokens:
+            yield tokenizer.decode(tokens[chunk_start:piece_start]), piece_start - chunk_start
+            chunk_start = overlap_start(chunk_start, piece_start, len(piece_tokens)) if token_overlap > 0 else piece_start
+        if byte_ranges:
+            token_ends = list(accumulate(len(token_bytes) for token_bytes in tokenizer.decode_tokens_bytes(piece_tokens)))
+            for byte_start, byte_end in byte_ranges:
+                protected_starts.append(piece_start + bisect_right(token_ends, byte_start))
+                protected_ends.append(piece_start + bisect_left(token_ends, byte_end) + 1)
+        tokens.extend(piece_tokens)
+    if len(tokens) > chunk_start:
+        yield tokenizer.decode(tokens[chunk_start:]), len(tokens) - chunk_start
 
 def get_payload_and_headers_cohere(
-    text, aad_token) -> Tuple[Dict, Dict]:
+    texts, aad_token) -> Tuple[Dict, Dict]:
     oai_headers =  {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {aad_token}",
     }
 
-    cohere_body = { "texts": [text], "input_type": "search_document" }
+    cohere_body = { "texts": texts, "input_type": "search_document" }
     return cohere_body, oai_headers
     
-def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+def get_embeddings(texts: List[str], embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None) -> List[List[float]]:
+    """Embeds the given texts with one request to the embedding model.
+    Args:
+        texts (List[str]): The texts to embed (non empty).
+        embedding_model_endpoint (str): The embedding model endpoint, defaults to EMBEDDING_MODEL_ENDPOINT.
+        embedding_model_key (str): The key of the endpoint, if azure_credential is not given.
+        azure_credential: The credential to get an Entra ID token for Azure OpenAI with.
+    Returns:
+        List[List[float]]: The embeddings, in the order of texts.
+    """
     endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
     
     FLAG_EMBEDDING_MODEL = os.getenv("FLAG_EMBEDDING_MODEL", "AOAI")
     FLAG_COHERE = os.getenv("FLAG_COHERE", "ENGLISH")
     FLAG_AOAI = os.getenv("FLAG_AOAI", "V3")
 
-    if azure_credential is None and (endpoint is None or key is None):
+    if endpoint is None:
         raise Exception("EMBEDDING_MODEL_ENDPOINT and EMBEDDING_MODEL_KEY are required for embedding")
 
     try:
@@ -768,20 +2006,20 @@ def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None,
             
             client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key)
             if FLAG_AOAI == "V2":
-                embeddings = client.embeddings.create(model=deployment_id, input=text)
+                embeddings = client.embeddings.create(model=deployment_id, input=texts)
             elif FLAG_AOAI == "V3":   
                 embeddings = client.embeddings.create(model=deployment_id, 
-                                                      input=text, 
+                                                      input=texts, 
                                                       dimensions=int(os.getenv("VECTOR_DIMENSION", 1536)))
             
-            return embeddings.model_dump()['data'][0]['embedding']
+            return [item.embedding for item in sorted(embeddings.data, key=lambda item: item.index)]
         
         if FLAG_EMBEDDING_MODEL == "COHERE":
             if FLAG_COHERE == "MULTILINGUAL":
                 key = embedding_model_key if embedding_model_key else os.getenv("COHERE_MULTILINGUAL_API_KEY")
             elif FLAG_COHERE == "ENGLISH":
                 key = embedding_model_key if embedding_model_key else os.getenv("COHERE_ENGLISH_API_KEY")
-            data, headers = get_payload_and_headers_cohere(text, key)
+            data, headers = get_payload_and_headers_cohere(texts, key)
 
             body = str.encode(json.dumps(data))
             req = urllib.request.Request(endpoint, body, headers)
@@ -789,12 +2027,322 @@ def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None,
             result = response.read()
             result_content = json.loads(result.decode('utf-8'))
                         
-            return result_content["embeddings"][0]   
+            return result_content["embeddings"]
         
 
     except Exception as e:
         raise Exception(f"Error getting embeddings with endpoint={endpoint} with error={e}")
 
+def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+    return get_embeddings([text], embedding_model_endpoint, embedding_model_key, azure_credential)[0]
+
+class TokenRateLimiter:
+    """Token bucket that keeps the tokens sent to a model under tokens_per_minute. Thread safe."""
+
+    def __init__(self, tokens_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self.available_tokens = tokens_per_minute
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, num_tokens: int):
+        """Blocks until num_tokens can be spent."""
+        num_tokens = min(num_tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available_tokens = min(self.tokens_per_minute, self.available_tokens + (now - self.updated_at) * self.tokens_per_minute / 60)
+                self.updated_at = now
+                if self.available_tokens >= num_tokens:
+                    self.available_tokens -= num_tokens
+                    return
+                wait_seconds = (num_tokens - self.available_tokens) * 60 / self.tokens_per_minute
+            time.sleep(wait_seconds)
+
+
+class ChunkDeduplicator:
+    """Drops the chunks that are duplicates of a previous chunk, keeping the first of each group.
+    Exact duplicates (same text up to whitespace) are found by hashing. Near duplicates are found with MinHash:
+    chunks whose estimated Jaccard similarity of word shingles is at least threshold. Candidates are looked up
+    with locality sensitive hashing on bands of the signatures, then their similarity is checked.
+    """
+
+    # the hashes are (a * x + b) mod a Mersenne prime, with x the 31 bit hash of a shingle, so that the products fit in 64 bits
+    PRIME = (1 << 31) - 1
+
+    def __init__(self, threshold: float = 0.9, policy: str = "keep-first", num_hashes: int = DEDUP_NUM_HASHES, shingle_size: int = DEDUP_SHINGLE_SIZE):
+        """
+        Args:
+            threshold (float): The minimum Jaccard similarity of near duplicates. 1.0 only drops exact duplicates.
+            policy (str): keep-first drops the duplicates, merge-urls also adds their urls to the "duplicate_urls"
+                          of the kept chunk's metadata.
+        """
+        if policy not in DEDUP_POLICIES:
+            raise Exception(f"Unknown dedup policy {policy}, expected one of {', '.join(DEDUP_POLICIES)}")
+        self.threshold = threshold
+        self.policy = policy
+        self.num_hashes = num_hashes
+        self.shingle_size = shingle_size
+        # fixed seed, so that runs deduplicate the same way
+        rng = random.Random(0)
+        self.hash_params = [(rng.randrange(1, self.PRIME), rng.randrange(0, self.PRIME)) for _ in range(num_hashes)]
+        self.num_bands, self.band_size = self._get_bands(threshold, num_hashes)
+
+    @staticmethod
+    def _get_bands(threshold: float, num_hashes: int) -> Tuple[int, int]:
+        """Picks the number of bands b and rows r (b * r = num_hashes) whose LSH threshold (1/b)^(1/r) is the highest one
+        under threshold, so that few near duplicates are missed and few candidates are compared."""
+        best = (num_hashes, 1)
+        for band_size in range(1, num_hashes + 1):
+            if num_hashes % band_size == 0:
+                num_bands = num_hashes // band_size
+                if (1 / num_bands) ** (1 / band_size) <= threshold:
+                    best = (num_bands, band_size)
+        return best
+
+    def _shingle_hashes(self, words: List[str]) -> List[int]:
+        shingles = {" ".join(words[i:i + self.shingle_size]) for i in range(max(1, len(words) - self.shingle_size + 1))}
+        return [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") & self.PRIME for shingle in shingles]
+
+    def get_signature(self, words: List[str]) -> Tuple[int, ...]:
+        """Returns the MinHash signature of the chunk's words."""
+        shingle_hashes = self._shingle_hashes(words)
+        if np is not None:
+            x = np.array(shingle_hashes, dtype=np.uint64)[:, None]
+            a = np.array([a for a, _ in self.hash_params], dtype=np.uint64)
+            b = np.array([b for _, b in self.hash_params], dtype=np.uint64)
+            return tuple(((a * x + b) % self.PRIME).min(axis=0).tolist())
+        return tuple(min((a * x + b) % self.PRIME for x in shingle_hashes) for a, b in self.hash_params)
+
+    def _merge(self, kept: Document, duplicate: Document):
+        url = duplicate.url or duplicate.filepath
+        if self.policy != "merge-urls" or url is None or url == (kept.url or kept.filepath):
+            return
+        # chunk_file stores the metadata as a json string, which is what the index field holds
+        metadata = kept.metadata if isinstance(kept.metadata, dict) else json.loads(kept.metadata or "{}")
+        duplicate_urls = metadata.setdefault("duplicate_urls", [])
+        if url not in duplicate_urls:
+            duplicate_urls.append(url)
+        if not isinstance(kept.metadata, dict):
+            kept.metadata = json.dumps(metadata)
+
+    def deduplicate(self, chunks: List[Document]) -> Tuple[List[Document], int, int]:
+        """
+        Args:
+            chunks (List[Document]): The chunks, in order.
+        Returns:
+            Tuple[List[Document], int, int]: The kept chunks in order, and the number of exact and near duplicates dropped.
+        """
+        kept_chunks = []
+        by_hash = {}
+        signatures = []
+        # band -> indexes in kept_chunks of the chunks with that band
+        buckets = {}
+        num_exact = 0
+        num_near = 0
+        for chunk in chunks:
+            words = chunk.content.split()
+            content_hash = hashlib.sha256(" ".join(words).encode("utf-8")).digest()
+            if content_hash in by_hash:
+                self._merge(kept_chunks[by_hash[content_hash]], chunk)
+                num_exact += 1
+                continue
+
+            if self.threshold < 1.0 and words:
+                signature = self.get_signature(words)
+                bands = [(i, signature[i * self.band_size:(i + 1) * self.band_size]) for i in range(self.num_bands)]
+                candidates = {index for band in bands for index in buckets.get(band, ())}
+                duplicate_of = next((index for index in sorted(candidates)
+                                     if sum(x == y for x, y in zip(signature, signatures[index])) >= self.threshold * self.num_hashes), None)
+                if duplicate_of is not None:
+                    self._merge(kept_chunks[duplicate_of], chunk)
+                    num_near += 1
+                    continue
+                for band in bands:
+                    buckets.setdefault(band, []).append(len(kept_chunks))
+            else:
+                signature = None
+
+            by_hash[content_hash] = len(kept_chunks)
+            signatures.append(signature)
+            kept_chunks.append(chunk)
+        return kept_chunks, num_exact, num_near
+
+def deduplicate_chunking_result(result: ChunkingResult, threshold: float = 0.9, policy: str = "keep-first") -> ChunkingResult:
+    """Drops the duplicate chunks of the result with ChunkDeduplicator, counting them in the result."""
+    result.chunks, num_exact, num_near = ChunkDeduplicator(threshold, policy).deduplicate(result.chunks)
+    result.num_exact_duplicate_chunks += num_exact
+    result.num_near_duplicate_chunks += num_near
+    print(f"Dropped {num_exact} exact and {num_near} near duplicate chunks, {len(result.chunks)} chunks left")
+    return result
+
+def _get_embedding_retry_seconds(error: Exception, retry: int) -> Optional[float]:
+    """Returns how long to wait before retrying a failed get_embeddings call, or None if it isn't worth retrying.
+    The Retry-After header of a throttled request is honored, other retryable failures back off exponentially."""
+    # get_embeddings raises from the error of the Azure OpenAI client or of urllib
+    cause = error.__context__ if error.__context__ is not None else error
+    if isinstance(cause, urllib.error.HTTPError):
+        status_code, headers = cause.code, cause.headers
+    elif getattr(cause, "response", None) is not None:
+        status_code, headers = cause.response.status_code, cause.response.headers
+    else:
+        # no response, e.g. a connection error
+        return _backoff_seconds(retry)
+    if status_code not in EMBEDDING_RETRY_STATUS_CODES:
+        return None
+    retry_after = headers.get("Retry-After") if headers else None
+    return float(retry_after) if retry_after and retry_after.isdigit() else _backoff_seconds(retry)
+
+def embed_chunks(chunks: List[Document], embedding_endpoint=None, azure_credential=None, compact_vectors=False, max_workers: int = 4, batch_size: int = EMBEDDING_BATCH_SIZE):
+    """Adds the contentVector of the chunks, embedding batch_size chunks per request with max_workers requests in flight.
+    Used instead of embedding each chunk while chunking when the chunks are deduplicated first."""
+    def embed_batch(batch: List[Document]):
+        for i in range(RETRY_COUNT):
+            try:
+                embeddings = get_embeddings([chunk.content for chunk in batch], embedding_endpoint, azure_credential=azure_credential)
+                break
+            except Exception as e:
+                retry_seconds = _get_embedding_retry_seconds(e, i)
+                if i == RETRY_COUNT - 1 or retry_seconds is None:
+                    raise
+                print(f"Error getting embeddings for {len(batch)} chunks with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
+                time.sleep(retry_seconds)
+        for chunk, embedding in zip(batch, embeddings):
+            chunk.contentVector = to_compact_vector(embedding) if compact_vectors else embedding
+
+    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(tqdm(executor.map(embed_batch, batches), total=len(batches), desc="Embedding chunks"))
+
+
+class TextFileReader:
+    """Reads a text file through a memory map, a block at a time, so that large files are never held as one string.
+    The file is read as utf-8, with the newlines translated as open() does. If it isn't utf-8, its encoding is detected from
+    a sample of at most 2 * ENCODING_SAMPLE_BYTES (the start of the file, and the bytes around the first undecodable one),
+    and it is read as is in that encoding, with the bytes it can't decode replaced if the detection was wrong.
+    """
+
+    def __init__(self, file_path: str, block_bytes: int = TEXT_STREAM_BLOCK_BYTES, sample_bytes: int = ENCODING_SAMPLE_BYTES):
+        self.file_path = file_path
+        self.block_bytes = block_bytes
+        self.sample_bytes = sample_bytes
+        self.size = os.path.getsize(file_path)
+        self._encoding = None
+        self._errors = "strict"
+
+    @contextmanager
+    def _map(self) -> Generator[Union[mmap.mmap, bytes], None, None]:
+        if self.size == 0:
+            # empty files can't be mapped
+            yield b""
+            return
+        with open(self.file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+    def _detect_encoding(self, mapped, error_offset: int) -> str:
+        from chardet import detect
+        sample = mapped[:self.sample_bytes]
+        if error_offset >= self.sample_bytes:
+            window_start = max(self.sample_bytes, error_offset - self.sample_bytes // 2)
+            sample += mapped[window_start:window_start + self.sample_bytes]
+        return detect(sample).get('encoding') or 'utf8'
+
+    def _decoder(self, encoding: str, errors: str = "strict"):
+        decoder = codecs.getincrementaldecoder(encoding)(errors)
+        if codecs.lookup(encoding).name == "utf-8":
+            decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+        return decoder
+
+    def read(self) -> str:
+        """Returns the whole text of the file. On the first undecodable byte, it is decoded again from the start in the
+        detected encoding, replacing what that encoding can't decode either."""
+        with self._map() as mapped:
+            if self._encoding is None:
+                try:
+                    text = self._decoder("utf-8").decode(mapped, final=True)
+                    self._encoding = "utf-8"
+                    return text
+                except UnicodeDecodeError as e:
+                    self._encoding = self._detect_encoding(mapped, e.start)
+            try:
+                return self._decoder(self._encoding, self._errors).decode(mapped, final=True)
+            except UnicodeDecodeError:
+                self._errors = "replace"
+                return self._decoder(self._encoding, self._errors).decode(mapped, final=True)
+
+    def blocks(self) -> Generator[str, None, None]:
+        """Returns the text of the file, in blocks decoded from block_bytes bytes each. The utf-8 check is this same pass:
+        the blocks already returned are kept, and the file goes on from its first undecodable byte in the detected
+        encoding, then with what that encoding can't decode either replaced."""
+        with self._map() as mapped:
+            encoding, errors = self._encoding or "utf-8", self._errors
+            start = 0
+            while True:
+                decoder = self._decoder(encoding, errors)
+                offset, buffered, flag = start, b"", 0
+                try:
+                    for offset in range(start, len(mapped), self.block_bytes):
+                        buffered, flag = decoder.getstate()
+                        text = decoder.decode(mapped[offset:offset + self.block_bytes], final=offset + self.block_bytes >= len(mapped))
+                        if text:
+                            yield text
+                    if self._encoding is None:
+                        self._encoding = encoding
+                    return
+                except UnicodeDecodeError as e:
+                    error_offset = offset - len(buffered) + e.start
+                    # what was decoded before the undecodable byte, but not returned yet
+                    text = mapped[offset - len(buffered):error_offset].decode(encoding, errors="replace")
+                    if isinstance(decoder, io.IncrementalNewlineDecoder):
+                        text = ("\r" if flag & 1 else "") + text
+                        text = text.replace("\r\n", "\n").replace("\r", "\n")
+                    if text:
+                        yield text
+                    if self._encoding is None:
+                        encoding = self._encoding = self._detect_encoding(mapped, error_offset)
+                    else:
+                        errors = self._errors = "replace"
+                    start = error_offset
+
+    def lines(self) -> Generator[str, None, None]:
+        """Returns the lines of the text of the file, as str.splitlines(keepends=True)."""
+        pending = ""
+        for block in self.blocks():
+            lines = (pending + block).splitlines(keepends=True)
+            # the last line may go on in the next block
+            pending = lines.pop() if lines else ""
+            yield from lines
+        if pending:
+            yield pending
+
+
+def chunk_text_file_helper(
+        reader: TextFileReader, file_name: Optional[str],
+        token_overlap: int,
+        num_tokens: int = 256
+) -> Generator[Tuple[str, int, Document], None, None]:
+    """Chunks a text file as chunk_content_helper chunks its text, a block at a time. The text of each block is split
+    with what was left of the previous block: all its chunks but the last are final, and the last one is split again
+    with the next block. Chunks are the same as from the whole text, except where a block's last chunk was cut from
+    a piece of text too long to be a chunk by itself.
+    """
+    doc = Document(content="", title=parser_factory("text").get_title(reader.lines(), file_name=file_name))
+    splitter = RecursiveCharacterTextSplitter(length_function=TOKEN_ESTIMATOR.estimate_tokens,
+            separators=SENTENCE_ENDINGS + WORDS_BREAKS,
+            chunk_size=num_tokens, chunk_overlap=token_overlap)
+    pending = ""
+    for block in cleanup_content_blocks(reader.blocks()):
+        text = pending + block
+        chunked_content_list = splitter.split_text(text)
+        if len(chunked_content_list) < 2:
+            pending = text
+            continue
+        for chunked_content in chunked_content_list[:-1]:
+            yield chunked_content, TOKEN_ESTIMATOR.estimate_tokens(chunked_content), doc
+        pending = text[text.rfind(chunked_content_list[-1]):]
+    for chunked_content in splitter.split_text(pending):
+        yield chunked_content, TOKEN_ESTIMATOR.estimate_tokens(chunked_content), doc
+
 
 def chunk_content_helper(
         content: str, file_format: str, file_name: Optional[str],
@@ -812,7 +2360,7 @@ def chunk_content_helper(
         yield doc.content, doc_content_size, doc
     else:
         if file_format == "markdown":
-            splitter = MarkdownTextSplitter.from_tiktoken_encoder(
+            splitter = MarkdownTextSplitter(length_function=TOKEN_ESTIMATOR.estimate_tokens,
                 chunk_size=num_tokens, chunk_overlap=token_overlap)
             chunked_content_list = splitter.split_text(
                 content)  # chunk the original content
@@ -821,14 +2369,19 @@ def chunk_content_helper(
                 chunk_doc.title = doc.title
                 yield chunk_doc.content, chunk_size, chunk_doc
         else:
+            # the splitters count with TOKEN_ESTIMATOR (same gpt2 encoding as from_tiktoken_encoder), so the
+            # counts of splits measured while splitting are reused from its cache
             if file_format == "python":
-                splitter = PythonCodeTextSplitter.from_tiktoken_encoder(
+                splitter = PythonCodeTextSplitter(length_function=TOKEN_ESTIMATOR.estimate_tokens,
                     chunk_size=num_tokens, chunk_overlap=token_overlap)
             else:
                 if file_format == "html_pdf": # cracked pdf converted to html
                     splitter = PdfTextSplitter(separator=SENTENCE_ENDINGS + WORDS_BREAKS, chunk_size=num_tokens, chunk_overlap=token_overlap)
+                    for chunked_content, chunk_size in splitter.split_text_with_sizes(doc.content):
+                        yield chunked_content, chunk_size, doc
+                    return
                 else:
-                    splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+                    splitter = RecursiveCharacterTextSplitter(length_function=TOKEN_ESTIMATOR.estimate_tokens,
                             separators=SENTENCE_ENDINGS + WORDS_BREAKS,
                             chunk_size=num_tokens, chunk_overlap=token_overlap)
             chunked_content_list = splitter.split_text(doc.content)
@@ -837,7 +2390,7 @@ def chunk_content_helper(
                 yield chunked_content, chunk_size, doc
 
 def chunk_content(
-    content: str,
+    content: Union[str, TextFileReader],
     file_name: Optional[str] = None,
     url: Optional[str] = None,
     ignore_errors: bool = True,
@@ -850,18 +2403,20 @@ def chunk_content(
     add_embeddings = False,
     azure_credential = None,
     embedding_endpoint = None,
-    image_mapping = {}
+    image_mapping = {},
+    compact_vectors = False
 ) -> ChunkingResult:
     """Chunks the given content. If ignore_errors is true, returns None
         in case of an error
     Args:
-        content (str): The content to chunk.
+        content (str): The content to chunk, or the TextFileReader of a text file to chunk as it is read.
         file_name (str): The file name. used for title, file format detection.
         url (str): The url. used for title.
         ignore_errors (bool): If true, ignores errors and returns None.
         num_tokens (int): The number of tokens in each chunk.
         min_chunk_size (int): The minimum chunk size below which chunks will be filtered.
         token_overlap (int): The number of tokens to overlap between chunks.
+        compact_vectors (bool): If true, embeddings are stored as float32 array('f') instead of lists of floats.
     Returns:
         List[Document]: List of chunked documents.
     """
@@ -877,13 +2432,21 @@ def chunk_content(
                 raise Exception(
                     f"{file_name} is not supported")
 
-        chunked_context = chunk_content_helper(
-            content=content,
-            file_name=file_name,
-            file_format=file_format,
-            num_tokens=num_tokens,
-            token_overlap=token_overlap
-        )
+        if isinstance(content, TextFileReader):
+            chunked_context = chunk_text_file_helper(
+                reader=content,
+                file_name=file_name,
+                num_tokens=num_tokens,
+                token_overlap=token_overlap
+            )
+        else:
+            chunked_context = chunk_content_helper(
+                content=content,
+                file_name=file_name,
+                file_format=file_format,
+                num_tokens=num_tokens,
+                token_overlap=token_overlap
+            )
         chunks = []
         skipped_chunks = 0
         for chunk, chunk_size, doc in chunked_context:
@@ -892,6 +2455,8 @@ def chunk_content(
                     for i in range(RETRY_COUNT):
                         try:
                             doc.contentVector = get_embedding(chunk, azure_credential=azure_credential, embedding_model_endpoint=embedding_endpoint)
+                            if compact_vectors:
+                                doc.contentVector = to_compact_vector(doc.contentVector)
                             break
                         except Exception as e:
                             print(f"Error getting embedding for chunk with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
@@ -941,59 +2506,158 @@ def image_content_to_tag(image_content: str) -> str:
     img_tag = f'<img src="IMG_{random_id}.jpg">{image_content.replace("<img>", "&lt;img&gt;").replace("</img>", "&lt;/img&gt;")}</img>'
     return img_tag
 
-def get_caption(image_path, captioning_model_endpoint, captioning_model_key):
-    encoded_image = base64.b64encode(open(image_path, 'rb').read()).decode('ascii')
-    file_ext = image_path.split(".")[-1]
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": captioning_model_key,
-    }
+def prepare_image_for_captioning(image_bytes: bytes, file_ext: str, max_edge: int = CAPTION_MAX_IMAGE_EDGE, jpeg_quality: int = CAPTION_JPEG_QUALITY) -> Tuple[bytes, str]:
+    """Downscales the image to fit max_edge pixels per edge and re-encodes it as jpeg, to cut upload size and vision tokens.
+    Args:
+        image_bytes (bytes): The encoded image.
+        file_ext (str): The image format, e.g. png.
+    Returns:
+        Tuple[bytes, str]: The image to send and its format. The image is returned unchanged if it is small already or can't be read.
+    """
+    try:
+        pixmap = fitz.Pixmap(image_bytes)
+        scale = max_edge / max(pixmap.width, pixmap.height)
+        if scale >= 1 and file_ext in ("jpg", "jpeg"):
+            return image_bytes, file_ext
+        if pixmap.alpha:
+            pixmap = fitz.Pixmap(pixmap, 0)
+        if pixmap.colorspace is None or pixmap.colorspace.n != 3:
+            pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+        if scale < 1:
+            pixmap = fitz.Pixmap(pixmap, max(1, round(pixmap.width * scale)), max(1, round(pixmap.height * scale)), None)
+        jpeg_bytes = pixmap.tobytes("jpg", jpg_quality=jpeg_quality)
+    except Exception as e:
+        print(f"Could not downscale image, sending it as is. Error: {e}")
+        return image_bytes, file_ext
+    if scale >= 1 and len(jpeg_bytes) >= len(image_bytes):
+        return image_bytes, file_ext
+    return jpeg_bytes, "jpeg"
+
+class CaptioningEngine:
+    """Captions images with a vision chat completions model.
+    Images are downscaled before upload, requests share one session and run on a bounded thread pool, and captions are
+    cached by image hash, in memory and (if cache_dir is given) on disk.
+    """
 
-    payload = {
-        "messages": [
-            {
-            "role": "system",
-            "content": [
-                {
-                "type": "text",
-                "text": "You are a captioning model that helps uses find descriptive captions."
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
+    def __init__(self, endpoint: str, key: str, max_workers: int = 4, max_image_edge: int = CAPTION_MAX_IMAGE_EDGE, cache_dir: Optional[str] = None):
+        self.endpoint = endpoint
+        self.max_image_edge = max_image_edge
+        self.cache_dir = cache_dir
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json", "api-key": key})
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._captions = {}
+
+    def _get_cache_path(self, image_hash: str) -> str:
+        return os.path.join(self.cache_dir, image_hash[:2], f"{image_hash}.txt")
+
+    def _get_cached_caption(self, image_hash: str) -> Optional[str]:
+        if image_hash in self._captions:
+            return self._captions[image_hash]
+        if self.cache_dir and os.path.exists(self._get_cache_path(image_hash)):
+            with open(self._get_cache_path(image_hash), "r", encoding="utf-8") as f:
+                self._captions[image_hash] = f.read()
+            return self._captions[image_hash]
+        return None
+
+    def _cache_caption(self, image_hash: str, caption: str):
+        self._captions[image_hash] = caption
+        if self.cache_dir:
+            path = self._get_cache_path(image_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(caption)
+            os.replace(temp_path, path)
+
+    def _post_with_retries(self, payload: Dict) -> requests.Response:
+        for i in range(RETRY_COUNT):
+            try:
+                response = self.session.post(self.endpoint, json=payload)
+            except requests.exceptions.RequestException as e:
+                print(f"Error getting caption with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
+                time.sleep(_backoff_seconds(i))
+                continue
+            if response.status_code not in CAPTION_RETRY_STATUS_CODES:
+                break
+            retry_after = response.headers.get("Retry-After")
+            print(f"Error getting caption with status_code={response.status_code}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
+            time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else _backoff_seconds(i))
+        else:
+            raise Exception(f"Error getting caption after {RETRY_COUNT} retries")
+
+        if response.status_code != 200:
+            raise Exception(f"Error getting caption with status_code={response.status_code}")
+        return response
+
+    def caption(self, image_bytes: bytes, file_ext: str) -> str:
+        """Returns a descriptive caption of the given image."""
+        image_hash = hashlib.sha256(image_bytes + f"|{self.max_image_edge}".encode()).hexdigest()
+        caption = self._get_cached_caption(image_hash)
+        if caption is not None:
+            return caption
+
+        image_bytes, file_ext = prepare_image_for_captioning(image_bytes, file_ext, max_edge=self.max_image_edge)
+        encoded_image = base64.b64encode(image_bytes).decode('ascii')
+        payload = {
+            "messages": [
                 {
-                "type": "text",
-                "text": "Describe this image as if you were describing it to someone who can't see it. "
+                "role": "system",
+                "content": [
+                    {
+                    "type": "text",
+                    "text": "You are a captioning model that helps uses find descriptive captions."
+                    }
+                ]
                 },
                 {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/{file_ext};base64,{encoded_image}"
+                "role": "user",
+                "content": [
+                    {
+                    "type": "text",
+                    "text": "Describe this image as if you were describing it to someone who can't see it. "
+                    },
+                    {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/{file_ext};base64,{encoded_image}"
+                    }
+                    }
+                ]
                 }
-                }
-            ]
-            }
-        ],
-        "temperature": 0
-    }
+            ],
+            "temperature": 0
+        }
 
-    for i in range(RETRY_COUNT):
-        try:
-            response = requests.post(captioning_model_endpoint, headers=headers, json=payload)
-            response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
-            break
-        except Exception as e:
-            print(f"Error getting caption with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
-            time.sleep(15)
+        response = self._post_with_retries(payload)
+        caption = response.json()["choices"][0]["message"]["content"]
+        self._cache_caption(image_hash, caption)
+        return caption
 
-    if response.status_code != 200:
-        raise Exception(f"Error getting caption with status_code={response.status_code}")
-    
-    caption = response.json()["choices"][0]["message"]["content"]
+    def caption_many(self, images: List[Tuple[bytes, str]]) -> List[str]:
+        """Captions the given (image bytes, format) pairs concurrently, in order."""
+        return list(self.executor.map(lambda image: self.caption(*image), images))
+
+@lru_cache(maxsize=None)
+def get_captioning_engine(captioning_model_endpoint: str, captioning_model_key: str, cache_dir: Optional[str] = None) -> CaptioningEngine:
+    # one engine (session, thread pool and in memory cache) per process
+    return CaptioningEngine(captioning_model_endpoint, captioning_model_key, cache_dir=cache_dir)
+
+def get_caption(image_path, captioning_model_endpoint, captioning_model_key, caption_cache_dir=None, figure_asset_store=None):
+    with open(image_path, 'rb') as f:
+        image_bytes = f.read()
+    file_ext = image_path.split(".")[-1]
+
+    caption = get_captioning_engine(captioning_model_endpoint, captioning_model_key, caption_cache_dir).caption(image_bytes, file_ext)
     img_tag = image_content_to_tag(caption)
-    mapping = {img_tag: f"data:image/{file_ext};base64,{encoded_image}"}
+    if figure_asset_store is not None:
+        mapping = {img_tag: figure_asset_store.put(image_bytes, file_ext)}
+    else:
+        encoded_image = base64.b64encode(image_bytes).decode('ascii')
+        mapping = {img_tag: f"data:image/{file_ext};base64,{encoded_image}"}
 
     return img_tag, mapping
 
@@ -1011,16 +2675,32 @@ def chunk_file(
     azure_credential = None,
     embedding_endpoint = None,
     captioning_model_endpoint = None,
-    captioning_model_key = None
+    captioning_model_key = None,
+    compact_vectors = False,
+    analyze_cache_dir = None,
+    caption_cache_dir = None,
+    figure_store = None,
+    figure_max_edge = FIGURE_MAX_EDGE,
+    local_extraction = False
 ) -> ChunkingResult:
     """Chunks the given file.
     Args:
         file_path (str): The file to chunk.
+        analyze_cache_dir (str): Optional directory to cache the Form Recognizer results of pdf, docx and pptx files in.
+            Files in the cache are not sent to Form Recognizer again, so that they can be re-chunked locally.
+        caption_cache_dir (str): Optional directory to cache image captions in, keyed by image hash.
+        figure_store (str): Optional local directory or blob container url to store the pdf figures and images in.
+            The chunks' image_mapping then holds the asset ids (local) or blob urls instead of base64 data urls.
+        figure_max_edge (int): The maximum number of pixels per edge of the pdf figures stored in the figure store.
+        local_extraction (bool): If true, pdf, docx, pptx and xlsx files are extracted locally when their text can be (see DocumentExtractor),
+            and only the others are sent to Form Recognizer. Without it, xlsx files are unsupported. Formats added by plugins are always extracted locally.
     Returns:
         List[Document]: List of chunked documents.
     """
     file_name = os.path.basename(file_path)
     file_format = _get_file_format(file_name, extensions_to_process)
+    if file_format in LOCAL_EXTRACTION_ONLY_FORMATS and not local_extraction:
+        file_format = None
     image_mapping = {}
     if not file_format:
         if ignore_errors:
@@ -1031,28 +2711,43 @@ def chunk_file(
             raise UnsupportedFormatError(f"{file_name} is not supported")
 
     cracked_pdf = False
-    if file_format in ["pdf", "docx", "pptx"]:
-        if form_recognizer_client is None:
+    figure_asset_store = get_figure_asset_store(figure_store) if figure_store else None
+    # documents that can be extracted locally don't go to Form Recognizer, the extractor routes the others to it
+    extractor = parser_factory.get_extractor(file_format)
+    locally_extracted = False
+    if extractor is not None and (local_extraction or file_format not in DOCUMENT_INTELLIGENCE_FORMATS):
+        content = extractor.extract(file_path, use_layout=use_layout)
+        locally_extracted = content is not None
+    if locally_extracted:
+        cracked_pdf = True
+    elif file_format in DOCUMENT_INTELLIGENCE_FORMATS:
+        if form_recognizer_client is None and analyze_cache_dir is None:
             raise UnsupportedFormatError("form_recognizer_client is required for pdf files")
-        content, image_mapping = extract_pdf_content(file_path, form_recognizer_client, use_layout=use_layout)
+        analyze_result_cache = AnalyzeResultCache(analyze_cache_dir) if analyze_cache_dir else None
+        captioning_engine = None
+        if captioning_model_endpoint and captioning_model_key:
+            captioning_engine = get_captioning_engine(captioning_model_endpoint, captioning_model_key, caption_cache_dir)
+        content, image_mapping = extract_pdf_content(file_path, form_recognizer_client, use_layout=use_layout,
+                                                     analyze_result_cache=analyze_result_cache, captioning_engine=captioning_engine,
+                                                     figure_asset_store=figure_asset_store, figure_max_edge=figure_max_edge)
         cracked_pdf = True
+    elif extractor is not None:
+        raise UnsupportedFormatError(f"{file_name} could not be extracted")
     elif file_format in ["png", "jpg", "jpeg", "webp"]:
         # Make call to LLM for a descriptive caption
         if captioning_model_endpoint is None or captioning_model_key is None:
             raise Exception("CAPTIONING_MODEL_ENDPOINT and CAPTIONING_MODEL_KEY are required for images")
-        content, image_mapping = get_caption(file_path, captioning_model_endpoint, captioning_model_key)
+        content, image_mapping = get_caption(file_path, captioning_model_endpoint, captioning_model_key, caption_cache_dir=caption_cache_dir,
+                                             figure_asset_store=figure_asset_store)
     else:
-        try:
-            with open(file_path, "r", encoding="utf8") as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            from chardet import detect
-            with open(file_path, "rb") as f:
-                binary_content = f.read()
-                encoding = detect(binary_content).get('encoding', 'utf8')
-                content = binary_content.decode(encoding)
+        # large text files are chunked as they are read, the others are read whole
+        reader = TextFileReader(file_path)
+        if file_format == "text" and reader.size >= TEXT_STREAMING_MIN_BYTES and num_tokens is not None:
+            content = reader
+        else:
+            content = reader.read()
         
-    return chunk_content(
+    result = chunk_content(
         content=content,
         file_name=file_name,
         ignore_errors=ignore_errors,
@@ -1066,8 +2761,12 @@ def chunk_file(
         add_embeddings=add_embeddings,
         azure_credential=azure_credential,
         embedding_endpoint=embedding_endpoint,
-        image_mapping=image_mapping
+        image_mapping=image_mapping,
+        compact_vectors=compact_vectors
     )
+    if locally_extracted:
+        result.num_locally_extracted_files = 1
+    return result
 
 
 def process_file(
@@ -1085,7 +2784,13 @@ def process_file(
         azure_credential = None,
         embedding_endpoint = None,
         captioning_model_endpoint = None,
-        captioning_model_key = None
+        captioning_model_key = None,
+        compact_vectors = False,
+        analyze_cache_dir = None,
+        caption_cache_dir = None,
+        figure_store = None,
+        figure_max_edge = FIGURE_MAX_EDGE,
+        local_extraction = False
     ):
 
     if not form_recognizer_client:
@@ -1113,7 +2818,13 @@ def process_file(
             azure_credential=azure_credential,
             embedding_endpoint=embedding_endpoint,
             captioning_model_endpoint=captioning_model_endpoint,
-            captioning_model_key=captioning_model_key
+            captioning_model_key=captioning_model_key,
+            compact_vectors=compact_vectors,
+            analyze_cache_dir=analyze_cache_dir,
+            caption_cache_dir=caption_cache_dir,
+            figure_store=figure_store,
+            figure_max_edge=figure_max_edge,
+            local_extraction=local_extraction
         )
         for chunk_idx, chunk_doc in enumerate(result.chunks):
             chunk_doc.filepath = rel_file_path
@@ -1142,30 +2853,132 @@ def chunk_blob_container(
         njobs=4,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        compact_vectors = False,
+        analyze_cache_dir = None,
+        max_downloads: int = 4,
+        blob_manifest: Optional[BlobManifest] = None,
+        dedup_threshold: Optional[float] = None,
+        dedup_policy: str = "keep-first",
+        figure_store = None,
+        figure_max_edge = FIGURE_MAX_EDGE,
+        local_extraction = False
 ):
-    with tempfile.TemporaryDirectory() as local_data_folder:
-        print(f'Downloading {blob_url} to local folder')
-        downloadBlobUrlToLocalFolder(blob_url, local_data_folder, credential)
-        print(f'Downloaded.')
+    """
+    Chunks the blobs under the given url. Blobs are listed lazily and downloaded with bounded parallelism
+    while the blobs downloaded before are being chunked. Each blob is streamed to a temp file that is deleted
+    as soon as it has been chunked, so the local disk used is bounded by the blobs in flight, not the container size.
+    Args:
+        blob_url (str): The url of the container or folder to chunk, e.g. https://<account>.blob.core.windows.net/<container>/<folder>
+        credential: The credential to access the storage account with.
+        njobs (int): The number of processes to chunk the blobs with.
+        max_downloads (int): The maximum number of blobs downloaded concurrently.
+        blob_manifest (BlobManifest): If given, blobs with the same ETag or Content-MD5 as in the manifest are skipped,
+                            and the chunked blobs are recorded in it. Save it once their chunks have been uploaded.
+        dedup_threshold (float): If given, duplicate chunks are dropped before they are embedded, see chunk_directory.
+        figure_store (str): Optional local directory or blob container url to store the pdf figures in, see chunk_directory.
+        local_extraction (bool): If true, the pdf, docx, pptx and xlsx blobs are extracted locally when possible, see chunk_directory.
+        See chunk_directory for the other arguments.
 
-        result = chunk_directory(
-            local_data_folder,
-            ignore_errors=ignore_errors,
-            num_tokens=num_tokens,
-            min_chunk_size=min_chunk_size,
-            url_prefix=url_prefix,
-            token_overlap=token_overlap,
-            extensions_to_process=extensions_to_process,
-            form_recognizer_client=form_recognizer_client,
-            use_layout=use_layout,
-            njobs=njobs,
-            add_embeddings=add_embeddings,
-            azure_credential=azure_credential,
-            embedding_endpoint=embedding_endpoint
-        )
+    Returns:
+        ChunkingResult: The chunks of the blobs and the chunking statistics.
+    """
+    (storage_account, container_name, path) = extractStorageDetailsFromUrl(blob_url)
+    container_url = f'https://{storage_account}.blob.core.windows.net/{container_name}'
+    container_client = ContainerClient.from_container_url(container_url, credential=credential)
+    if path and not path.endswith('/'):
+        path = path + '/'
 
-    return result
+    num_unchanged_files = 0
+    # blob name -> (result, is_error, seconds), collected in listing order at the end
+    blob_names = []
+    file_results = {}
+
+    # a few blobs per process are kept ready, so that the processes never wait for downloads
+    max_blobs_in_flight = max_downloads + 2 * njobs
+
+    print(f'Chunking blobs of {blob_url} with njobs={njobs} and max_downloads={max_downloads}')
+    with tempfile.TemporaryDirectory() as local_data_folder:
+        chunking_kwargs = dict(directory_path=local_data_folder, ignore_errors=ignore_errors,
+                               num_tokens=num_tokens,
+                               min_chunk_size=min_chunk_size, url_prefix=url_prefix,
+                               token_overlap=token_overlap,
+                               extensions_to_process=extensions_to_process,
+                               form_recognizer_client=form_recognizer_client if njobs == 1 else None, use_layout=use_layout,
+                               add_embeddings=add_embeddings and dedup_threshold is None, azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
+                               compact_vectors=compact_vectors, analyze_cache_dir=analyze_cache_dir,
+                               figure_store=figure_store, figure_max_edge=figure_max_edge, local_extraction=local_extraction)
+        if njobs == 1:
+            _init_chunking_worker(chunking_kwargs)
+            chunk_executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            chunk_executor = ProcessPoolExecutor(max_workers=njobs, initializer=_init_chunking_worker, initargs=(chunking_kwargs,))
+
+        with ThreadPoolExecutor(max_workers=max_downloads) as download_executor, chunk_executor:
+            blobs = iter(container_client.list_blobs(name_starts_with=path))
+            downloads = {}
+            chunkings = {}
+            progress = tqdm(unit="file")
+            while True:
+                while len(downloads) + len(chunkings) < max_blobs_in_flight:
+                    blob = next(blobs, None)
+                    if blob is None:
+                        break
+                    relative_path = blob.name[len(path):]
+                    # skip the folder entries of hierarchical namespace accounts
+                    if not relative_path or relative_path.endswith('/'):
+                        continue
+                    blob_version = BlobManifest.get_blob_version(blob)
+                    if blob_manifest is not None and blob_manifest.is_unchanged(f"{container_url}/{blob.name}", blob_version):
+                        num_unchanged_files += 1
+                        continue
+                    blob_names.append(blob.name)
+                    local_path = os.path.join(local_data_folder, relative_path)
+                    download = download_executor.submit(download_blob_to_file, container_client, blob.name, local_path)
+                    downloads[download] = (blob.name, blob_version, local_path)
+
+                if not downloads and not chunkings:
+                    break
+
+                done, _ = wait(list(downloads) + list(chunkings), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in downloads:
+                        blob_name, blob_version, local_path = downloads.pop(future)
+                        try:
+                            future.result()
+                        except Exception as e:
+                            print(f"Blob ({blob_name}) failed to download with ", e)
+                            if not ignore_errors:
+                                raise
+                            if os.path.exists(local_path):
+                                os.remove(local_path)
+                            file_results[blob_name] = (None, True, 0.0)
+                            progress.update()
+                            continue
+                        chunkings[chunk_executor.submit(_chunk_files_in_worker, [local_path])] = (blob_name, blob_version, local_path)
+                    else:
+                        blob_name, blob_version, local_path = chunkings.pop(future)
+                        os.remove(local_path)
+                        result, is_error, seconds = future.result()[local_path]
+                        file_results[blob_name] = (result, is_error, seconds)
+                        progress.update()
+                        if blob_manifest is not None and not is_error and not result.num_files_with_errors:
+                            blob_manifest.update(f"{container_url}/{blob_name}", blob_version)
+            progress.close()
+
+    if num_unchanged_files:
+        print(f"Skipped {num_unchanged_files} blobs unchanged since the last run")
+
+    merged_result = collect_chunking_results({blob_name: file_results[blob_name] for blob_name in blob_names if blob_name in file_results})
+    merged_result.num_unchanged_files = num_unchanged_files
+    # keyed like the filepath of the chunks, relative to the temporary directory
+    merged_result.blob_urls = {os.path.normpath(blob_name[len(path):]): f"{container_url}/{blob_name}" for blob_name, (result, is_error, _) in file_results.items()
+                               if not is_error and not result.num_files_with_errors}
+    if dedup_threshold is not None:
+        deduplicate_chunking_result(merged_result, dedup_threshold, dedup_policy)
+        if add_embeddings:
+            embed_chunks(merged_result.chunks, embedding_endpoint, azure_credential, compact_vectors, max_workers=max(1, njobs))
+    return merged_result
 
 
 def chunk_directory(
@@ -1183,7 +2996,15 @@ def chunk_directory(
         azure_credential = None,
         embedding_endpoint = None,
         captioning_model_endpoint = None,
-        captioning_model_key = None
+        captioning_model_key = None,
+        compact_vectors = False,
+        analyze_cache_dir = None,
+        caption_cache_dir = None,
+        dedup_threshold: Optional[float] = None,
+        dedup_policy: str = "keep-first",
+        figure_store = None,
+        figure_max_edge = FIGURE_MAX_EDGE,
+        local_extraction = False
 ):
     """
     Chunks the given directory recursively
@@ -1200,70 +3021,359 @@ def chunk_directory(
         form_recognizer_client: Optional form recognizer client to use for pdf files.
         use_layout (bool): If true, uses Layout model for pdf files. Otherwise, uses Read.
         add_embeddings (bool): If true, adds a vector embedding to each chunk using the embedding model endpoint and key.
+        compact_vectors (bool): If true, embeddings are kept as float32 array('f') (~8x smaller than lists of floats,
+                            and much cheaper to send back from the worker processes).
+        analyze_cache_dir (str): Optional directory to cache the Form Recognizer results in, keyed by file hash, model and API version.
+        caption_cache_dir (str): Optional directory to cache image and figure captions in, keyed by image hash.
+        dedup_threshold (float): If given, chunks that are exact or near duplicates (Jaccard similarity >= dedup_threshold)
+                            of a previous chunk are dropped, and only the remaining chunks are embedded. See ChunkDeduplicator.
+        dedup_policy (str): keep-first or merge-urls, see ChunkDeduplicator.
+        figure_store (str): Optional local directory or blob container url to store the pdf figures and images in,
+                            so that the chunks reference them instead of holding them as base64. See FigureAssetStore.
+        figure_max_edge (int): The maximum number of pixels per edge of the pdf figures stored in the figure store.
+        local_extraction (bool): If true, pdf, docx, pptx and xlsx files are extracted locally when their text can be, and only
+                            scanned or layout critical documents are sent to Form Recognizer. See DocumentExtractor.
 
     Returns:
         List[Document]: List of chunked documents.
     """
-    chunks = []
-    total_files = 0
-    num_unsupported_format_files = 0
-    num_files_with_errors = 0
-    skipped_chunks = 0
-
     all_files_directory = get_files_recursively(directory_path)
     files_to_process = [file_path for file_path in all_files_directory if os.path.isfile(file_path)]
     print(f"Total files to process={len(files_to_process)} out of total directory size={len(all_files_directory)}")
 
-
+    chunking_kwargs = dict(directory_path=directory_path, ignore_errors=ignore_errors,
+                           num_tokens=num_tokens,
+                           min_chunk_size=min_chunk_size, url_prefix=url_prefix,
+                           token_overlap=token_overlap,
+                           extensions_to_process=extensions_to_process,
+                           form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=add_embeddings and dedup_threshold is None,
+                           azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
+                           captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key,
+                           compact_vectors=compact_vectors, analyze_cache_dir=analyze_cache_dir,
+                           caption_cache_dir=caption_cache_dir, figure_store=figure_store, figure_max_edge=figure_max_edge,
+                           local_extraction=local_extraction)
+
+    file_results = {}
     if njobs==1:
         print("Single process to chunk and parse the files. --njobs > 1 can help performance.")
+        _init_chunking_worker(chunking_kwargs)
         for file_path in tqdm(files_to_process):
-            total_files += 1
-            result, is_error = process_file(file_path=file_path,directory_path=directory_path, ignore_errors=ignore_errors,
-                                       num_tokens=num_tokens,
-                                       min_chunk_size=min_chunk_size, url_prefix=url_prefix,
-                                       token_overlap=token_overlap,
-                                       extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
-                                       captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
-            if is_error:
-                num_files_with_errors += 1
-                continue
-            chunks.extend(result.chunks)
-            num_unsupported_format_files += result.num_unsupported_format_files
-            num_files_with_errors += result.num_files_with_errors
-            skipped_chunks += result.skipped_chunks
+            file_results.update(_chunk_files_in_worker([file_path]))
     elif njobs > 1:
         print(f"Multiprocessing with njobs={njobs}")
-        process_file_partial = partial(process_file, directory_path=directory_path, ignore_errors=ignore_errors,
-                                       num_tokens=num_tokens,
-                                       min_chunk_size=min_chunk_size, url_prefix=url_prefix,
-                                       token_overlap=token_overlap,
-                                       extensions_to_process=extensions_to_process,
-                                       form_recognizer_client=None, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint,
-                                       captioning_model_endpoint=captioning_model_endpoint, captioning_model_key=captioning_model_key)
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            futures = list(tqdm(executor.map(process_file_partial, files_to_process), total=len(files_to_process)))
-            for result, is_error in futures:
-                total_files += 1
-                if is_error:
-                    num_files_with_errors += 1
-                    continue
-                chunks.extend(result.chunks)
-                num_unsupported_format_files += result.num_unsupported_format_files
-                num_files_with_errors += result.num_files_with_errors
-                skipped_chunks += result.skipped_chunks
+        # the clients are created in each worker by the initializer
+        chunking_kwargs["form_recognizer_client"] = None
+        tasks = schedule_chunking_tasks(files_to_process, extensions_to_process, njobs)
+        with ProcessPoolExecutor(max_workers=njobs, initializer=_init_chunking_worker, initargs=(chunking_kwargs,)) as executor:
+            futures = [executor.submit(_chunk_files_in_worker, task) for task in tasks]
+            with tqdm(total=len(files_to_process)) as progress:
+                for future in as_completed(futures):
+                    task_results = future.result()
+                    file_results.update(task_results)
+                    progress.update(len(task_results))
+
+    # results are collected in directory order, whatever order the files were chunked in
+    result = collect_chunking_results({file_path: file_results[file_path] for file_path in files_to_process if file_path in file_results})
+    if dedup_threshold is not None:
+        deduplicate_chunking_result(result, dedup_threshold, dedup_policy)
+        if add_embeddings:
+            embed_chunks(result.chunks, embedding_endpoint, azure_credential, compact_vectors, max_workers=max(1, njobs))
+    return result
 
-    return ChunkingResult(
-            chunks=chunks,
-            total_files=total_files,
-            num_unsupported_format_files=num_unsupported_format_files,
-            num_files_with_errors=num_files_with_errors,
-            skipped_chunks=skipped_chunks,
-        )
 
+def get_file_cost(file_path: str, extensions_to_process: List[str] = FILE_FORMAT_DICT.keys()) -> float:
+    """Estimates the cost of chunking the given file, from its size and format."""
+    file_format = _get_file_format(os.path.basename(file_path), extensions_to_process)
+    return os.path.getsize(file_path) * FILE_FORMAT_COSTS.get(file_format, 1)
+
+def schedule_chunking_tasks(files_to_process: List[str], extensions_to_process: List[str], njobs: int) -> List[List[str]]:
+    """Groups the files into chunking tasks, the most expensive first.
+    Submitting the largest files first keeps one large pdf from leaving the other workers idle at the end, and the small
+    files at the end are grouped so that each task is worth a round trip to a worker.
+    Args:
+        files_to_process (List[str]): The files to chunk.
+        extensions_to_process (List[str]): The list of extensions to process.
+        njobs (int): The number of worker processes.
+    Returns:
+        List[List[str]]: The tasks, as lists of file paths, in the order to submit them.
+    """
+    file_costs = {file_path: get_file_cost(file_path, extensions_to_process) for file_path in files_to_process}
+    target_task_cost = sum(file_costs.values()) / (njobs * CHUNKING_TASKS_PER_JOB)
+    tasks = []
+    task, task_cost = [], 0
+    for file_path in sorted(files_to_process, key=file_costs.get, reverse=True):
+        task.append(file_path)
+        task_cost += file_costs[file_path]
+        if task_cost >= target_task_cost:
+            tasks.append(task)
+            task, task_cost = [], 0
+    if task:
+        tasks.append(task)
+    return tasks
+
+_worker_chunking_kwargs = {}
+
+def _init_chunking_worker(chunking_kwargs: Dict[str, Any]):
+    # keeps the process_file arguments once per worker instead of pickling them with every task, and creates the clients once
+    global _worker_chunking_kwargs
+    _worker_chunking_kwargs = dict(chunking_kwargs)
+    if not _worker_chunking_kwargs.get("form_recognizer_client"):
+        _worker_chunking_kwargs["form_recognizer_client"] = SingletonFormRecognizerClient()
+
+def _chunk_files_in_worker(file_paths: List[str]) -> Dict[str, Tuple[Optional[ChunkingResult], bool, float]]:
+    task_results = {}
+    for file_path in file_paths:
+        start = time.perf_counter()
+        result, is_error = process_file(file_path, **_worker_chunking_kwargs)
+        task_results[file_path] = (result, is_error, time.perf_counter() - start)
+    return task_results
+
+def collect_chunking_results(file_results: Dict[str, Tuple[Optional[ChunkingResult], bool, float]]) -> ChunkingResult:
+    """Merges the chunking results of the files into one, and prints the slowest files.
+    Args:
+        file_results (Dict[str, Tuple[ChunkingResult, bool, float]]): The result, whether it failed, and the seconds spent, by file path.
+    Returns:
+        ChunkingResult: The merged result, with the chunks in the order of file_results.
+    """
+    merged_result = ChunkingResult(chunks=[], total_files=0)
+    for file_path, (result, is_error, seconds) in file_results.items():
+        merged_result.total_files += 1
+        merged_result.file_seconds[file_path] = seconds
+        if is_error:
+            merged_result.num_files_with_errors += 1
+            continue
+        merged_result.chunks.extend(result.chunks)
+        merged_result.num_unsupported_format_files += result.num_unsupported_format_files
+        merged_result.num_files_with_errors += result.num_files_with_errors
+        merged_result.skipped_chunks += result.skipped_chunks
+        merged_result.num_locally_extracted_files += result.num_locally_extracted_files
+
+    slowest_files = sorted(merged_result.file_seconds.items(), key=lambda file_seconds: file_seconds[1], reverse=True)[:NUM_SLOWEST_FILES_REPORTED]
+    if slowest_files:
+        print(f"Slowest files to chunk (of {merged_result.total_files} files, {sum(merged_result.file_seconds.values()):.1f}s in total):")
+        for file_path, seconds in slowest_files:
+            print(f"  {seconds:8.2f}s  {file_path}")
+    return merged_result
+
+
+@dataclass
+class UploadResult:
+    """Data model for the result of an index upload
+
+    Attributes:
+        num_succeeded (int): Number of documents uploaded.
+        failed (Dict[str, str]): Keys of the documents that failed after all retries, mapped to their last error.
+    """
+    num_succeeded: int = 0
+    failed: Dict[str, str] = field(default_factory=dict)
+
+def batch_documents_for_upload(
+        docs: Iterable[Dict],
+        max_batch_size: int = UPLOAD_MAX_BATCH_SIZE,
+        max_batch_bytes: int = UPLOAD_MAX_BATCH_BYTES
+) -> Generator[List[Dict], None, None]:
+    """Groups documents into upload batches that stay under both the document count and the payload size limits.
+    Args:
+        docs (Iterable[Dict]): The documents to upload, as json serializable dicts.
+        max_batch_size (int): Maximum number of documents per batch.
+        max_batch_bytes (int): Maximum (estimated) json payload size per batch.
+    Returns:
+        Generator[List[Dict]]: The batches.
+    """
+    batch = []
+    batch_bytes = 0
+    for d in docs:
+        # +1 for the separating comma
+        doc_bytes = len(json.dumps(d, ensure_ascii=False).encode("utf-8")) + 1
+        if batch and (len(batch) >= max_batch_size or batch_bytes + doc_bytes > max_batch_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(d)
+        batch_bytes += doc_bytes
+    if batch:
+        yield batch
+
+async def _upload_batch_with_retries(
+        search_client: AsyncSearchClient,
+        batch: List[Dict],
+        key_field: str,
+        retry_count: int,
+        progress_callback: Optional[Callable[[int, int], None]]
+) -> UploadResult:
+    result = UploadResult()
+    pending = batch
+    for i in range(retry_count):
+        last_attempt = i == retry_count - 1
+        try:
+            indexing_results = await search_client.upload_documents(documents=pending)
+        except (HttpResponseError, ServiceRequestError) as e:
+            status_code = getattr(e, "status_code", None)
+            if last_attempt or (status_code is not None and status_code not in UPLOAD_RETRY_STATUS_CODES):
+                for d in pending:
+                    result.failed[d[key_field]] = str(e)
+                break
+            print(f"Error uploading batch of {len(pending)} documents with error={e}, retrying, current at {i + 1} retry, {retry_count - (i + 1)} retries left")
+            await asyncio.sleep(_backoff_seconds(i))
+            continue
+
+        # a 207 response holds the status of each document: keep only the failed ones that can be retried
+        docs_by_key = {d[key_field]: d for d in pending}
+        retry_docs = []
+        num_succeeded = 0
+        num_failed = 0
+        for indexing_result in indexing_results:
+            if indexing_result.succeeded:
+                num_succeeded += 1
+            elif indexing_result.status_code in UPLOAD_RETRY_STATUS_CODES and not last_attempt:
+                retry_docs.append(docs_by_key[indexing_result.key])
+            else:
+                print(f"Indexing Failed for {indexing_result.key} with ERROR: {indexing_result.error_message}")
+                result.failed[indexing_result.key] = indexing_result.error_message
+                num_failed += 1
+        result.num_succeeded += num_succeeded
+        if progress_callback:
+            progress_callback(num_succeeded, num_failed)
+
+        if not retry_docs:
+            return result
+        pending = retry_docs
+        await asyncio.sleep(_backoff_seconds(i))
+
+    if progress_callback:
+        progress_callback(0, len(pending))
+    return result
+
+def _backoff_seconds(retry: int) -> float:
+    # exponential backoff with jitter, so concurrent batches don't retry in lockstep
+    return min(60, 2 ** retry) + random.random()
+
+async def upload_documents_concurrently(
+        search_client: AsyncSearchClient,
+        docs: Iterable[Dict],
+        key_field: str = "id",
+        max_batch_size: int = UPLOAD_MAX_BATCH_SIZE,
+        max_batch_bytes: int = UPLOAD_MAX_BATCH_BYTES,
+        max_concurrency: int = 4,
+        retry_count: int = RETRY_COUNT,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        batch_callback: Optional[Callable[[List[Dict], UploadResult], None]] = None
+) -> UploadResult:
+    """Uploads documents to an Azure AI Search index, keeping several batches in flight.
+    Batches are sized by document count and payload bytes. Throttled (429/503) requests are retried with backoff,
+    and for partial failures (207) only the failed documents are sent again.
+    docs is consumed lazily, at most max_concurrency batches are held in memory at a time.
+    Args:
+        search_client (azure.search.documents.aio.SearchClient): The async client of the target index.
+        docs (Iterable[Dict]): The documents to upload, as json serializable dicts.
+        key_field (str): The key field of the index.
+        max_batch_size (int): Maximum number of documents per request.
+        max_batch_bytes (int): Maximum (estimated) payload size per request.
+        max_concurrency (int): Maximum number of requests in flight.
+        retry_count (int): Number of attempts for each batch.
+        progress_callback (Callable[[int, int], None]): Called as batches complete, with the number of documents
+            that succeeded and failed since the last call.
+        batch_callback (Callable[[List[Dict], UploadResult], None]): Called with each batch and its result once it is done
+            (after retries). Batches can complete out of order.
+    Returns:
+        UploadResult: The number of uploaded documents and the failures.
+    """
+    result = UploadResult()
+    in_flight = set()
+    batches = {}
+
+    def collect(done):
+        for task in done:
+            batch_result = task.result()
+            result.num_succeeded += batch_result.num_succeeded
+            result.failed.update(batch_result.failed)
+            batch = batches.pop(task)
+            if batch_callback:
+                batch_callback(batch, batch_result)
+
+    for batch in batch_documents_for_upload(docs, max_batch_size=max_batch_size, max_batch_bytes=max_batch_bytes):
+        if len(in_flight) >= max_concurrency:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            collect(done)
+        task = asyncio.ensure_future(_upload_batch_with_retries(search_client, batch, key_field, retry_count, progress_callback))
+        batches[task] = batch
+        in_flight.add(task)
+
+    if in_flight:
+        done, _ = await asyncio.wait(in_flight)
+        collect(done)
+    return result
+
+@dataclass
+class BatchWriteReport:
+    """Data model for the result of a batched write to a vector store
+
+    Attributes:
+        num_batches (int): Number of batches.
+        num_written (int): Number of documents written.
+        failed_batches (Dict[int, str]): Batches that failed after all retries (by batch number), mapped to their last error.
+        failed_ids (List[str]): Ids of the documents in the failed batches.
+    """
+    num_batches: int = 0
+    num_written: int = 0
+    failed_batches: Dict[int, str] = field(default_factory=dict)
+    failed_ids: List[str] = field(default_factory=list)
+
+def _write_batch_with_retries(write_batch: Callable[[List], None], batch: List, batch_num: int, retry_count: int) -> Optional[Exception]:
+    for i in range(retry_count):
+        try:
+            write_batch(batch)
+            return None
+        except Exception as e:
+            print(f"Error writing batch {batch_num} with error={e}, retrying, current at {i + 1} retry, {retry_count - (i + 1)} retries left")
+            error = e
+            if i < retry_count - 1:
+                time.sleep(_backoff_seconds(i))
+    return error
+
+def write_batches_concurrently(
+        items: List,
+        write_batch: Callable[[List], None],
+        get_id: Callable[[Any], str],
+        batch_size: int = 100,
+        max_workers: int = 4,
+        retry_count: int = RETRY_COUNT
+) -> BatchWriteReport:
+    """Writes items in batches from a thread pool, retrying each batch on failure.
+    write_batch must be idempotent (e.g. an upsert keyed by a deterministic id) since a batch may be sent more than once.
+    Args:
+        items (List): The items to write.
+        write_batch (Callable[[List], None]): Writes one batch, raising on failure.
+        get_id (Callable[[Any], str]): Returns the id of an item, used for the failure report.
+        batch_size (int): Number of items per batch.
+        max_workers (int): Number of batches written in parallel.
+        retry_count (int): Number of attempts for each batch.
+    Returns:
+        BatchWriteReport: The number of items written and the failed batches.
+    """
+    batches = [items[i: i + batch_size] for i in range(0, len(items), batch_size)]
+    report = BatchWriteReport(num_batches=len(batches))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_write_batch_with_retries, write_batch, batch, batch_num, retry_count): batch_num
+            for batch_num, batch in enumerate(batches)
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Writing batches..."):
+            batch_num = futures[future]
+            error = future.result()
+            if error is None:
+                report.num_written += len(batches[batch_num])
+            else:
+                report.failed_batches[batch_num] = str(error)
+                report.failed_ids.extend(get_id(item) for item in batches[batch_num])
+    return report
+
+def print_batch_write_report(report: BatchWriteReport):
+    print(f"Wrote {report.num_written} documents in {report.num_batches} batches")
+    if report.failed_batches:
+        print(f"{len(report.failed_batches)} batches ({len(report.failed_ids)} documents) failed:")
+        for batch_num, error in sorted(report.failed_batches.items()):
+            print(f"  batch {batch_num}: {error}")
 
 class SingletonFormRecognizerClient:
     instance = None
@@ -1273,16 +3383,43 @@ class SingletonFormRecognizerClient:
             url = os.getenv("FORM_RECOGNIZER_ENDPOINT")
             key = os.getenv("FORM_RECOGNIZER_KEY")
             if url and key:
-                cls.instance = DocumentIntelligenceClient(
-                        endpoint=url, credential=AzureKeyCredential(key), headers={"x-ms-useragent": "sample-app-aoai-chatgpt/1.0.0"})
+                cls.instance = DocumentAnalysisEngine(
+                        endpoint=url, credential=AzureKeyCredential(key),
+                        max_concurrency=int(os.getenv("FORM_RECOGNIZER_MAX_CONCURRENCY", 4)),
+                        pages_per_request=int(os.getenv("FORM_RECOGNIZER_PAGES_PER_REQUEST", 100)))
             else:
                 print("SingletonFormRecognizerClient: Skipping since credentials not provided. Assuming NO form recognizer extensions(like .pdf) in directory")
                 cls.instance = object() # dummy object
         return cls.instance
 
-    def __getstate__(self):
-        return self.url, self.key
+@lru_cache(maxsize=None)
+def get_keyvault_secret(keyvault_url: str, secret_name: str, credential) -> str:
+    # index configs of the same run usually share their key vault secrets, they are looked up once
+    return SecretClient(keyvault_url, credential).get_secret(secret_name).value
+
+class TimingReport:
+    """Collects how long each stage of each target (e.g. index) took, across threads, to print them in one report."""
 
-    def __setstate__(self, state):
-        url, key = state
-        self.instance = DocumentIntelligenceClient(endpoint=url, credential=AzureKeyCredential(key), headers={"x-ms-useragent": "sample-app-aoai-chatgpt/1.0.0"})
+    def __init__(self):
+        self.timings = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def time(self, target: str, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.timings.append((target, stage, time.perf_counter() - start))
+
+    def print_report(self):
+        print("Timing report:")
+        for target, stage, seconds in self.timings:
+            print(f"  {seconds:9.1f}s  {stage:<24} {target}")
+        totals = {}
+        for target, _, seconds in self.timings:
+            totals[target] = totals.get(target, 0) + seconds
+        print("Total per target (stages of different targets overlap):")
+        for target, seconds in totals.items():
+            print(f"  {seconds:9.1f}s  {target}")
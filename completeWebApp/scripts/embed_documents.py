@@ -1,19 +1,204 @@
 import argparse
-from asyncio import sleep
 import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, List, Optional
 
 from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
+from tqdm import tqdm
 
-from data_utils import get_embedding
+from data_utils import get_embeddings, get_keyvault_secret, to_compact_vector, vector_to_list, TokenRateLimiter, TOKEN_ESTIMATOR, _backoff_seconds
 
 RETRY_COUNT = 5
 
+
+class InputBatch:
+    """Consecutive documents of the input file, embedded with one request."""
+
+    def __init__(self, first_line: int):
+        self.first_line = first_line
+        self.documents = []
+        self.num_tokens = 0
+        # offset in the input file right after the batch
+        self.end_offset = 0
+
+    @property
+    def last_line(self) -> int:
+        return self.first_line + len(self.documents) - 1
+
+    @property
+    def texts(self) -> List[str]:
+        # empty contents can't be embedded, these documents are written without a vector
+        return [document["content"] for document in self.documents if document.get("content")]
+
+
+def read_batches(input_file, first_line: int, batch_size: int, max_tokens_per_request: int) -> Generator[InputBatch, None, None]:
+    """Reads the NDJSON input file (opened in binary mode) from its current position, in batches of at most batch_size documents
+    and max_tokens_per_request tokens."""
+    batch = InputBatch(first_line)
+    for line in iter(input_file.readline, b""):
+        if not line.strip():
+            continue
+        document = json.loads(line)
+        num_tokens = TOKEN_ESTIMATOR.estimate_tokens(document.get("content") or "")
+        if batch.documents and (len(batch.documents) >= batch_size or batch.num_tokens + num_tokens > max_tokens_per_request):
+            yield batch
+            batch = InputBatch(batch.last_line + 1)
+        batch.documents.append(document)
+        batch.num_tokens += num_tokens
+        batch.end_offset = input_file.tell()
+    if batch.documents:
+        yield batch
+
+
+def embed_batch(batch: InputBatch, embedding_endpoint: str, embedding_key: str, rate_limiter: TokenRateLimiter) -> InputBatch:
+    texts = batch.texts
+    if not texts:
+        return batch
+    rate_limiter.acquire(batch.num_tokens)
+    for retry in range(RETRY_COUNT):
+        try:
+            embeddings = get_embeddings(texts, embedding_endpoint, embedding_key)
+            break
+        except Exception as e:
+            if retry == RETRY_COUNT - 1:
+                raise
+            print(f"Error generating embeddings for lines {batch.first_line}-{batch.last_line}: {e}. Retrying...")
+            time.sleep(_backoff_seconds(retry))
+
+    embeddings = iter(embeddings)
+    for document in batch.documents:
+        if document.get("content"):
+            document["contentVector"] = next(embeddings)
+    return batch
+
+
+def load_checkpoint(checkpoint_path: str) -> Optional[Dict[str, int]]:
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint_path: str, checkpoint: Dict[str, int]):
+    with open(f"{checkpoint_path}.tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+
+def embed_documents(input_data_path: str, output_file_path: str, embedding_endpoint: str, embedding_key: str,
+                    batch_size: int = 16, max_tokens_per_request: int = 32000, tokens_per_minute: int = 240000, concurrency: int = 4):
+    """Embeds the documents of the NDJSON input file and writes them with their contentVector to the output file, in input order.
+    Batches are embedded concurrently under the tokens per minute budget. After each batch is written, the input and output offsets
+    are saved to <output_file_path>.checkpoint, so that a rerun resumes where the last one stopped.
+    """
+    checkpoint_path = f"{output_file_path}.checkpoint"
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint:
+        print(f"Resuming from checkpoint, {checkpoint['num_documents']} documents already embedded.")
+    else:
+        checkpoint = {"input_offset": 0, "output_offset": 0, "num_documents": 0}
+
+    rate_limiter = TokenRateLimiter(tokens_per_minute)
+    with open(input_data_path, "rb") as input_file, open(output_file_path, "r+b" if checkpoint["output_offset"] else "wb") as output_file, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor, tqdm(initial=checkpoint["num_documents"], unit="doc") as progress:
+        input_file.seek(checkpoint["input_offset"])
+        output_file.seek(checkpoint["output_offset"])
+        output_file.truncate()
+
+        def write_batch(batch: InputBatch):
+            for document in batch.documents:
+                output_file.write((json.dumps(document) + "\n").encode("utf-8"))
+            output_file.flush()
+            checkpoint["input_offset"] = batch.end_offset
+            checkpoint["output_offset"] = output_file.tell()
+            checkpoint["num_documents"] += len(batch.documents)
+            save_checkpoint(checkpoint_path, checkpoint)
+            progress.update(len(batch.documents))
+
+        # batches are written in input order, while up to 2 * concurrency of them are embedded ahead
+        pending = deque()
+        for batch in read_batches(input_file, checkpoint["num_documents"], batch_size, max_tokens_per_request):
+            pending.append(executor.submit(embed_batch, batch, embedding_endpoint, embedding_key, rate_limiter))
+            while len(pending) >= 2 * concurrency:
+                write_batch(pending.popleft().result())
+        while pending:
+            write_batch(pending.popleft().result())
+
+    os.remove(checkpoint_path)
+
+
+def write_batch_api_requests(input_data_path: str, requests_file_path: str, embedding_endpoint: str, batch_size: int = 16, max_tokens_per_request: int = 32000):
+    """Writes the embedding requests for the input documents in the Azure OpenAI Batch API format, for offline bulk jobs.
+    The custom_id of each request is the range of input lines it embeds, see merge_batch_api_results.
+    """
+    deployment_id = embedding_endpoint.split("/openai/deployments/")[1].split("/embeddings")[0]
+    num_requests = 0
+    with open(input_data_path, "rb") as input_file, open(requests_file_path, "w") as requests_file:
+        for batch in read_batches(input_file, 0, batch_size, max_tokens_per_request):
+            if not batch.texts:
+                continue
+            body = {"model": deployment_id, "input": batch.texts}
+            if os.getenv("FLAG_AOAI", "V3") == "V3":
+                body["dimensions"] = int(os.getenv("VECTOR_DIMENSION", 1536))
+            request = {"custom_id": f"{batch.first_line}-{batch.last_line}", "method": "POST", "url": "/embeddings", "body": body}
+            requests_file.write(json.dumps(request) + "\n")
+            num_requests += 1
+    print(f"{num_requests} Batch API requests written to {requests_file_path}.")
+
+
+def merge_batch_api_results(input_data_path: str, results_file_path: str, output_file_path: str):
+    """Adds the embeddings of a Batch API results file to the input documents, and writes them to the output file in input order."""
+    # embeddings by input line, kept as float32 until written
+    embeddings = {}
+    num_failed_requests = 0
+    with open(results_file_path) as results_file:
+        for line in results_file:
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                num_failed_requests += 1
+                print(f"Batch API request {result['custom_id']} failed: {result.get('error') or response.get('body')}")
+                continue
+            first_line, _ = map(int, result["custom_id"].split("-"))
+            data = sorted(response["body"]["data"], key=lambda item: item["index"])
+            embeddings[first_line] = [to_compact_vector(item["embedding"]) for item in data]
+
+    num_missing = 0
+    with open(input_data_path, "rb") as input_file, open(output_file_path, "w") as output_file:
+        request_embeddings = iter([])
+        # lines are numbered as in read_batches, skipping blank lines
+        line_number = -1
+        for line in input_file:
+            if not line.strip():
+                continue
+            line_number += 1
+            document = json.loads(line)
+            if line_number in embeddings:
+                request_embeddings = iter(embeddings.pop(line_number))
+            if document.get("content"):
+                embedding = next(request_embeddings, None)
+                if embedding is None:
+                    num_missing += 1
+                else:
+                    document["contentVector"] = vector_to_list(embedding)
+            output_file.write(json.dumps(document) + "\n")
+    print(f"Embeddings merged and saved to {output_file_path}. {num_failed_requests} failed requests, {num_missing} documents without embedding.")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_data_path", type=str, required=True)
     parser.add_argument("--output_file_path", type=str, required=True)
     parser.add_argument("--config_file", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, default=16, help="Maximum number of documents embedded per request.")
+    parser.add_argument("--max_tokens_per_request", type=int, default=32000, help="Maximum number of tokens embedded per request.")
+    parser.add_argument("--tokens_per_minute", type=int, default=240000, help="Tokens per minute budget of the embedding deployment.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of concurrent embedding requests.")
+    parser.add_argument("--batch_api_requests_file", type=str, help="Instead of embedding, write the requests for the Azure OpenAI Batch API to this file.")
+    parser.add_argument("--batch_api_results_file", type=str, help="Instead of embedding, merge the embeddings of this Azure OpenAI Batch API results file into the documents.")
 
     args = parser.parse_args()
 
@@ -24,44 +209,42 @@ if __name__ == "__main__":
 
     if type(config) is not list:
         config = [config]
-    
+
+    embedded_endpoints = set()
     for index_config in config:
+        embedding_endpoint = index_config.get("embedding_endpoint")
+        if not embedding_endpoint:
+            raise ValueError("No embedding endpoint provided in config file. Embeddings will not be generated.")
+        # indexes sharing an embedding model share the embeddings of the documents
+        if embedding_endpoint in embedded_endpoints:
+            print(f"Embeddings for {embedding_endpoint} already generated, skipping index {index_config.get('index_name')}.")
+            continue
+        embedded_endpoints.add(embedding_endpoint)
+
+        if args.batch_api_requests_file:
+            write_batch_api_requests(args.input_data_path, args.batch_api_requests_file, embedding_endpoint,
+                                     batch_size=args.batch_size, max_tokens_per_request=args.max_tokens_per_request)
+            continue
+        if args.batch_api_results_file:
+            merge_batch_api_results(args.input_data_path, args.batch_api_results_file, args.output_file_path)
+            continue
+
         # Keyvault Secret Client
         keyvault_url = index_config.get("keyvault_url")
         if not keyvault_url:
             print("No keyvault url provided in config file. Secret client will not be set up.")
-            secret_client = None
-        else:
-            secret_client = SecretClient(keyvault_url, credential)
 
         # Get Embedding key
         embedding_key_secret_name = index_config.get("embedding_key_secret_name")
         if not embedding_key_secret_name:
             raise ValueError("No embedding key secret name provided in config file. Embeddings will not be generated.")
         else:
-            embedding_key_secret = secret_client.get_secret(embedding_key_secret_name)
-            embedding_key = embedding_key_secret.value
-
-        embedding_endpoint = index_config.get("embedding_endpoint")
-        if not embedding_endpoint:
-            raise ValueError("No embedding endpoint provided in config file. Embeddings will not be generated.")
+            embedding_key = get_keyvault_secret(keyvault_url, embedding_key_secret_name, credential)
 
         # Embed documents
         print("Generating embeddings...")
-        with open(args.input_data_path) as input_file, open(args.output_file_path, "w") as output_file:
-            for line in input_file:
-                document = json.loads(line)
-                # Sleep/Retry in case embedding model is rate limited.
-                for _ in range(RETRY_COUNT):
-                    try:
-                        embedding = get_embedding(document["content"], embedding_endpoint,  embedding_key)
-                        document["contentVector"] = embedding
-                        break
-                    except:
-                        print("Error generating embedding. Retrying...")
-                        sleep(30)
-                
-                output_file.write(json.dumps(document) + "\n")
+        embed_documents(args.input_data_path, args.output_file_path, embedding_endpoint, embedding_key,
+                        batch_size=args.batch_size, max_tokens_per_request=args.max_tokens_per_request,
+                        tokens_per_minute=args.tokens_per_minute, concurrency=args.concurrency)
 
         print("Embeddings generated and saved to {}.".format(args.output_file_path))
-
@@ -3,7 +3,6 @@ import argparse
 import json
 import os
 import time
-import uuid
 import pinecone
 
 import requests
@@ -14,7 +13,7 @@ from azure.identity import AzureCliCredential
 
 from typing import List
 
-from data_utils import chunk_directory
+from data_utils import chunk_directory, get_document_id, vector_to_list, write_batches_concurrently, print_batch_write_report, BatchWriteReport
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -101,27 +100,22 @@ def create_or_update_vector_search_index(
      
 def upsert_documents_to_index(
         index_name: str,
-        docs: List[Document]
-        ):
+        docs: List[Document],
+        batch_size: int = 100,
+        max_workers: int = 4
+        ) -> BatchWriteReport:
     
     index = pinecone.Index(index_name)
-    for document in docs:
-        finalDocChunk:dict = {}
-        finalDocChunk["id"] = f"{uuid.uuid4()}"
-        finalDocChunk['title'] = document.title
-        finalDocChunk["filepath"] = document.filepath
-        finalDocChunk["url"] = ""
-        finalDocChunk["content"] = document.content
-        finalDocChunk["contentvector"] = document.contentVector
-
-        try:
-            index.upsert([(finalDocChunk["id"],finalDocChunk["contentvector"], {"title":finalDocChunk['title'], "filepath":finalDocChunk['filepath'],"url":finalDocChunk['url'],"content":finalDocChunk['content']})])
-
-            print(f"Upsert doc chunk {document.id} successfully")
-        
-        except Exception as e:
-            print(f"Failed to upsert doc chunk {document.id}")
-            continue
+
+    def to_vector(document: Document):
+        metadata = {"title": document.title, "filepath": document.filepath, "url": "", "content": document.content}
+        return (get_document_id(document), vector_to_list(document.contentVector), metadata)
+
+    def upsert_batch(batch: List[Document]):
+        index.upsert(vectors=[to_vector(document) for document in batch])
+
+    # ids are deterministic, so retried or re-run batches overwrite the same vectors
+    return write_batches_concurrently(docs, upsert_batch, get_id=get_document_id, batch_size=batch_size, max_workers=max_workers)
 
 def validate_index(
         index_name):
@@ -177,7 +171,8 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
 
     # upsert documents to index
     print("Upserting documents to index...")
-    upsert_documents_to_index(index_name, result.chunks)
+    report = upsert_documents_to_index(index_name, result.chunks, batch_size=config.get("upsert_batch_size", 100), max_workers=config.get("upsert_max_workers", 4))
+    print_batch_write_report(report)
 
     # check if index is ready/validate index
     print("Validating index...")
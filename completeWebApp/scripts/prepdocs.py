@@ -1,9 +1,10 @@
 import argparse
-import dataclasses
+import asyncio
 import time
 
 from tqdm import tqdm
 from azure.identity import AzureDeveloperCliCredential
+from azure.identity.aio import AzureDeveloperCliCredential as AsyncAzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
@@ -19,11 +20,11 @@ from azure.search.documents.indexes.models import (
     VectorSearchAlgorithmConfiguration,
     HnswParameters
 )
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
 
-from data_utils import chunk_directory
+from data_utils import chunk_directory, upload_documents_concurrently, RETRY_COUNT, UPLOAD_MAX_BATCH_SIZE
 
 
 def create_search_index(index_name, index_client):
@@ -75,40 +76,34 @@ def create_search_index(index_name, index_client):
         print(f"Search index {index_name} already exists")
 
 
-def upload_documents_to_index(docs, search_client, upload_batch_size=50):
-    to_upload_dicts = []
-
-    id = 0
-    for document in docs:
-        d = dataclasses.asdict(document)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(id)})
-        if "contentVector" in d and d["contentVector"] is None:
-            del d["contentVector"]
-        to_upload_dicts.append(d)
-        id += 1
-
-    # Upload the documents in batches of upload_batch_size
-    for i in tqdm(
-        range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."
-    ):
-        batch = to_upload_dicts[i : i + upload_batch_size]
-        results = search_client.upload_documents(documents=batch)
-        num_failures = 0
-        errors = set()
-        for result in results:
-            if not result.succeeded:
-                print(
-                    f"Indexing Failed for {result.key} with ERROR: {result.error_message}"
-                )
-                num_failures += 1
-                errors.add(result.error_message)
-        if num_failures > 0:
-            raise Exception(
-                f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
-                f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}"
+def upload_documents_to_index(docs, search_client, upload_batch_size=UPLOAD_MAX_BATCH_SIZE, max_concurrency=4):
+    """Uploads docs through the async search_client (azure.search.documents.aio.SearchClient), closing it when done."""
+    # add id to documents
+    to_upload_dicts = (
+        document.to_dict(**{"@search.action": "upload", "id": str(id)})
+        for id, document in enumerate(docs)
+    )
+
+    async def upload(progress):
+        async with search_client:
+            return await upload_documents_concurrently(
+                search_client,
+                to_upload_dicts,
+                max_batch_size=upload_batch_size,
+                max_concurrency=max_concurrency,
+                progress_callback=lambda num_succeeded, num_failed: progress.update(num_succeeded + num_failed),
             )
 
+    with tqdm(total=len(docs), desc="Indexing Chunks...") as progress:
+        result = asyncio.run(upload(progress))
+
+    if result.failed:
+        errors = set(result.failed.values())
+        raise Exception(
+            f"INDEXING FAILED for {len(result.failed)} documents after {RETRY_COUNT} attempts. Re-running the upload will only overwrite existing documents."
+            f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}"
+        )
+
 
 def validate_index(index_name, index_client):
     for retry_count in range(5):
@@ -223,8 +218,18 @@ if __name__ == "__main__":
     print("Preparing data for index:", args.index)
     search_endpoint = f"https://{args.searchservice}.search.windows.net/"
     index_client = SearchIndexClient(endpoint=search_endpoint, credential=search_creds)
-    search_client = SearchClient(
-        endpoint=search_endpoint, credential=search_creds, index_name=args.index
+    # the uploader uses the async client, which needs an async credential
+    async_search_creds = (
+        (
+            AsyncAzureDeveloperCliCredential()
+            if args.tenantid == None
+            else AsyncAzureDeveloperCliCredential(tenant_id=args.tenantid, process_timeout=60)
+        )
+        if args.searchkey == None
+        else AzureKeyCredential(args.searchkey)
+    )
+    search_client = AsyncSearchClient(
+        endpoint=search_endpoint, credential=async_search_creds, index_name=args.index
     )
     form_recognizer_client = DocumentAnalysisClient(
         endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/",
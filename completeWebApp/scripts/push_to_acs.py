@@ -1,20 +1,82 @@
 import argparse
-from asyncio import sleep
-import dataclasses
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
 
-from data_preparation import create_or_update_search_index, upload_documents_to_index
+from data_preparation import create_or_update_search_index, upload_documents_to_index, validate_vector_config
+from data_utils import read_ndjson, get_keyvault_secret, TimingReport, VECTOR_DEFAULT_OVERSAMPLING
 
 RETRY_COUNT = 5
 
+
+def get_input_stamp(input_data_path):
+    """The path, size and modification time of the input, that a checkpoint is only resumed with if they are unchanged."""
+    stat = os.stat(input_data_path)
+    return {"path": os.path.abspath(input_data_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def push_documents(input_data_path, search_service_name, index_name, search_key, checkpoint_path, read_ahead=1000, max_concurrency=4, vector_dimensions=None):
+    """Streams the NDJSON documents to the index, holding only the read ahead buffer and the batches in flight in memory.
+    The input offset up to which all documents are indexed is saved to checkpoint_path as batches complete, so that
+    a rerun after an interruption resumes from there, if the input is unchanged. The checkpoint is removed once all
+    documents are indexed. Once documents fail to be indexed after all retries, no more documents are read, the batches
+    in flight complete and the upload fails, keeping the checkpoint before the first failed document.
+    With vector_dimensions, the vectors are truncated to that many dimensions as they are uploaded (see truncate_vector).
+    """
+    input_stamp = get_input_stamp(input_data_path)
+    checkpoint = {"offset": 0, "next_id": 0, "input": input_stamp}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            saved_checkpoint = json.load(f)
+        if saved_checkpoint.get("input") == input_stamp:
+            checkpoint = saved_checkpoint
+            print(f"Resuming from checkpoint, {checkpoint['next_id']} documents already indexed.")
+        else:
+            print(f"Ignoring checkpoint {checkpoint_path}, it was saved for another input or {input_data_path} changed since.")
+
+    # input offset after each document not yet covered by the checkpoint, by document id
+    document_offsets = {}
+    indexed_ids = set()
+    failed_ids = set()
+
+    def documents():
+        for id, (end_offset, document) in enumerate(read_ndjson(input_data_path, checkpoint["offset"], read_ahead), start=checkpoint["next_id"]):
+            # the checkpoint can't move past a failed document, reading on would only grow document_offsets
+            if failed_ids:
+                return
+            document_offsets[id] = end_offset
+            yield document
+
+    def save_checkpoint(batch, batch_result):
+        failed_ids.update(batch_result.failed)
+        indexed_ids.update(int(document["id"]) for document in batch if document["id"] not in batch_result.failed)
+        # batches complete out of order, the checkpoint only moves past documents that are all indexed
+        if checkpoint["next_id"] not in indexed_ids:
+            return
+        while checkpoint["next_id"] in indexed_ids:
+            indexed_ids.remove(checkpoint["next_id"])
+            checkpoint["offset"] = document_offsets.pop(checkpoint["next_id"])
+            checkpoint["next_id"] += 1
+        with open(f"{checkpoint_path}.tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+    upload_documents_to_index(search_service_name, "", "", index_name, documents(), admin_key=search_key, max_concurrency=max_concurrency,
+                              first_id=checkpoint["next_id"], batch_callback=save_checkpoint, vector_dimensions=vector_dimensions)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_data_path", type=str, required=True)
     parser.add_argument("--config_file", type=str, required=True)
+    parser.add_argument("--checkpoint_dir", type=str, default=".", help="Directory of the checkpoint files used to resume interrupted uploads.")
+    parser.add_argument("--read_ahead", type=int, default=1000, help="Maximum number of documents read ahead of the upload.")
+    parser.add_argument("--max_concurrency", type=int, default=4, help="Maximum number of upload batches in flight.")
+    parser.add_argument("--max_parallel_indexes", type=int, default=4, help="Maximum number of indexes pushed to concurrently.")
 
     args = parser.parse_args()
 
@@ -25,45 +87,55 @@ if __name__ == "__main__":
 
     if type(config) is not list:
         config = [config]
-    
-    for index_config in config:
+
+    def push_index(index_config):
         # Keyvault Secret Client
-        print("Connecting to keyvault...")
         keyvault_url = index_config.get("keyvault_url")
         if not keyvault_url:
             print("No keyvault url provided in config file. Secret client will not be set up.")
-            secret_client = None
-        else:
-            secret_client = SecretClient(keyvault_url, credential)
 
         # Get Search Key
         search_key_secret_name = index_config.get("search_key_secret_name")
         if not search_key_secret_name:
             raise ValueError("No search key secret name provided in config file. Index will not be created.")
         else:
-            search_key_secret = secret_client.get_secret(search_key_secret_name)
-            search_key = search_key_secret.value
+            search_key = get_keyvault_secret(keyvault_url, search_key_secret_name, credential)
 
         search_service_name = index_config.get("search_service_name")
         if not search_service_name:
             raise ValueError("No search service name provided in config file. Index will not be created.")
 
+        validate_vector_config(index_config)
+
         # Create Index
-        print("Creating index...")
         index_name = index_config.get("index_name", "default-index")
-        create_or_update_search_index(
-            service_name=search_service_name,
-            index_name=index_name,
-            vector_config_name="default" if "embedding_endpoint" in index_config else None,
-            admin_key=search_key
-        )
+        target = f"{search_service_name}/{index_name}"
+        print(f"Creating index {index_name}...")
+        with timing_report.time(target, "create index"):
+            create_or_update_search_index(
+                service_name=search_service_name,
+                index_name=index_name,
+                vector_config_name="default" if "embedding_endpoint" in index_config else None,
+                admin_key=search_key,
+                vector_dimensions=index_config.get("vector_dimensions"),
+                vector_compression=index_config.get("vector_compression"),
+                vector_oversampling=index_config.get("vector_oversampling", VECTOR_DEFAULT_OVERSAMPLING)
+            )
         print(f"Index {index_name} created.")
 
         # Upload Documents
-        print("Uploading documents...")
-        with open(args.input_data_path) as input_file:
-            documents = [json.loads(line) for line in input_file]
-        
-        upload_documents_to_index(search_service_name, "", "", index_name, documents, admin_key=search_key)
-        print("Done.")
+        print(f"Uploading documents to {index_name}...")
+        checkpoint_path = os.path.join(args.checkpoint_dir, f"push_to_acs.{search_service_name}.{index_name}.checkpoint")
+        with timing_report.time(target, "upload"):
+            push_documents(args.input_data_path, search_service_name, index_name, search_key, checkpoint_path,
+                           read_ahead=args.read_ahead, max_concurrency=args.max_concurrency, vector_dimensions=index_config.get("vector_dimensions"))
+        print(f"Done with {index_name}.")
 
+    # the same documents are pushed to each index once, and the indexes are independent so they are pushed concurrently
+    index_configs = {(index_config.get("search_service_name"), index_config.get("index_name", "default-index")): index_config for index_config in config}
+    timing_report = TimingReport()
+    with ThreadPoolExecutor(max_workers=args.max_parallel_indexes) as executor:
+        futures = [executor.submit(push_index, index_config) for index_config in index_configs.values()]
+    timing_report.print_report()
+    for future in futures:
+        future.result()
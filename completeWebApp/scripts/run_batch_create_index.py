@@ -31,7 +31,10 @@ run_config_by_data_path_3_small_512_512 = {
 }
 
 # change path and embedding models
+# all indexes go in one config, so that data_preparation chunks folders shared by indexes once
+# and creates and uploads to the indexes concurrently
 Path("logs").mkdir(exist_ok=True)
+batch_config = []
 for key, cfg in tqdm.tqdm(run_config_by_data_path_3_small_512_512.items()):
     folder = os.path.join("/index_data", key)
     
@@ -48,25 +51,26 @@ for key, cfg in tqdm.tqdm(run_config_by_data_path_3_small_512_512.items()):
     config_key = copy.deepcopy(config[0])
     config_key["data_path"] = os.path.abspath(folder)
     config_key["index_name"] = index
+    config_key["form_rec_use_layout"] = form_rec_use_layout
 
     print(config_key["data_path"])
-    with open(f"./config.{key}.json", "w") as f:
-        f.write(json.dumps([config_key]))
-    
-    command = [
-        "python",
-        "data_preparation.py",
-        "--config",
-        f"config.{key}.json",
-        "--embedding-model-endpoint",
-        '"EMBEDDING_MODEL_ENDPOINT"',
-        "--form-rec-resource",
-        "test-tprompt",
-        "--form-rec-key",
-        FORM_RECOGNIZER_KEY,
-    ] + (["--form-rec-use-layout"] if form_rec_use_layout else []) + [
-        "--njobs=8",
-    ]
-    str_command = " ".join(command)
-    with open(f"logs/stdout.{key}.txt", "w") as f_stdout, open(f"logs/stderr.{key}.txt", "w") as f_stderr:
-        subprocess.run(str_command, stdout=f_stdout, stderr=f_stderr)
+    batch_config.append(config_key)
+
+with open("./config.batch.json", "w") as f:
+    f.write(json.dumps(batch_config))
+
+command = [
+    "python",
+    "data_preparation.py",
+    "--config",
+    "config.batch.json",
+    "--embedding-model-endpoint",
+    "EMBEDDING_MODEL_ENDPOINT",
+    "--form-rec-resource",
+    "test-tprompt",
+    "--form-rec-key",
+    FORM_RECOGNIZER_KEY,
+    "--njobs=8",
+]
+with open("logs/stdout.batch.txt", "w") as f_stdout, open("logs/stderr.batch.txt", "w") as f_stderr:
+    subprocess.run(command, stdout=f_stdout, stderr=f_stderr)
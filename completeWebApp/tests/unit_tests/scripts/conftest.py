@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the data preparation scripts import each other as top level modules, as when they are run from their directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..", "scripts")))
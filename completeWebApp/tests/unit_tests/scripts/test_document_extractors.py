@@ -0,0 +1,132 @@
+import zipfile
+from importlib.metadata import EntryPoint
+
+import pytest
+import tiktoken
+
+try:
+    tiktoken.get_encoding("gpt2")
+except Exception:
+    pytest.skip("data_utils needs the gpt2 encoding of tiktoken, which couldn't be loaded", allow_module_level=True)
+
+import data_utils
+from data_utils import DocxExtractor, DocumentExtractor, ParserFactory, PptxExtractor, XlsxExtractor
+
+RELATIONSHIPS = '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{}</Relationships>'
+W = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+P = 'xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main" xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" ' \
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+S = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+
+
+def write_archive(path, parts):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, content in parts.items():
+            archive.writestr(name, content)
+    return str(path)
+
+
+def write_xlsx(path, cells, shared_strings=()):
+    rows = {}
+    for reference, cell in cells.items():
+        rows.setdefault(int(reference.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")), []).append(f'<c r="{reference}"{cell}</c>')
+    sheet_data = "".join(f'<row r="{row}">{"".join(row_cells)}</row>' for row, row_cells in sorted(rows.items()))
+    return write_archive(path, {
+        "xl/workbook.xml": f'<workbook {S}><sheets><sheet name="Sales" r:id="rId1"/></sheets></workbook>',
+        "xl/_rels/workbook.xml.rels": RELATIONSHIPS.format('<Relationship Id="rId1" Target="worksheets/sheet1.xml"/>'),
+        "xl/sharedStrings.xml": f'<sst {S}>{"".join(f"<si><t>{text}</t></si>" for text in shared_strings)}</sst>',
+        "xl/worksheets/sheet1.xml": f'<worksheet {S}><sheetData>{sheet_data}</sheetData></worksheet>',
+    })
+
+
+def test_docx_extractor(tmp_path):
+    path = write_archive(tmp_path / "report.docx", {"word/document.xml": f"""<w:document {W}><w:body>
+        <w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr><w:r><w:t>Results</w:t></w:r></w:p>
+        <w:p><w:r><w:t>Revenue</w:t></w:r><w:r><w:tab/><w:t>grew.</w:t></w:r></w:p>
+        <w:tbl>
+            <w:tr><w:tc><w:p><w:r><w:t>Year</w:t></w:r></w:p></w:tc><w:tc><w:p><w:r><w:t>Total</w:t></w:r></w:p></w:tc></w:tr>
+            <w:tr><w:tc><w:p><w:r><w:t>2024</w:t></w:r></w:p></w:tc><w:tc><w:p><w:r><w:t>12</w:t></w:r></w:p></w:tc></w:tr>
+        </w:tbl>
+    </w:body></w:document>"""})
+
+    assert DocxExtractor().extract(path) == "Results\nRevenue\tgrew.\nYear Total\n2024 12"
+    text = DocxExtractor().extract(path, use_layout=True)
+    assert text.startswith("<h2>Results</h2>\nRevenue\tgrew.\n<table>")
+    assert "<td>2024</td>" in text
+
+
+def test_pptx_extractor(tmp_path):
+    path = write_archive(tmp_path / "deck.pptx", {
+        "ppt/presentation.xml": f'<p:presentation {P}><p:sldIdLst><p:sldId id="256" r:id="rId2"/></p:sldIdLst></p:presentation>',
+        "ppt/_rels/presentation.xml.rels": RELATIONSHIPS.format('<Relationship Id="rId2" Target="slides/slide1.xml"/>'),
+        "ppt/slides/slide1.xml": f"""<p:sld {P}><p:cSld><p:spTree>
+            <p:sp><p:nvSpPr><p:nvPr><p:ph type="title"/></p:nvPr></p:nvSpPr><p:txBody><a:p><a:r><a:t>Roadmap</a:t></a:r></a:p></p:txBody></p:sp>
+            <p:sp><p:txBody><a:p><a:r><a:t>Ship the index</a:t></a:r></a:p><a:p><a:r><a:t>Measure recall</a:t></a:r></a:p></p:txBody></p:sp>
+        </p:spTree></p:cSld></p:sld>""",
+    })
+
+    assert PptxExtractor().extract(path) == "Roadmap\nShip the index\nMeasure recall"
+    assert PptxExtractor().extract(path, use_layout=True).startswith("<h2>Roadmap</h2>\n")
+
+
+def test_xlsx_extractor(tmp_path):
+    path = write_xlsx(tmp_path / "sales.xlsx", {
+        "A1": ' t="s"><v>0</v>', "B1": ' t="s"><v>1</v>',
+        "A2": ' t="inlineStr"><is><t>apples</t></is>', "B2": "><v>12</v>",
+        # a corrupt shared string index is an empty cell
+        "A3": ' t="s"><v>7</v>', "B3": ' t="b"><v>1</v>',
+    }, shared_strings=["Fruit", "Count"])
+
+    assert XlsxExtractor().extract(path) == "Sales\nFruit Count\napples 12\nTRUE"
+
+
+def test_xlsx_extractor_far_apart_cells(tmp_path, monkeypatch):
+    # only the rows and columns with values make the table, not the used range
+    path = write_xlsx(tmp_path / "sparse.xlsx", {"A1": "><v>1</v>", "XFD1048576": "><v>2</v>"})
+    assert XlsxExtractor().extract(path) == "Sales\n1\n2"
+
+    # larger tables are sent to Document Intelligence
+    monkeypatch.setattr(data_utils, "XLSX_MAX_SHEET_CELLS", 3)
+    assert XlsxExtractor().extract(path) is None
+
+
+def test_office_extractor_without_text(tmp_path):
+    path = write_archive(tmp_path / "scan.docx", {"word/document.xml": f"<w:document {W}><w:body><w:p/></w:body></w:document>"})
+    assert DocxExtractor().extract(path) is None
+
+
+class NoteExtractor(DocumentExtractor):
+    def extract(self, file_path, use_layout=False):
+        with open(file_path, encoding="utf-8") as f:
+            return f.read().upper()
+
+
+def test_register_extractor(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_utils, "FILE_FORMAT_DICT", dict(data_utils.FILE_FORMAT_DICT))
+    monkeypatch.setattr(data_utils, "parser_factory", ParserFactory())
+    data_utils.parser_factory.register("note", NoteExtractor(), extensions=["note", "notes"])
+    path = tmp_path / "meeting.notes"
+    path.write_text("the index is rebuilt every night from the blob container, and the figures are stored out of band")
+
+    result = data_utils.chunk_file(str(path), extensions_to_process=["notes"])
+    assert result.num_locally_extracted_files == 1
+    assert result.chunks[0].content.startswith("THE INDEX IS REBUILT")
+
+    with pytest.raises(TypeError):
+        data_utils.parser_factory.register("bad", object())
+
+
+def test_load_plugins(monkeypatch):
+    monkeypatch.setattr(data_utils, "FILE_FORMAT_DICT", dict(data_utils.FILE_FORMAT_DICT))
+    plugins = [
+        EntryPoint(name="note", value=f"{__name__}:NoteExtractor", group=data_utils.PARSER_ENTRY_POINT_GROUP),
+        EntryPoint(name="broken", value=f"{__name__}:MissingParser", group=data_utils.PARSER_ENTRY_POINT_GROUP),
+    ]
+    monkeypatch.setattr(data_utils, "entry_points", lambda group: plugins if group == data_utils.PARSER_ENTRY_POINT_GROUP else [])
+
+    factory = ParserFactory()
+    assert isinstance(factory.get_extractor("note"), NoteExtractor)
+    assert data_utils.FILE_FORMAT_DICT["note"] == "note"
+    # a plugin that fails to load is skipped
+    assert factory.get_extractor("broken") is None
+    assert "broken" not in factory.supported_formats
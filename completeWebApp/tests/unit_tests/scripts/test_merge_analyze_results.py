@@ -0,0 +1,112 @@
+import copy
+
+import pytest
+import tiktoken
+
+try:
+    tiktoken.get_encoding("gpt2")
+except Exception:
+    pytest.skip("data_utils needs the gpt2 encoding of tiktoken, which couldn't be loaded", allow_module_level=True)
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+from data_utils import extract_pdf_content, merge_analyze_results
+
+# the paragraphs of each page by role, its table by cell, and its page number
+PAGES = [
+    [("title", "Annual report"), (None, "Revenue grew in every region."), ("table", ["Region", "Revenue", "North", "12"]), (None, "1")],
+    [("sectionHeading", "Outlook"), (None, "Costs are expected to fall."), ("table", ["Quarter", "Costs", "Q1", "3"]), (None, "2")],
+    [(None, "Appendix with no heading."), ("table", ["Name", "Value", "A", "1"]), (None, "3")],
+]
+
+
+def build_analyze_result(pages, first_page_number=1):
+    """The layout result of the given pages, with one section per page, as Document Intelligence returns it."""
+    content = []
+    paragraphs, tables, sections, result_pages = [], [], [], []
+    offset = 0
+
+    def add_text(text):
+        nonlocal offset
+        span = {"offset": offset, "length": len(text)}
+        content.append(text)
+        offset += len(text) + 1
+        return span
+
+    for page_number, page in enumerate(pages, first_page_number):
+        page_start = offset
+        elements = []
+        for role, text in page:
+            region = {"pageNumber": page_number, "polygon": [0, 0, 1, 0, 1, 1, 0, 1]}
+            if role == "table":
+                cells = [{"rowIndex": i // 2, "columnIndex": i % 2, "content": cell, "spans": [add_text(cell)], "boundingRegions": [region]}
+                         for i, cell in enumerate(text)]
+                elements += [f"/tables/{len(tables)}", f"/tables/{len(tables)}/cells/0"]
+                tables.append({"rowCount": len(text) // 2, "columnCount": 2, "cells": cells, "boundingRegions": [region],
+                               "spans": [{"offset": cells[0]["spans"][0]["offset"], "length": offset - 1 - cells[0]["spans"][0]["offset"]}]})
+            else:
+                elements.append(f"/paragraphs/{len(paragraphs)}")
+                paragraphs.append({"content": text, "spans": [add_text(text)], "boundingRegions": [region], **({"role": role} if role else {})})
+        page_span = {"offset": page_start, "length": offset - 1 - page_start}
+        result_pages.append({"pageNumber": page_number, "spans": [page_span]})
+        sections.append({"spans": [page_span], "elements": elements})
+    return AnalyzeResult({"content": "\n".join(content), "pages": result_pages, "paragraphs": paragraphs, "tables": tables, "sections": sections})
+
+
+def resolve(result, pointer):
+    node = result
+    for part in pointer.strip("/").split("/"):
+        node = node[int(part)] if part.isdigit() else node[part]
+    return node
+
+
+def test_merged_ranges_match_the_whole_document():
+    whole = build_analyze_result(PAGES)
+    # the pages of each range are numbered from 1
+    ranges = [(2, build_analyze_result(PAGES[2:])), (0, build_analyze_result(PAGES[:2]))]
+
+    merged = merge_analyze_results(copy.deepcopy(ranges))
+
+    assert merged.as_dict() == whole.as_dict()
+    for paragraph in merged.paragraphs:
+        assert merged.content[paragraph.spans[0].offset:][:paragraph.spans[0].length] == paragraph.content
+    for table in merged.tables:
+        for cell in table.cells:
+            assert merged.content[cell.spans[0].offset:][:cell.spans[0].length] == cell.content
+    assert [page.page_number for page in merged.pages] == [1, 2, 3]
+    assert [region.page_number for table in merged.tables for region in table.bounding_regions] == [1, 2, 3]
+    # the pointers of the last range point at its elements, after those of the first range
+    assert resolve(merged, merged.sections[2].elements[0]).content == "Appendix with no heading."
+    assert resolve(merged, merged.sections[2].elements[2]).content == "Name"
+
+
+def test_first_range_not_on_the_first_page():
+    merged = merge_analyze_results([(1, build_analyze_result(PAGES[1:]))])
+
+    assert merged.as_dict() == build_analyze_result(PAGES[1:], 2).as_dict()
+
+
+class FakeClient:
+    """A DocumentIntelligenceClient that returns the given result for any document."""
+
+    def __init__(self, analyze_result):
+        self.analyze_result = analyze_result
+
+    def begin_analyze_document(self, model_id, request):
+        return self
+
+    def result(self):
+        return self.analyze_result
+
+
+@pytest.mark.parametrize("use_layout", [False, True])
+def test_extract_content_of_merged_ranges(tmp_path, use_layout):
+    file_path = tmp_path / "report.bin"
+    file_path.write_bytes(b"content")
+    merged = merge_analyze_results([(0, build_analyze_result(PAGES[:1])), (1, build_analyze_result(PAGES[1:]))])
+
+    text, _ = extract_pdf_content(str(file_path), FakeClient(merged), use_layout=use_layout)
+
+    assert text == extract_pdf_content(str(file_path), FakeClient(build_analyze_result(PAGES)), use_layout=use_layout)[0]
+    if use_layout:
+        assert "<h1>Annual report</h1>" in text and "<h2>Outlook</h2>" in text and "<td>Q1</td>" in text
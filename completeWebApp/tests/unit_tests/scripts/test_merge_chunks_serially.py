@@ -0,0 +1,101 @@
+import pytest
+import tiktoken
+
+try:
+    tiktoken.get_encoding("gpt2")
+except Exception:
+    pytest.skip("data_utils needs the gpt2 encoding of tiktoken, which couldn't be loaded", allow_module_level=True)
+
+from data_utils import MASK_PLACEHOLDER_REGEX, TOKEN_ESTIMATOR, merge_chunks_serially
+
+PIECES = [f"Sentence number {i} talks about item {i * 7} in some detail. " for i in range(40)]
+
+
+def merge_by_concatenation(pieces, num_tokens, content_dict={}):
+    """merge_chunks_serially as it was before overlaps, growing each chunk by concatenation."""
+    current_chunk = ""
+    total_size = 0
+    for piece in pieces:
+        if content_dict:
+            piece = MASK_PLACEHOLDER_REGEX.sub(lambda match: content_dict.get(match.group(0), match.group(0)), piece)
+        size = TOKEN_ESTIMATOR.estimate_tokens(piece)
+        if total_size > 0 and total_size + size > num_tokens:
+            yield current_chunk, total_size
+            current_chunk = ""
+            total_size = 0
+        total_size += size
+        current_chunk += piece
+    if total_size > 0:
+        yield current_chunk, total_size
+
+
+def chunk_starts(chunks, text):
+    """Offsets of the chunks in text, each chunk starting after the previous one."""
+    starts = []
+    for chunk, _ in chunks:
+        starts.append(text.index(chunk, starts[-1] + 1 if starts else 0))
+    return starts
+
+
+@pytest.mark.parametrize("num_tokens", [1, 16, 50, 1000])
+def test_no_overlap_is_concatenation(num_tokens):
+    content_dict = {"##URL0##": "https://example.com/a/very/long/path?with=query", "##IMG0##": "<img src='figure.png'>"}
+    pieces = PIECES[:10] + ["See ##URL0## and ##IMG0## here. "] + PIECES[10:]
+
+    assert list(merge_chunks_serially(pieces, num_tokens, content_dict)) == list(merge_by_concatenation(pieces, num_tokens, content_dict))
+
+
+def test_overlap_repeats_the_end_of_the_previous_chunk():
+    num_tokens = 3 * max(TOKEN_ESTIMATOR.estimate_tokens(piece) for piece in PIECES)
+    chunks = list(merge_chunks_serially(PIECES, num_tokens, token_overlap=num_tokens // 5))
+    text = "".join(PIECES)
+
+    assert len(chunks) > 2
+    assert all(size <= num_tokens for _, size in chunks)
+    assert all(TOKEN_ESTIMATOR.estimate_tokens(chunk) == size for chunk, size in chunks)
+    starts = chunk_starts(chunks, text)
+    for (chunk, _), start, next_start in zip(chunks, starts, starts[1:]):
+        # the next chunk starts inside this one, on a token boundary
+        assert start < next_start < start + len(chunk)
+    assert starts[-1] + len(chunks[-1][0]) == len(text)
+
+
+def test_overlap_never_starts_inside_an_unmasked_url():
+    url = "https://example.com/" + "/".join(f"segment{i}" for i in range(8))
+    content_dict = {f"##URL{i}##": f"{url}?page={i}" for i in range(8)}
+    pieces = [f"Part {i} links ##URL{i}## for more. " for i in range(8)]
+    unmasked_pieces = [f"Part {i} links {url}?page={i} for more. " for i in range(8)]
+    text = "".join(unmasked_pieces)
+    piece_size = max(TOKEN_ESTIMATOR.estimate_tokens(piece) for piece in unmasked_pieces)
+
+    chunks = list(merge_chunks_serially(pieces, 2 * piece_size, content_dict, token_overlap=piece_size // 2))
+
+    assert "".join(chunk for chunk, _ in chunks).count("##URL") == 0
+    urls = [(text.index(value), text.index(value) + len(value)) for value in content_dict.values()]
+    for start in chunk_starts(chunks, text)[1:]:
+        assert not any(url_start < start < url_end for url_start, url_end in urls)
+
+
+def test_overlap_never_starts_inside_a_character():
+    pieces = [f"{i}: 🙂🚀日本語の文章 ✓ñé. " for i in range(10)]
+    piece_size = max(TOKEN_ESTIMATOR.estimate_tokens(piece) for piece in pieces)
+
+    for token_overlap in range(1, piece_size):
+        chunks = list(merge_chunks_serially(pieces, 2 * piece_size, token_overlap=token_overlap))
+        assert len(chunks) > 2
+        assert all("�" not in chunk for chunk, _ in chunks)
+        # every chunk is a part of the text, so none starts with half a character
+        chunk_starts(chunks, "".join(pieces))
+
+
+def test_oversized_piece_is_a_chunk_by_itself():
+    large = " ".join(f"word{i}" for i in range(100)) + ". "
+    pieces = PIECES[:3] + [large] + PIECES[3:6]
+    large_size = TOKEN_ESTIMATOR.estimate_tokens(large)
+    num_tokens = 2 * max(TOKEN_ESTIMATOR.estimate_tokens(piece) for piece in PIECES)
+    assert large_size > num_tokens
+
+    for token_overlap in (0, 5):
+        chunks = list(merge_chunks_serially(pieces, num_tokens, token_overlap=token_overlap))
+        assert (large, large_size) in chunks
+        assert all(size <= num_tokens for chunk, size in chunks if chunk != large)
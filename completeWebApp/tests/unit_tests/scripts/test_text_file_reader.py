@@ -0,0 +1,54 @@
+import pytest
+import tiktoken
+
+try:
+    tiktoken.get_encoding("gpt2")
+except Exception:
+    pytest.skip("data_utils needs the gpt2 encoding of tiktoken, which couldn't be loaded", allow_module_level=True)
+
+from data_utils import TextFileReader
+
+
+def write_file(tmp_path, content):
+    path = tmp_path / "file.txt"
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_utf8_file(tmp_path):
+    path = write_file(tmp_path, "première ligne\r\nsecond line\rthird ✓\n".encode("utf-8") * 50)
+    expected = "première ligne\nsecond line\nthird ✓\n" * 50
+
+    for block_bytes in (7, 64, 1 << 20):
+        assert "".join(TextFileReader(path, block_bytes=block_bytes).blocks()) == expected
+    assert TextFileReader(path).read() == expected
+    assert list(TextFileReader(path, block_bytes=5).lines()) == expected.splitlines(keepends=True)
+
+
+def test_late_non_utf8_byte(tmp_path, monkeypatch):
+    content = "plain ascii text\r\n".encode("ascii") * 100 + "café à la crème\n".encode("latin-1")
+    path = write_file(tmp_path, content)
+    detected = []
+    monkeypatch.setattr(TextFileReader, "_detect_encoding", lambda self, mapped, offset: detected.append(offset) or "latin-1")
+
+    reader = TextFileReader(path, block_bytes=64)
+    text = "".join(reader.blocks())
+    assert text == "plain ascii text\n" * 100 + "café à la crème\n"
+    assert detected == [content.index(b"\xe9")]
+
+    # the encoding is known from then on, so the file is read again from its start in it
+    assert "".join(reader.blocks()) == content.decode("latin-1")
+    assert reader.read() == content.decode("latin-1")
+    assert len(detected) == 1
+
+    assert TextFileReader(path).read() == content.decode("latin-1")
+    assert detected[1] == detected[0]
+
+
+def test_wrongly_detected_encoding(tmp_path, monkeypatch):
+    content = b"abc\xe9def" + b"x" * 100 + b"\xff\xfe end"
+    path = write_file(tmp_path, content)
+    monkeypatch.setattr(TextFileReader, "_detect_encoding", lambda self, mapped, offset: "ascii")
+
+    assert "".join(TextFileReader(path, block_bytes=16).blocks()) == "abc�def" + "x" * 100 + "�� end"
+    assert TextFileReader(path).read() == content.decode("ascii", errors="replace")
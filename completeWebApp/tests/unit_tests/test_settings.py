@@ -70,3 +70,20 @@ def test_dotenv_with_elasticsearch_success(app_settings):
     
     
 
+
+
+def test_dotenv_with_local_vector_index_success(app_settings):
+    # Validate model object
+    assert app_settings.base_settings.datasource_type == "LocalVectorIndex"
+    assert app_settings.datasource is not None
+    assert app_settings.datasource.retrieves_locally
+    assert app_settings.datasource.path == "chunks_index"
+    assert app_settings.datasource.query_type == "vector_simple_hybrid"
+    assert app_settings.datasource.filter == {"filepath": ["a.md", "b.md"]}
+    
+    # Validate the retrieval parameters
+    payload = app_settings.datasource.construct_payload_configuration()
+    assert payload["type"] == "local_vector_index"
+    assert payload["parameters"]["top_n_documents"] == 3
+    assert payload["parameters"]["filter"] == {"filepath": ["a.md", "b.md"]}
+    assert payload["parameters"]["fields_mapping"]["title_field"] == "title"
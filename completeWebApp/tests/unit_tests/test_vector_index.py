@@ -0,0 +1,111 @@
+import json
+import numpy as np
+import pytest
+from backend.retrieval.hybrid import hybrid_search, reciprocal_rank_fusion
+from backend.retrieval.vector_index import LocalVectorIndex, build_index, recall
+
+
+@pytest.fixture(scope="function")
+def chunks_path(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / "chunks.ndjson"
+    with open(path, "w") as f:
+        for i in range(200):
+            chunk = {
+                "content": f"chunk {i} " + ("apple " * (1 + i % 3) if i % 10 == 0 else "pear"),
+                "id": str(i),
+                "filepath": f"{i % 4}.md",
+                "metadata": {"groups": ["all", f"group{i % 2}"]},
+                "contentVector": rng.normal(size=16).tolist()
+            }
+            f.write(json.dumps(chunk) + "\n")
+        f.write(json.dumps({"content": "not embedded", "id": "200"}) + "\n")
+    return str(path)
+
+
+def test_build_and_open_index(chunks_path, tmp_path):
+    build_index([chunks_path], str(tmp_path / "index"), filter_fields=["filepath", "metadata.groups"])
+    index = LocalVectorIndex(str(tmp_path / "index"))
+    
+    assert len(index) == 200
+    assert index.dimensions == 16
+    assert index.document(7) == {"content": "chunk 7 pear", "id": "7", "filepath": "3.md", "metadata": {"groups": ["all", "group1"]}}
+    assert np.allclose(np.linalg.norm(index.vectors, axis=1), 1)
+
+
+def test_filter_on_json_metadata(tmp_path):
+    # the data preparation scripts write metadata as a json string
+    path = tmp_path / "chunks.ndjson"
+    with open(path, "w") as f:
+        for i in range(10):
+            chunk = {"content": f"chunk {i}", "id": str(i), "metadata": json.dumps({"chunk_id": str(i % 3)}), "contentVector": [1.0, float(i)]}
+            f.write(json.dumps(chunk) + "\n")
+    index = build_index([str(path)], str(tmp_path / "index"), filter_fields=["metadata.chunk_id"], keyword_fields=["metadata.chunk_id"])
+
+    _, rows = index.search(index.vectors[0], k=10, filter={"metadata.chunk_id": "1"})
+    assert sorted(rows[0][rows[0] >= 0].tolist()) == [1, 4, 7]
+    _, rows = index.keywords.search(["2"], k=10)
+    assert sorted(rows[0][rows[0] >= 0].tolist()) == [2, 5, 8]
+
+
+def test_exact_search(chunks_path, tmp_path):
+    index = build_index([chunks_path], str(tmp_path / "index"))
+    queries = np.array(index.vectors[[3, 50, 199]]) * 2
+    
+    scores, rows = index.search(queries, k=5)
+    expected = np.argsort(-(queries / 2) @ np.array(index.vectors).T, axis=1)[:, :5]
+    assert rows.shape == (3, 5)
+    assert rows[:, 0].tolist() == [3, 50, 199]
+    assert np.allclose(scores[:, 0], 1, atol=1e-5)
+    assert recall(rows, expected) == 1.0
+
+
+def test_filtered_search(chunks_path, tmp_path):
+    index = build_index([chunks_path], str(tmp_path / "index"), filter_fields=["filepath", "metadata.groups"])
+    
+    _, rows = index.search(index.vectors[0], k=10, filter={"filepath": ["1.md", "2.md"], "metadata.groups": "group0"})
+    assert all(index.document(row)["filepath"] == "2.md" for row in rows[0])
+    
+    # fewer matches than k
+    scores, rows = index.search(index.vectors[0], k=60, filter={"filepath": "1.md"})
+    assert (rows[0] >= 0).sum() == 50
+    assert np.isneginf(scores[0, 50:]).all()
+    
+    with pytest.raises(ValueError):
+        index.search(index.vectors[0], filter={"title": "a"})
+
+
+def test_keyword_search(chunks_path, tmp_path):
+    index = build_index([chunks_path], str(tmp_path / "index"), filter_fields=["filepath"], keyword_fields=["content"])
+    
+    scores, rows = index.keywords.search(["apple", "Chunk 42", "banana"], k=30)
+    # the chunks with apple, more often in the shorter ones first
+    assert (rows[0] >= 0).sum() == 20
+    assert all(row % 10 == 0 for row in rows[0][rows[0] >= 0])
+    assert index.document(rows[0][0])["content"].count("apple") == 3
+    assert np.all(np.diff(scores[0][:20]) <= 0)
+    assert rows[1][0] == 42
+    assert (rows[2] == -1).all()
+    
+    _, rows = index.keywords.search(["apple"], k=30, mask=index.filter_mask({"filepath": "0.md"}))
+    assert sorted(rows[0][rows[0] >= 0].tolist()) == list(range(0, 200, 20))
+
+
+def test_reciprocal_rank_fusion():
+    vector_rows = np.array([[1, 2, 3], [4, -1, -1]])
+    keyword_rows = np.array([[3, 1, 5], [-1, -1, -1]])
+    
+    scores, rows = reciprocal_rank_fusion([vector_rows, keyword_rows], k=3, rrf_k=60)
+    assert rows.tolist() == [[1, 3, 2], [4, -1, -1]]
+    assert np.isclose(scores[0][0], 1 / 61 + 1 / 62)
+    assert np.isclose(scores[1][0], 1 / 61)
+
+
+def test_hybrid_search(chunks_path, tmp_path):
+    index = build_index([chunks_path], str(tmp_path / "index"), keyword_fields=["content"])
+    
+    _, rows = hybrid_search(index, ["chunk 30 apple"], index.vectors[30], k=5, candidates=20)
+    assert rows[0][0] == 30
+    
+    with pytest.raises(ValueError):
+        hybrid_search(build_index([chunks_path], str(tmp_path / "vectors_only")), ["apple"], index.vectors[0])